@@ -3,6 +3,9 @@
 import os
 import time
 import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 import pprint
 pretty_printer = pprint.PrettyPrinter()
@@ -14,6 +17,65 @@ import requests
 from utility_to_osm import gentle_requests
 request_session = gentle_requests.GentleRequests()
 from utility_to_osm import file_util
+from barnehagefakta_store import FileStore
+import profile_report
+file_store = FileStore()
+# e.g. http://localhost:8000 for standin_server.py
+barnehagefakta_url = os.environ.get('BARNEHAGEFAKTA_URL', 'http://barnehagefakta.no')
+thread_local = threading.local()
+
+class RateLimiter(object):
+    """Ensures at least min_interval seconds between the start of each request, across all threads"""
+    def __init__(self, min_interval=0.5):
+        self.min_interval = min_interval
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+def get_session():
+    """Returns the module level request_session for the main thread,
+    worker threads gets their own gentle_requests.GentleRequests"""
+    if threading.current_thread() is threading.main_thread():
+        return request_session
+    if not(hasattr(thread_local, 'request_session')):
+        thread_local.request_session = gentle_requests.GentleRequests()
+    return thread_local.request_session
+
+def get_url(url, rate_limiter=None, headers=None):
+    if rate_limiter is not None:
+        rate_limiter.wait()
+    with profile_report.timer('http_fetch'):
+        if headers:
+            r = get_session().get(url, headers=headers)
+        else:
+            r = get_session().get(url)
+    profile_report.add_bytes('http_fetch', len(r.content))
+    return r
+
+def conditional_headers(validators):
+    """Returns the If-None-Match/If-Modified-Since request headers given the stored ETag/Last-Modified"""
+    headers = dict()
+    if 'ETag' in validators:
+        headers['If-None-Match'] = validators['ETag']
+    if 'Last-Modified' in validators:
+        headers['If-Modified-Since'] = validators['Last-Modified']
+    return headers
+
+def response_validators(response):
+    """Returns the ETag/Last-Modified response headers (if any) as a dictionary"""
+    validators = dict()
+    for key in ('ETag', 'Last-Modified'):
+        if key in response.headers:
+            validators[key] = response.headers[key]
+    return validators
+
 #
 # Main
 #
@@ -35,7 +97,8 @@ def equal_json_responses(res1, res2, ignore=('id', 'indikatorDataKommune')):
     except:
         return res1 != res2
         
-def barnehagefakta_get_json(orgnr, old_age_days=5, cache_dir='data', keep_history=True):
+def barnehagefakta_get_json(orgnr, old_age_days=5, cache_dir='data', keep_history=True, rate_limiter=None,
+                            store=None):
     """Returns json string for the given orgnr, caches result to file in directory cache_dir. 
     If the cached result is older than old_age_days a new version is fetched.
     By default (if keep_history is True) changes in the response will detected 
@@ -51,31 +114,49 @@ def barnehagefakta_get_json(orgnr, old_age_days=5, cache_dir='data', keep_histor
     will visit barnehagefakta again, refreshing and returning the local .json file.
     If the responce has changed from last time, the previous result is archived as
     cache_dir/barnehagefakta_no_nbrId{orgnr}-{%Y-%m-%d}-OUTDATED.json
+    The refresh is a conditional request if the server gave an ETag or Last-Modified header
+    (stored as the .json.meta file), a 304 response simply touches and returns the cached file.
 
     May raise requests.ConnectionError if the connection fails.
+    If a RateLimiter is given, it is waited on before each request.
+    The files described above are the default FileStore, pass e.g. a barnehagefakta_store.SQLiteStore
+    as store to keep everything in a single file.
+    If the store has a journal, each archived response is also recorded in the barnehagefakta_store.ChangeJournal.
     """
-    
-    filename = os.path.join(cache_dir, 'barnehagefakta_no_orgnr{0}.json'.format(orgnr))
-    cached, outdated = file_util.cached_file(filename, old_age_days)
+    if store is None:
+        store = file_store
+
+    cached, outdated = store.load(orgnr, cache_dir, old_age_days)
     if cached is not None and not(outdated):
+        profile_report.count('cache_hit')
         return cached
+    profile_report.count('cache_miss')
     # else, else:
 
-    url = 'http://barnehagefakta.no/api/barnehage/{0}'.format(orgnr)
+    url = barnehagefakta_url + '/api/barnehage/{0}'.format(orgnr)
+    headers = dict()
+    if cached is not None:
+        headers = conditional_headers(store.load_validators(orgnr, cache_dir))
     # try:
-    r = request_session.get(url)
+    r = get_url(url, rate_limiter, headers=headers)
     # except requests.ConnectionError as e:
     #     logger.error('Could not connect to %s, try again later? %s', url, e)
     #     return None
     
     logger.info('requested %s, got %s', url, r)
+    if r.status_code == 304 and cached is not None:
+        profile_report.count('cache_not_modified')
+        logger.info('%s not modified, keeping the cached response', url)
+        store.touch(orgnr, cache_dir) # restarts the old_age_days countdown
+        return cached
+
     ret = None
     if r.status_code == 200:
         ret = r.content
     elif r.status_code == 404:
         # 404 seems to occur very frequently, try again and ensure we still get 404
         time.sleep(1)
-        r = request_session.get(url)
+        r = get_url(url, rate_limiter)
         if r.status_code != 404:
             logger.error('Seeing sporadic 404,%s for url = %s', r.status_code, url)
             if r.status_code == 200:
@@ -91,10 +172,13 @@ def barnehagefakta_get_json(orgnr, old_age_days=5, cache_dir='data', keep_histor
             # note: the date will represent the date we discovered this to be outdated
             # which is not all that logical, but we just need a unique filename (assuming old_age_days > 1).
             logger.warning('Change in response for id=%s, archiving old result', orgnr)
-            file_util.rename_file(filename, d.strftime("-%Y-%m-%d-OUTDATED")) # move old one
+            ref_outdated = store.archive(orgnr, cache_dir, d) # move old one
+            if store.journal is not None:
+                store.journal.append(orgnr, cache_dir, cached, ret,
+                                     outdated=ref_outdated, updated=store.ref(orgnr, cache_dir))
             #return ret, cached
 
-        file_util.write_file(filename, ret) # write
+        store.save(orgnr, cache_dir, ret, response_validators(r)) # write
     
     return ret
 
@@ -111,26 +195,115 @@ def barnehagefakta_get(orgnr, *args, **kwargs):
         raise NotFoundException('orgnr={0} returned 404'.format(orgnr))
     #return {}
     
-    dct = json.loads(j)
+    with profile_report.timer('json_parse'):
+        dct = json.loads(j)
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug('barnehagefakta_get(%s) -> %s', orgnr, pretty_printer.pformat(dct))
     return dct
 
+def barnehagefakta_get_many(orgnrs, concurrency=4, min_interval=0.5, window=None, **kwargs):
+    """Concurrent version of barnehagefakta_get for an iterable of orgnr (duplicates are only requested once),
+    uses a pool of concurrency threads, with at most one request started every min_interval seconds
+    and at most window (defaults to 4*concurrency) requests submitted but not yet yielded.
+    Yields the tuple (orgnr, dictionary, exception) as the results are completed (i.e. not in order),
+    where exception is None on success (e.g. NotFoundException on 404).
+    Additonal arguments are passed to barnehagefakta_get_json"""
+    if window is None:
+        window = 4*concurrency
+    rate_limiter = RateLimiter(min_interval)
+    seen = set()
+    futures = dict()            # future -> orgnr
+
+    def completed():
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            orgnr = futures.pop(future)
+            try:
+                yield orgnr, future.result(), None
+            except Exception as e:
+                yield orgnr, {}, e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for orgnr in orgnrs:
+            if orgnr in seen:
+                continue
+            seen.add(orgnr)
+            future = executor.submit(barnehagefakta_get, orgnr, rate_limiter=rate_limiter, **kwargs)
+            futures[future] = orgnr
+            while len(futures) >= window:
+                for result in completed():
+                    yield result
+
+        while len(futures) != 0:
+            for result in completed():
+                yield result
+
+def barnehagefakta_get_ordered(items, concurrency=4, min_interval=0.5, window=None, key=None, **kwargs):
+    """Like barnehagefakta_get_many, but for an iterable (e.g. a generator) of items, which is consumed lazily.
+    Yields the tuple (item, dictionary, exception) in the same order as items,
+    with at most window (defaults to 4*concurrency) requests in flight or waiting to be consumed,
+    such that memory does not depend on the number of items.
+    key(item) gives the orgnr (defaults to the item itself), an orgnr already in the window is not requested twice."""
+    if window is None:
+        window = 4*concurrency
+    if key is None:
+        key = lambda item: item
+    rate_limiter = RateLimiter(min_interval)
+    pending = deque()
+    in_flight = dict()          # orgnr -> [future, number of pending items with this orgnr]
+
+    def result(item, future):
+        try:
+            return item, future.result(), None
+        except Exception as e:
+            return item, {}, e
+
+    def pop():
+        item, orgnr, future = pending.popleft()
+        in_flight[orgnr][1] -= 1
+        if in_flight[orgnr][1] == 0:
+            del in_flight[orgnr]
+        return result(item, future)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for item in items:
+            orgnr = key(item)
+            if orgnr not in in_flight:
+                future = executor.submit(barnehagefakta_get, orgnr, rate_limiter=rate_limiter, **kwargs)
+                in_flight[orgnr] = [future, 0]
+            in_flight[orgnr][1] += 1
+            pending.append((item, orgnr, in_flight[orgnr][0]))
+            if len(pending) >= window:
+                yield pop()
+
+        while len(pending) != 0:
+            yield pop()
+
 if __name__ == '__main__':
     from utility_to_osm import argparse_util
+    from barnehagefakta_store import get_store, get_journal_filename, ChangeJournal
     
     parser = argparse_util.get_parser('Helper script for requesting (with local cache) and parsing json data from "Utdanningdsdirektoratet Nasjonalt barnehageregister (NBR)"')
     parser.add_argument('orgnr', nargs='+', help='Unique NBR-id(s) to download (e.g. 1015988).')
     parser.add_argument('--cache_dir', default='data',
                         help='Specify directory for cached .json files, defaults to data/')
+    parser.add_argument('--concurrency', default=1, type=int,
+                        help='Number of concurrent requests, defaults to 1')
+    parser.add_argument('--cache_db', default=None,
+                        help='Use a single sqlite file as cache instead of .json files in --cache_dir (see barnehagefakta_store.py)')
     argparse_util.add_verbosity(parser, default=logging.DEBUG)
     
     args = parser.parse_args()
 
     logging.basicConfig(level=args.loglevel)    
 
-    if args.orgnr:             # list of ids given
+    store = get_store(args.cache_db, journal=ChangeJournal(get_journal_filename(args.cache_dir)))
+    if args.orgnr and args.concurrency > 1:
+        for orgnr, _, e in barnehagefakta_get_many(args.orgnr, concurrency=args.concurrency,
+                                                   cache_dir=args.cache_dir, store=store):
+            print('Got', orgnr, e if e is not None else '')
+    elif args.orgnr:             # list of ids given
         for orgnr in args.orgnr:
             print('Getting', orgnr)
-            barnehagefakta_get(orgnr, cache_dir=args.cache_dir)
+            barnehagefakta_get(orgnr, cache_dir=args.cache_dir, store=store)
 
@@ -6,16 +6,24 @@ import re
 import os
 import codecs
 open = codecs.open
+import io
+import math
+import json
 import datetime
+from xml.sax.saxutils import escape
 import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 logger = logging.getLogger('barnehagefakta')
 # This project:
-from barnehagefakta_get import barnehagefakta_get, NotFoundException
+from barnehagefakta_get import barnehagefakta_get, barnehagefakta_get_ordered, NotFoundException
 from barnehageregister_nbrId import get_kommune, update_kommune
+from barnehagefakta_store import get_store, get_journal_filename, ChangeJournal
 from utility_to_osm.kommunenummer import kommunenummer, to_kommunenr
 #from email_verification import mailbox_check_valid_cached
 from utility_to_osm import file_util
 from name_cleanup import name_cleanup
+import profile_report
 from utility_to_osm import osmapis
 
 try:
@@ -226,80 +234,427 @@ def create_osmtags(udir_tags, operator='', udir_name='', cache_dir='data',
     logger.debug('%d, Created node %s', orgnr, node)
     return node, udir_tags['type']
 
-def main(lst, output_filename, cache_dir, osm=None, osm_familiebarnehage=None, discontinued=None, save=True,
-         global_cache_dir='data', name_cleanup_filehandle=None):
-    """if osm and osm_familiebarnehage are given, they will be appended to.
-    Ensure save is True to save the files (only needed on the last iteration)"""
-
-    base, ext = os.path.splitext(output_filename)
-    output_filename_familiebarnehager = base + '_familiebarnehager' + ext
-    output_filename_discontinued = base + '_discontinued' + '.csv'
+def get_orgnr(item):
+    """item can be either dictionary (from get_kommune) or simply the orgnr,
+    returns the tuple (orgnr, operator, name)"""
+    try:
+        return item['orgnr'], item['Eier'], item['name']
+    except TypeError:
+        return item, '', ''
+
+def convert(lst, cache_dir, discontinued, global_cache_dir='data', name_cleanup_filehandle=None, concurrency=1,
+            store=None):
+    """Yields the tuple (osmapis.Node, barnehage_type) for each kindergarten in lst,
+    kindergartens returning 404 are appended to discontinued (a list or a DiscontinuedWriter).
+    lst is consumed lazily, such that a generator (e.g. get_kommune) is never held in memory.
+    With concurrency > 1, the barnehagefakta data is fetched using barnehagefakta_get_ordered,
+    at most a small window of responses are fetched ahead of the node being created.
+    store is passed to barnehagefakta_get_json (defaults to the .json files in cache_dir)."""
+    visited_ids = set()
 
-    if osm is None:
-        osm = osmapis.OSM()
+    if concurrency > 1:
+        fetched = barnehagefakta_get_ordered(lst, concurrency=concurrency, key=lambda item: get_orgnr(item)[0],
+                                             cache_dir=cache_dir, store=store)
+    else:
+        fetched = ((item, None, None) for item in lst)
 
-    if osm_familiebarnehage is None:
-        osm_familiebarnehage = osmapis.OSM()
-
-    visited_ids = set()
-    if discontinued is None:
-        discontinued = list()
-    for item in lst:
-        operator = ''
-        name = ''
-        # item can be either dictionary or simply items
-        try:
-            orgnr = item['orgnr']
-            operator = item['Eier']
-            name = item['name']
-        except TypeError:
-            orgnr = item
+    for item, udir_tags, e in fetched:
+        orgnr, operator, name = get_orgnr(item)
 
         if orgnr in visited_ids:
             logger.warning('Already added %s', orgnr)
         visited_ids.add(orgnr)
 
         try:
-            udir_tags = barnehagefakta_get(orgnr, cache_dir=cache_dir)
+            if e is not None:
+                raise e
+            if udir_tags is None:
+                udir_tags = barnehagefakta_get(orgnr, cache_dir=cache_dir, store=store)
             if udir_tags == {}: continue
-            node, barnehage_type = create_osmtags(udir_tags, operator=operator, udir_name=name, cache_dir=global_cache_dir,
-                                                  name_cleanup_filehandle=name_cleanup_filehandle)
-
-            if barnehage_type == u'Familiebarnehage':
-                osm_familiebarnehage.add(node)
-            else:
-                osm.add(node)
+            with profile_report.timer('create_osmtags'):
+                node, barnehage_type = create_osmtags(udir_tags, operator=operator, udir_name=name, cache_dir=global_cache_dir,
+                                                      name_cleanup_filehandle=name_cleanup_filehandle)
         except NotFoundException as e:
             logger.info(('Kindergarten "{name}" https://nbr.udir.no/enhet/{id}'
                          ', returned 404 at http://barnehagefakta.no/api/barnehage/{id}. '
                          'The kindergarten is probably discontinued.').format(
                              name=name.encode('utf8'), id=orgnr))
             discontinued.append((name, operator, str(orgnr)))
+            continue
         except:
             logger.exception('Un-handled exception for orgnr = %s, skipping', orgnr)
             exit(1)
-            return osm, osm_familiebarnehage, discontinued
-
-    if save and len(osm) != 0:
-        osm.save(output_filename)
-    if save and len(osm_familiebarnehage) != 0:
-        osm_familiebarnehage.save(output_filename_familiebarnehager)
-    if save and len(discontinued) != 0:
-        with open(output_filename_discontinued, 'w', 'utf-8') as f:
-            f.write('# The following kindergartens exists in the https://nbr.udir.no/enhet/{id} directory, but gives 404 at http://barnehagefakta.no/api/barnehage/{id}, the following kindergartens are probably discontinued.\n')
-            header = ['name', 'operator', 'nbr id']
-            discontinued.insert(0, header)
-            for row in discontinued:
-                r = map(lambda x: '"' + str(x) + '"', row)
-                r = ', '.join(r) + '\n'
-                f.write(r)
-            # csv does not handle utf8
-            # print discontinued
-            # w = csv.writer(f)
-            # w.writerows(discontinued)
+            return
+
+        yield node, barnehage_type
+
+def xml_escape(value):
+    return escape(str(value), {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'})
+
+class OSMWriter(object):
+    """Writes each added node directly to filename as .osm xml, instead of keeping them in an osmapis.OSM.
+    The file is created on the first add (nothing is written if no nodes are added),
+    call flush to ensure the nodes so far are on disk and close to end the document.
+
+    >>> f = io.StringIO()
+    >>> writer = OSMWriter(None, fileobj=f)
+    >>> writer.add(osmapis.Node(attribs=dict(id=-1, lat=59.9, lon=10.7), tags={'name': 'A & "B"'}))
+    >>> writer.close()
+    >>> print(f.getvalue().strip())
+    <?xml version="1.0" encoding="UTF-8"?>
+    <osm version="0.6" generator="barnehagefakta_osm.py">
+      <node id="-1" lat="59.9" lon="10.7">
+        <tag k="name" v="A &amp; &quot;B&quot;"/>
+      </node>
+    </osm>
+    """
+
+    def __init__(self, filename, fileobj=None):
+        self.filename = filename
+        self.f = fileobj
+        self.started = False
+        self.closed = False
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    header = u'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="barnehagefakta_osm.py">\n'
+    footer = u'</osm>\n'
+
+    def format_node(self, node):
+        attribs = dict(node.attribs)
+        lines = [u'  <node id="%s"' % xml_escape(attribs.pop('id'))]
+        for key, value in attribs.items():
+            lines.append(u' %s="%s"' % (key, xml_escape(value)))
+        lines.append(u'>\n')
+        for key in sorted(node.tags):
+            lines.append(u'    <tag k="%s" v="%s"/>\n' % (xml_escape(key), xml_escape(node.tags[key])))
+        lines.append(u'  </node>\n')
+        return u''.join(lines)
+
+    def add(self, node):
+        assert not(self.closed), 'add called after close'
+        if not(self.started):
+            if self.f is None:
+                self.f = open(file_util.create_dirname(self.filename), 'w', 'utf-8')
+            self.f.write(self.header)
+            self.started = True
+
+        with profile_report.timer('xml_serialize'):
+            self.f.write(self.format_node(node))
+        self.count += 1
+
+    def flush(self):
+        if self.started:
+            self.f.flush()
+
+    def close(self):
+        if self.started and not(self.closed):
+            self.f.write(self.footer)
+            if self.filename is not None:
+                self.f.close()
+            else:
+                self.f.flush()
+        self.closed = True
+
+def node_to_feature(node):
+    """Returns the geojson Feature for the given osmapis.Node,
+    in the same (non-flat) form as osmtogeojson.
+
+    >>> feature = node_to_feature(osmapis.Node(attribs=dict(id=-1, lat=59.9, lon=10.7), tags={'name': 'A'}))
+    >>> feature['id'], feature['geometry'], feature['properties']['tags']
+    ('node/-1', {'type': 'Point', 'coordinates': [10.7, 59.9]}, {'name': 'A'})
+    """
+    node_id = int(node.attribs['id'])
+    return {'type': 'Feature',
+            'id': 'node/%d' % node_id,
+            'properties': {'type': 'node', 'id': node_id, 'tags': dict(node.tags),
+                           'relations': [], 'meta': {}},
+            'geometry': {'type': 'Point',
+                         'coordinates': [float(node.attribs['lon']), float(node.attribs['lat'])]}}
+
+class GeoJSONWriter(OSMWriter):
+    """As OSMWriter, but writes a geojson FeatureCollection (see node_to_feature)
+
+    >>> f = io.StringIO()
+    >>> writer = GeoJSONWriter(None, fileobj=f)
+    >>> for i in (1, 2): writer.add(osmapis.Node(attribs=dict(id=-i, lat=59.9, lon=10.7)))
+    >>> writer.close()
+    >>> [feature['id'] for feature in json.loads(f.getvalue())['features']]
+    ['node/-1', 'node/-2']
+    """
+    header = u'{"type": "FeatureCollection", "features": [\n'
+    footer = u'\n]}\n'
+
+    def format_node(self, node):
+        separator = u',\n' if self.count != 0 else u''
+        return separator + json.dumps(node_to_feature(node), ensure_ascii=False)
+
+def get_writer(filename):
+    """Returns a GeoJSONWriter for .json and .geojson filenames, otherwise an OSMWriter"""
+    if os.path.splitext(filename)[1].lower() in ('.json', '.geojson'):
+        return GeoJSONWriter(filename)
+    return OSMWriter(filename)
+
+def tile_xy(lat, lon, zoom):
+    """Returns the slippy map tile (x, y) containing lat, lon at the given zoom
+
+    >>> tile_xy(59.9, 10.7, 12)
+    (2169, 1191)
+    """
+    n = 2**zoom
+    lat_rad = math.radians(lat)
+    x = int((lon + 180.)/360.*n)
+    y = int((1. - math.log(math.tan(lat_rad) + 1./math.cos(lat_rad))/math.pi)/2.*n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+class TiledGeoJSONWriter(object):
+    """Writes the added nodes per slippy map tile at the given zoom, each tile as
+    a geojson FeatureCollection in tile_dir/data/{x}/{y}.json, the layout read by POI-Importer
+    (replaces osmtogeojson followed by tile_geojson.js).
+    Each feature is appended to its tile file as it is added, only the number of features per tile
+    is kept in memory, close ends each document.
+    Every node is also passed on to writer, if given.
+    """
+
+    def __init__(self, tile_dir, zoom=12, writer=None):
+        self.tile_dir = tile_dir
+        self.zoom = zoom
+        self.writer = writer
+        self.tiles = dict()     # (x, y) -> number of features written
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def tile_filename(self, x, y):
+        return os.path.join(self.tile_dir, 'data', str(x), '%d.json' % y)
+
+    def add(self, node):
+        tile = tile_xy(float(node.attribs['lat']), float(node.attribs['lon']), self.zoom)
+        tile_count = self.tiles.get(tile, 0)
+        if tile_count == 0:
+            f = open(file_util.create_dirname(self.tile_filename(*tile)), 'w', 'utf-8')
+            f.write(GeoJSONWriter.header)
+        else:
+            f = open(self.tile_filename(*tile), 'a', 'utf-8')
+            f.write(u',\n')
+        with f:
+            f.write(json.dumps(node_to_feature(node), ensure_ascii=False))
+        self.tiles[tile] = tile_count + 1
+        self.count += 1
+        if self.writer is not None:
+            self.writer.add(node)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        for x, y in sorted(self.tiles):
+            with open(self.tile_filename(x, y), 'a', 'utf-8') as f:
+                f.write(GeoJSONWriter.footer)
+        logger.info('Wrote %d nodes to %d tiles in %s', self.count, len(self.tiles), self.tile_dir)
+        self.tiles = dict()
+        if self.writer is not None:
+            self.writer.close()
+
+class DiscontinuedWriter(object):
+    """Writes each discontinued (name, operator, nbr id) row directly to the .csv filename,
+    can be passed as discontinued to convert and main instead of a list.
+    As for OSMWriter, the file is created on the first append.
+
+    >>> f = io.StringIO()
+    >>> writer = DiscontinuedWriter(None, fileobj=f)
+    >>> writer.append(('Foo barnehage', 'Foo AS', '42'))
+    >>> writer.close()
+    >>> for line in f.getvalue().splitlines()[1:]: print(line)
+    "name", "operator", "nbr id"
+    "Foo barnehage", "Foo AS", "42"
+    """
+    comment = '# The following kindergartens exists in the https://nbr.udir.no/enhet/{id} directory, but gives 404 at http://barnehagefakta.no/api/barnehage/{id}, the following kindergartens are probably discontinued.\n'
+    header = ['name', 'operator', 'nbr id']
+
+    def __init__(self, filename, fileobj=None):
+        self.filename = filename
+        self.f = fileobj
+        self.started = False
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def format_row(self, row):
+        r = map(lambda x: '"' + str(x) + '"', row)
+        return ', '.join(r) + '\n'
+
+    def append(self, row):
+        if not(self.started):
+            if self.f is None:
+                self.f = open(file_util.create_dirname(self.filename), 'w', 'utf-8')
+            self.f.write(self.comment)
+            self.f.write(self.format_row(self.header))
+            self.started = True
+        self.f.write(self.format_row(row))
+        self.count += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def close(self):
+        if self.started and self.filename is not None:
+            self.f.close()
+        elif self.started:
+            self.f.flush()
+
+def main(lst, output_filename, cache_dir, osm=None, osm_familiebarnehage=None, discontinued=None, save=True,
+         global_cache_dir='data', name_cleanup_filehandle=None, concurrency=1, converted=None,
+         store=None):
+    """if osm and osm_familiebarnehage are given, they will be appended to.
+    Ensure save is True to save the files (only needed on the last iteration).
+    If osm and osm_familiebarnehage are OSMWriter (or GeoJSONWriter/TiledGeoJSONWriter) objects
+    and discontinued a DiscontinuedWriter, the nodes are written as they are converted
+    and save closes the writers, such that memory does not grow with the number of kindergartens (see pipeline).
+    Optionally pass the already converted (osmapis.Node, barnehage_type) tuples as converted,
+    lst is then ignored, see convert."""
+
+    base, ext = os.path.splitext(output_filename)
+    output_filename_familiebarnehager = base + '_familiebarnehager' + ext
+    output_filename_discontinued = base + '_discontinued' + '.csv'
+
+    if osm is None:
+        osm = osmapis.OSM()
+
+    if osm_familiebarnehage is None:
+        osm_familiebarnehage = osmapis.OSM()
+
+    if discontinued is None:
+        discontinued = list()
+
+    if converted is None:
+        converted = convert(lst, cache_dir, discontinued, global_cache_dir=global_cache_dir,
+                            name_cleanup_filehandle=name_cleanup_filehandle,
+                            concurrency=concurrency, store=store)
+
+    for node, barnehage_type in converted:
+        if barnehage_type == u'Familiebarnehage':
+            osm_familiebarnehage.add(node)
+        else:
+            osm.add(node)
+
+    if isinstance(osm, (OSMWriter, TiledGeoJSONWriter)): # already written, keep the progress on disk
+        for writer in (osm, osm_familiebarnehage):
+            writer.flush()
+            if save:
+                writer.close()
+    else:
+        with profile_report.timer('xml_serialize'):
+            if save and len(osm) != 0:
+                osm.save(output_filename)
+            if save and len(osm_familiebarnehage) != 0:
+                osm_familiebarnehage.save(output_filename_familiebarnehager)
+    if isinstance(discontinued, DiscontinuedWriter):
+        if save:
+            discontinued.close()
+    elif save and len(discontinued) != 0:
+        # csv does not handle utf8
+        writer = DiscontinuedWriter(output_filename_discontinued)
+        writer.extend(discontinued)
+        writer.close()
 
     return osm, osm_familiebarnehage, discontinued
 
+def pipeline(rows, output_filename, cache_dir, global_cache_dir='data', name_cleanup_filehandle=None,
+             concurrency=1, store=None, converted=None, converted_discontinued=()):
+    """Converts the register rows (e.g. the generator from get_kommune) to output_filename,
+    output_filename_familiebarnehager and output_filename_discontinued (see main) with bounded memory:
+    each stage, rows -> barnehagefakta_get -> create_osmtags -> OSMWriter/GeoJSONWriter and DiscontinuedWriter,
+    pulls one item at a time from the previous one, only the fetch window (see convert) is held in memory.
+    Optionally pass the already converted nodes as converted (see main) and
+    their discontinued rows as converted_discontinued, rows is then ignored.
+    Returns the tuple (number of kindergartens, number of familiebarnehager, number of discontinued)"""
+    base, ext = os.path.splitext(output_filename)
+    osm = get_writer(output_filename)
+    osm_familiebarnehage = get_writer(base + '_familiebarnehager' + ext)
+    discontinued = DiscontinuedWriter(base + '_discontinued' + '.csv')
+    discontinued.extend(converted_discontinued)
+    main(rows, output_filename, cache_dir, osm, osm_familiebarnehage, discontinued=discontinued, save=True,
+         global_cache_dir=global_cache_dir, name_cleanup_filehandle=name_cleanup_filehandle,
+         concurrency=concurrency, converted=converted, store=store)
+    return len(osm), len(osm_familiebarnehage), len(discontinued)
+
+formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+def add_file_handler(filename='warnings.log'):
+    fh = logging.FileHandler(filename, mode='w')
+    fh.setLevel(logging.WARNING)
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
+    return fh
+
+def convert_kommune(kommune_id, global_cache_dir='data', update=False, concurrency=1, store=None):
+    """Process pool worker for --jobs, does update_kommune (if update is True), get_kommune and convert
+    for a single kommune, warnings are logged to <global_cache_dir>/<kommune_id>/warnings.log.
+    Returns the tuple (kommune_id, nodes, discontinued, name_log) where nodes is a list of
+    (attribs, tags, barnehage_type) and name_log is the name_cleanup log as a string.
+    Nodes are re-created by the caller, such that the node ids are assigned in the same order as a serial run."""
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.FileHandler): # inherited from the parent process
+            logger.removeHandler(handler)
+    cache_dir = os.path.join(global_cache_dir, kommune_id) # work inside kommune folder
+    warn_filename = os.path.join(cache_dir, 'warnings.log')
+    fh = add_file_handler(file_util.create_dirname(warn_filename))
+
+    try:
+        if update:
+            update_kommune(kommune_id, cache_dir=global_cache_dir, concurrency=concurrency)
+        k = get_kommune(kommune_id, cache_dir=global_cache_dir)
+
+        name_log = io.StringIO()
+        discontinued = list()
+        nodes = list()
+        for node, barnehage_type in convert(k, cache_dir, discontinued, global_cache_dir=global_cache_dir,
+                                            name_cleanup_filehandle=name_log,
+                                            concurrency=concurrency, store=store):
+            attribs = dict(node.attribs)
+            attribs.pop('id', None)
+            nodes.append((attribs, dict(node.tags), barnehage_type))
+    finally:
+        logger.removeHandler(fh)
+        fh.close()
+
+    return kommune_id, nodes, discontinued, name_log.getvalue()
+
+def convert_kommuner(kommunenummer, global_cache_dir='data', update=False, concurrency=1, jobs=2, store=None,
+                     ordered=True, window=None):
+    """Runs convert_kommune for each kommune in a pool of jobs processes,
+    yields the results in the same order as kommunenummer, or as they are completed if ordered is False.
+    At most window (defaults to 2*jobs) kommuner are submitted but not yet yielded,
+    and a result is not kept once it has been yielded."""
+    if window is None:
+        window = 2*jobs
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for kommune_id in kommunenummer:
+            pending.append(executor.submit(convert_kommune, kommune_id, global_cache_dir=global_cache_dir,
+                                           update=update, concurrency=concurrency, store=store))
+            while len(pending) >= window:
+                yield take_result(pending, ordered)
+
+        while len(pending) != 0:
+            yield take_result(pending, ordered)
+
+def take_result(pending, ordered):
+    """Removes and returns the result of the first future in pending if ordered,
+    otherwise of the first one to complete"""
+    if ordered:
+        future = pending.popleft()
+    else:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        future = next(f for f in pending if f in done)
+        pending.remove(future)
+    return future.result()
 
 if __name__ == '__main__':
     from utility_to_osm import argparse_util
@@ -316,23 +671,31 @@ Specify either by --orgnr or by --kommune.''',
                         help='Specify output filename, defaults to "barnehagefakta.osm", for kommuner it will default to cache_dir/<nr>/barnehagefakta.osm')
     parser.add_argument('--cache_dir', default='data',
                         help='Specify directory for cached .json files, defaults to data/')
+    parser.add_argument('--concurrency', default=1, type=int,
+                        help='Number of concurrent requests to barnehagefakta.no (and nbr.udir.no with --update_kommune), defaults to 1')
+    parser.add_argument('--jobs', default=1, type=int,
+                        help='Number of kommuner to process in parallel (separate processes) when using --kommune, defaults to 1')
+    parser.add_argument('--cache_db', default=None,
+                        help='Use a single sqlite file as cache instead of .json files in --cache_dir (see barnehagefakta_store.py)')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='With --kommune, write each node to the output file(s) as it is converted instead of keeping all kindergartens in memory (see pipeline). An --output_filename ending in .json or .geojson gives geojson instead of .osm')
+    parser.add_argument('--tile_dir', default=None,
+                        help='With --kommune, also write the (non-familiebarnehage) nodes as geojson tiles in tile_dir/data/{x}/{y}.json for POI-Importer, implies --stream')
+    parser.add_argument('--tile_zoom', default=12, type=int,
+                        help='Zoom level of the --tile_dir tiles, defaults to 12')
     argparse_util.add_verbosity(parser, default=logging.DEBUG)
 
+    profile_report.add_argument(parser)
     args = parser.parse_args()
+    profile_report.enable(args.profile_report, 'barnehagefakta_osm.py')
+    store = get_store(args.cache_db, journal=ChangeJournal(get_journal_filename(args.cache_dir)))
 
     logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
     ch = logging.StreamHandler()
     ch.setLevel(args.loglevel)
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
-    def add_file_handler(filename='warnings.log'):
-        fh = logging.FileHandler(filename, mode='w')
-        fh.setLevel(logging.WARNING)
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
-        return fh
     fh = add_file_handler()
 
     output_filename = args.output_filename
@@ -349,32 +712,81 @@ Specify either by --orgnr or by --kommune.''',
         else:
             kommunenummer = list(map(to_kommunenr, args.kommune))
 
-        for kommune_id in kommunenummer:
+        if args.tile_dir and args.output_filename is None:
+            parser.error('--tile_dir requires --output_filename')
+        if (args.stream or args.tile_dir) and args.output_filename is not None:
+            base, ext = os.path.splitext(args.output_filename)
+            osm = get_writer(args.output_filename)
+            osm_f = get_writer(base + '_familiebarnehager' + ext)
+            discontinued = DiscontinuedWriter(base + '_discontinued' + '.csv')
+        if args.tile_dir:
+            osm = TiledGeoJSONWriter(args.tile_dir, zoom=args.tile_zoom, writer=osm)
+
+        if args.jobs > 1:
+            # With a file per kommune the order does not matter, take each kommune as soon as it is done.
+            results = convert_kommuner(kommunenummer, global_cache_dir=args.cache_dir,
+                                       update=args.update_kommune, concurrency=args.concurrency,
+                                       jobs=args.jobs, store=store, ordered=args.output_filename is not None)
+        else:
+            results = [(kommune_id, None, None, None) for kommune_id in kommunenummer]
+
+        for kommune_id, nodes, kommune_discontinued, name_log in results:
             cache_dir = os.path.join(args.cache_dir, kommune_id) # work inside kommune folder
+            if nodes is not None:
+                # Already converted by a worker process, create the nodes and save.
+                name_cleanup_filehandle.write(name_log)
+                converted = ((osmapis.Node(attribs=attribs, tags=tags), barnehage_type)
+                             for attribs, tags, barnehage_type in nodes)
+                if args.output_filename is None:
+                    output_filename = os.path.join(cache_dir, '%s_barnehagefakta.osm' % kommune_id)
+                    if args.stream:
+                        pipeline(None, output_filename, cache_dir, converted=converted,
+                                 converted_discontinued=kommune_discontinued)
+                    else:
+                        main(None, output_filename, cache_dir, discontinued=kommune_discontinued,
+                             converted=converted)
+                else:
+                    if discontinued is None:
+                        discontinued = list()
+                    discontinued.extend(kommune_discontinued)
+                    osm, osm_f, discontinued = main(None, output_filename, cache_dir, osm, osm_f,
+                                                    discontinued=discontinued,
+                                                    save=kommune_id == kommunenummer[-1],
+                                                    converted=converted)
+                continue
+
             logger.removeHandler(fh)
             warn_filename = os.path.join(cache_dir, 'warnings.log')
             fh = add_file_handler(file_util.create_dirname(warn_filename))
 
             if args.update_kommune:
-                update_kommune(kommune_id, cache_dir=args.cache_dir)
+                update_kommune(kommune_id, cache_dir=args.cache_dir, concurrency=args.concurrency)
 
             k = get_kommune(kommune_id, cache_dir=args.cache_dir)
 
             if args.output_filename is None:
                 output_filename = os.path.join(cache_dir, '%s_barnehagefakta.osm' % kommune_id)
-                main(k, output_filename, cache_dir, global_cache_dir=args.cache_dir,
-                     name_cleanup_filehandle=name_cleanup_filehandle)
+                if args.stream:
+                    pipeline(k, output_filename, cache_dir, global_cache_dir=args.cache_dir,
+                             name_cleanup_filehandle=name_cleanup_filehandle,
+                             concurrency=args.concurrency, store=store)
+                else:
+                    main(k, output_filename, cache_dir, global_cache_dir=args.cache_dir,
+                         name_cleanup_filehandle=name_cleanup_filehandle,
+                         concurrency=args.concurrency, store=store)
             else:
                 osm, osm_f, discontinued = main(k, output_filename, cache_dir, osm, osm_f,
                                                 discontinued=discontinued,
                                                 save=kommune_id == kommunenummer[-1],
                                                 name_cleanup_filehandle=name_cleanup_filehandle,
-                                                global_cache_dir=args.cache_dir)
+                                                global_cache_dir=args.cache_dir,
+                                                concurrency=args.concurrency, store=store)
 
     if args.orgnr:
         if args.output_filename is None:
             output_filename = 'barnehagefakta.osm'
         main(args.orgnr, output_filename, args.cache_dir, global_cache_dir=args.cache_dir,
-             name_cleanup_filehandle=name_cleanup_filehandle)
+             name_cleanup_filehandle=name_cleanup_filehandle,
+             concurrency=args.concurrency, store=store)
 
     name_cleanup_filehandle.close()
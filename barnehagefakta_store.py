@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# -*- coding: utf8
+
+"""Cache backends for the barnehagefakta.no json responses used by barnehagefakta_get_json.
+FileStore is the original layout with one file per kindergarten (per kommune folder),
+SQLiteStore keeps the current responses and the archived (OUTDATED) versions in a single sqlite file.
+Run this file to migrate an existing data directory into a SQLiteStore."""
+# Standard python imports
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+import logging
+logger = logging.getLogger('barnehagefakta.store')
+# This project
+from utility_to_osm import file_util
+
+reg_filename = re.compile(r'barnehagefakta_no_orgnr(\d+)(-(\d+-\d+-\d+)-OUTDATED)?\.json$')
+
+def content_hash(content):
+    if not(isinstance(content, bytes)):
+        content = content.encode('utf8')
+    return hashlib.sha1(content).hexdigest()
+
+def is_cached(filename, old_age_days):
+    """Returns True if filename exists and is younger than old_age_days, such that get_cached will not do a request"""
+    try:
+        age = time.time() - os.path.getmtime(filename)
+    except OSError:
+        return False
+    return age < old_age_days*24*60*60
+
+def get_journal_filename(cache_dir):
+    return os.path.join(cache_dir, 'change_journal.json')
+
+class ChangeJournal(object):
+    """Append-only log of changed responses, one json object per line with the keys
+    orgnr, kommune, old_hash, new_hash, detected, outdated and updated
+    (the last two are references to the archived and current response in the store).
+    Written by barnehagefakta_get_json whenever a response is archived (if the store has a journal),
+    consumed by update_osm.py which keeps its position and the unresolved records in filename.checkpoint"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.checkpoint_filename = filename + '.checkpoint'
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def append(self, orgnr, cache_dir, old_content, new_content, outdated, updated):
+        record = dict(orgnr=str(orgnr),
+                      kommune=os.path.basename(os.path.normpath(cache_dir)),
+                      old_hash=content_hash(old_content),
+                      new_hash=content_hash(new_content),
+                      detected=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                      outdated=outdated,
+                      updated=updated)
+        line = (json.dumps(record) + '\n').encode('utf8')
+        # the lock serializes the threads, between processes each record is a single write() in append mode
+        with self.lock:
+            fd = os.open(file_util.create_dirname(self.filename), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def read(self, offset=0):
+        """Yields the tuple (record, offset) for each record after the given byte offset,
+        where offset is the position after the record"""
+        if not(os.path.exists(self.filename)):
+            return
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            for line in iter(f.readline, b''):
+                if not(line.endswith(b'\n')): # partially written, leave it for next time
+                    break
+                offset += len(line)
+                yield self.from_json(line.decode('utf8')), offset
+
+    def from_json(self, line):
+        record = json.loads(line)
+        for key in ('outdated', 'updated'):
+            if isinstance(record[key], list): # json has no tuples
+                record[key] = tuple(record[key])
+        return record
+
+    def pending(self, scan=None):
+        """Returns the tuple (records, offset), the unresolved records from the checkpoint
+        followed by all records written since the checkpoint, and the new offset.
+        Without a checkpoint, the records start with scan (e.g. store.find_outdated(root), tuples of
+        (outdated, updated, orgnr)), as changes from before the journal existed are not in it."""
+        offset, records = 0, list()
+        if os.path.exists(self.checkpoint_filename):
+            with open(self.checkpoint_filename, 'r') as f:
+                checkpoint = json.load(f)
+            offset = checkpoint['offset']
+            records = [self.from_json(json.dumps(record)) for record in checkpoint['pending']]
+        elif scan is not None:
+            records = [dict(orgnr=str(orgnr), outdated=outdated, updated=updated)
+                       for outdated, updated, orgnr in scan]
+
+        seen = set(record['outdated'] for record in records)
+        for record, offset in self.read(offset):
+            if record['outdated'] not in seen:
+                seen.add(record['outdated'])
+                records.append(record)
+        return records, offset
+
+    def save_checkpoint(self, offset, pending):
+        """Marks everything up to offset as consumed, except the list of pending records"""
+        with open(self.checkpoint_filename, 'w') as f:
+            json.dump(dict(offset=offset, pending=pending), f)
+
+class FileStore(object):
+    """The original cache layout, the response for orgnr is stored as
+    cache_dir/barnehagefakta_no_orgnr{orgnr}.json, archived responses as
+    cache_dir/barnehagefakta_no_orgnr{orgnr}-{%Y-%m-%d}-OUTDATED.json and the
+    ETag/Last-Modified response headers as cache_dir/barnehagefakta_no_orgnr{orgnr}.json.meta.
+    References (see find_outdated, read and remove) are filenames.
+    Optionally give a ChangeJournal, see barnehagefakta_get_json."""
+
+    def __init__(self, journal=None):
+        self.journal = journal
+
+    def ref(self, orgnr, cache_dir):
+        """Returns the reference to the current response"""
+        return self.filename(orgnr, cache_dir)
+
+    def filename(self, orgnr, cache_dir):
+        return os.path.join(cache_dir, 'barnehagefakta_no_orgnr{0}.json'.format(orgnr))
+
+    def load(self, orgnr, cache_dir, old_age_days):
+        """Returns the tuple (content, outdated), content is None if nothing is cached"""
+        return file_util.cached_file(self.filename(orgnr, cache_dir), old_age_days)
+
+    def touch(self, orgnr, cache_dir):
+        """Marks the cached response as fresh"""
+        os.utime(self.filename(orgnr, cache_dir), None)
+
+    def load_validators(self, orgnr, cache_dir):
+        """Returns the dictionary of stored ETag/Last-Modified headers (may be empty)"""
+        try:
+            with open(self.filename(orgnr, cache_dir) + '.meta', 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, orgnr, cache_dir, content, validators=None):
+        filename = self.filename(orgnr, cache_dir)
+        file_util.write_file(filename, content)
+
+        meta_filename = filename + '.meta'
+        if validators:
+            with open(meta_filename, 'w') as f:
+                json.dump(validators, f)
+        elif os.path.exists(meta_filename):
+            os.remove(meta_filename)
+
+    def archive(self, orgnr, cache_dir, date):
+        """Moves the current response to the archive, returns the reference to the archived response"""
+        filename = self.filename(orgnr, cache_dir)
+        suffix = date.strftime("-%Y-%m-%d-OUTDATED")
+        file_util.rename_file(filename, suffix) # move old one
+        base, ext = os.path.splitext(filename)
+        return base + suffix + ext
+
+    def find_outdated(self, root):
+        """Yields all {nbr_id}-%Y-%m-%d-OUTDATED.json files below directory 'root'.
+        the tuple (filename_outdated, filename_updated, nbr_id) is yielded
+        """
+        for root, dirs, files in os.walk(root):
+            for f in files:
+                if f.endswith('OUTDATED.json'):
+                    try:
+                        reg = re.search(r'orgnr(\d+)-(\d+-\d+-\d+)-OUTDATED.json', f)
+                        nbr_id = reg.group(1)
+                        date = datetime.strptime(reg.group(2), '%Y-%m-%d')
+                        filename_updated = f.replace('-'+reg.group(2)+'-OUTDATED', '') # hack
+                        filename_updated = os.path.join(root, filename_updated)
+                    except Exception as e:
+                        raise ValueError('Invalid OUTDATED.json filename detected, "%s/%s", %s' % (root, f, e))
+
+                    filename_outdated = os.path.join(root, f)
+                    yield filename_outdated, filename_updated, nbr_id
+
+    def read(self, ref):
+        with open(ref) as f:
+            return f.read()
+
+    def remove(self, ref):
+        os.remove(ref)
+
+class SQLiteStore(object):
+    """All responses in a single sqlite file, the table 'response' holds the current response per orgnr
+    and 'history' the archived responses. The kommune column is the name of the cache_dir folder.
+    Unlike the FileStore, the key is the orgnr alone: cache_dir is only recorded, so the same orgnr
+    cached below two kommune folders (e.g. a kindergarten moving kommune) shares a single current response.
+    References (see find_outdated, read and remove) are tuples ('response', orgnr) or ('history', id).
+    Each thread (and process) uses its own connection.
+    Optionally give a ChangeJournal, see barnehagefakta_get_json."""
+
+    schema = '''
+    CREATE TABLE IF NOT EXISTS response (orgnr TEXT PRIMARY KEY, kommune TEXT, content TEXT,
+                                         fetched REAL, validators TEXT);
+    CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, orgnr TEXT, kommune TEXT,
+                                        content TEXT, fetched REAL, archived TEXT);
+    CREATE INDEX IF NOT EXISTS history_orgnr ON history (orgnr);
+    '''
+
+    def __init__(self, filename, journal=None):
+        self.filename = filename
+        self.journal = journal
+        self.local = threading.local()
+
+    def __getstate__(self):     # for multiprocessing, connections are not shared
+        return {'filename': self.filename, 'journal': self.journal}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'], state['journal'])
+
+    def ref(self, orgnr, cache_dir):
+        """Returns the reference to the current response"""
+        return 'response', str(orgnr)
+
+    @property
+    def connection(self):
+        if not(hasattr(self.local, 'connection')):
+            file_util.create_dirname(self.filename)
+            connection = sqlite3.connect(self.filename, timeout=60)
+            connection.executescript(self.schema)
+            self.local.connection = connection
+        return self.local.connection
+
+    def kommune(self, cache_dir):
+        return os.path.basename(os.path.normpath(cache_dir))
+
+    def load(self, orgnr, cache_dir, old_age_days):
+        row = self.connection.execute('SELECT content, fetched FROM response WHERE orgnr = ?',
+                                      (str(orgnr), )).fetchone()
+        if row is None:
+            return None, True
+        content, fetched = row
+        outdated = time.time() - fetched > old_age_days*24*60*60
+        return content, outdated
+
+    def touch(self, orgnr, cache_dir):
+        with self.connection as c:
+            c.execute('UPDATE response SET fetched = ? WHERE orgnr = ?', (time.time(), str(orgnr)))
+
+    def load_validators(self, orgnr, cache_dir):
+        row = self.connection.execute('SELECT validators FROM response WHERE orgnr = ?',
+                                      (str(orgnr), )).fetchone()
+        if row is None or row[0] is None:
+            return {}
+        return json.loads(row[0])
+
+    def save(self, orgnr, cache_dir, content, validators=None, fetched=None):
+        if isinstance(content, bytes):
+            content = content.decode('utf8')
+        if fetched is None:
+            fetched = time.time()
+        if validators:
+            validators = json.dumps(validators)
+        else:
+            validators = None
+        with self.connection as c:
+            c.execute('INSERT OR REPLACE INTO response (orgnr, kommune, content, fetched, validators) '
+                      'VALUES (?, ?, ?, ?, ?)',
+                      (str(orgnr), self.kommune(cache_dir), content, fetched, validators))
+
+    def archive(self, orgnr, cache_dir, date):
+        with self.connection as c:
+            cursor = c.execute('INSERT INTO history (orgnr, kommune, content, fetched, archived) '
+                               'SELECT orgnr, kommune, content, fetched, ? FROM response WHERE orgnr = ?',
+                               (date.strftime('%Y-%m-%d'), str(orgnr)))
+            return 'history', cursor.lastrowid
+
+    def add_history(self, orgnr, cache_dir, content, date, fetched=None):
+        """Adds an archived response directly, used when migrating from a FileStore"""
+        if isinstance(content, bytes):
+            content = content.decode('utf8')
+        with self.connection as c:
+            cursor = c.execute('INSERT INTO history (orgnr, kommune, content, fetched, archived) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (str(orgnr), self.kommune(cache_dir), content, fetched, date.strftime('%Y-%m-%d')))
+            return 'history', cursor.lastrowid
+
+    def find_outdated(self, root=None):
+        """Yields the tuple (ref_outdated, ref_updated, nbr_id) for each archived response,
+        oldest first, root is ignored"""
+        rows = self.connection.execute('SELECT id, orgnr FROM history ORDER BY id').fetchall()
+        for history_id, orgnr in rows:
+            yield ('history', history_id), ('response', orgnr), orgnr
+
+    def read(self, ref):
+        table, key = ref
+        if table == 'history':
+            row = self.connection.execute('SELECT content FROM history WHERE id = ?', (key, )).fetchone()
+        elif table == 'response':
+            row = self.connection.execute('SELECT content FROM response WHERE orgnr = ?', (key, )).fetchone()
+        else:
+            raise ValueError('Invalid reference %s' % (ref, ))
+        if row is None:
+            raise KeyError('%s not found in %s' % (ref, self.filename))
+        return row[0]
+
+    def remove(self, ref):
+        table, key = ref
+        with self.connection as c:
+            if table == 'history':
+                c.execute('DELETE FROM history WHERE id = ?', (key, ))
+            elif table == 'response':
+                c.execute('DELETE FROM response WHERE orgnr = ?', (key, ))
+            else:
+                raise ValueError('Invalid reference %s' % (ref, ))
+
+def get_store(cache_db=None, journal=None):
+    """Returns a SQLiteStore if the filename cache_db is given, otherwise the FileStore"""
+    if cache_db is None:
+        return FileStore(journal=journal)
+    return SQLiteStore(cache_db, journal=journal)
+
+def migrate(cache_dir, store, remove=False):
+    """Imports all barnehagefakta_no_orgnr*.json (and -OUTDATED.json) files below cache_dir into store,
+    optionally removing the files. Returns the number of files imported."""
+    file_store = FileStore()
+    count = 0
+    for root, dirs, files in os.walk(cache_dir):
+        for f in sorted(files):     # sorted, such that the archived versions are added oldest first
+            reg = reg_filename.match(f)
+            if reg is None:
+                continue
+            filename = os.path.join(root, f)
+            orgnr = reg.group(1)
+            content = file_store.read(filename)
+            fetched = os.path.getmtime(filename)
+            if reg.group(3) is None:
+                validators = file_store.load_validators(orgnr, root)
+                store.save(orgnr, root, content, validators, fetched=fetched)
+            else:
+                date = datetime.strptime(reg.group(3), '%Y-%m-%d')
+                store.add_history(orgnr, root, content, date, fetched=fetched)
+            count += 1
+
+            if remove:
+                os.remove(filename)
+                if os.path.exists(filename + '.meta'):
+                    os.remove(filename + '.meta')
+    return count
+
+if __name__ == '__main__':
+    from utility_to_osm import argparse_util
+
+    parser = argparse_util.get_parser('Migrates the barnehagefakta_no_orgnr*.json files below --cache_dir into a single sqlite file, use the result with --cache_db.')
+    parser.add_argument('--cache_dir', default='data',
+                        help='Specify directory for cached .json files, defaults to data/')
+    parser.add_argument('--cache_db', default=os.path.join('data', 'barnehagefakta.sqlite'),
+                        help='Specify the sqlite file, defaults to data/barnehagefakta.sqlite')
+    parser.add_argument('--remove', default=False, action='store_true',
+                        help='Remove the .json files after they have been imported')
+    argparse_util.add_verbosity(parser, default=logging.INFO)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    count = migrate(args.cache_dir, SQLiteStore(args.cache_db), remove=args.remove)
+    logger.info('Imported %d files into %s', count, args.cache_db)
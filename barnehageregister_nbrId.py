@@ -6,6 +6,8 @@
 import os
 import re
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
 logger = logging.getLogger('barnehagefakta.barnehageregister_nbrId')
 # non-standard imports
@@ -14,19 +16,40 @@ from bs4 import BeautifulSoup
 from utility_to_osm import file_util
 from utility_to_osm import gentle_requests
 request_session = gentle_requests.GentleRequests()
+from barnehagefakta_get import RateLimiter, get_session
+from barnehagefakta_store import is_cached
+import profile_report
+
+# e.g. http://localhost:8000 for standin_server.py
+nbr_url = os.environ.get('NBR_URL', 'https://nbr.udir.no')
+max_pages = 1024                # Oslo currently has 832
 
 try:
     basestring
 except NameError:               # python3
     basestring = str
 
-def get(kommune_id, page_nr=1, old_age_days=30, cache_dir='data'):
-    url = 'https://nbr.udir.no/api/sok/sok?fritekstSoek=&inkluderAktive=true&inkluderAndreTyperEnheter=false&inkluderEiere=false&inkluderEnheter=true&inkluderNedlagte=false'
+def get(kommune_id, page_nr=1, old_age_days=30, cache_dir='data', rate_limiter=None):
+    """Returns the content of the given search page, cached in cache_dir/kommune_id/.
+    If a RateLimiter is given, it is waited on before any actual request, worker threads
+    get their own session."""
+    url = nbr_url + '/api/sok/sok?fritekstSoek=&inkluderAktive=true&inkluderAndreTyperEnheter=false&inkluderEiere=false&inkluderEnheter=true&inkluderNedlagte=false'
     url += '&kommunenr={0:s}'.format(kommune_id)
     url += '&side={0:d}'.format(page_nr)
 
     filename = os.path.join(cache_dir, kommune_id, 'nbr_udir_no_page{0}.html'.format(page_nr))
-    return request_session.get_cached(url, filename, old_age_days=old_age_days)
+    cached = is_cached(filename, old_age_days)
+    profile_report.count('cache_hit' if cached else 'cache_miss')
+    if rate_limiter is not None and not(cached):
+        rate_limiter.wait()
+    session = request_session
+    if threading.current_thread() is not threading.main_thread():
+        session = get_session()
+    with profile_report.timer('cache_read' if cached else 'http_fetch'):
+        content = session.get_cached(url, filename, old_age_days=old_age_days)
+    if not(cached) and content is not None:
+        profile_report.add_bytes('http_fetch', len(content))
+    return content
     
 def find_search_table(soup):
     """Finds correct table, raise exception if multiple (or no) matching tables are found"""
@@ -171,16 +194,43 @@ def parse(content):
         
     #     yield raw_data
 
-def all_pages(kommune_id):
-    for page_nr in range(1, 1024): # max pages (Oslo currently has 832)
-        content = get(kommune_id, page_nr=page_nr) # WARNING: passing page_nr=0 returns the same as page_nr=1
-        data = list(parse(content))
-        if len(data) == 0:      # requesting past the page number does not raise any errors, but returns an empty list
-            break
-        for row in data:
-            yield row
-    else:
-        raise ValueError('ERROR, max pages exceeded, %s', page_nr)
+def all_pages(kommune_id, cache_dir='data', concurrency=1, min_interval=0.5):
+    """Yields all rows for the given kommune, page by page.
+    With concurrency > 1, the remaining pages are fetched by a pool of threads
+    (at most one request every min_interval seconds), rows are still yielded in page order.
+    As for the sequential case, pages are fetched (concurrency at a time) until an empty page is found."""
+    if concurrency <= 1:
+        for page_nr in range(1, max_pages):
+            content = get(kommune_id, page_nr=page_nr, cache_dir=cache_dir) # WARNING: passing page_nr=0 returns the same as page_nr=1
+            data = list(parse(content))
+            if len(data) == 0:      # requesting past the page number does not raise any errors, but returns an empty list
+                break
+            for row in data:
+                yield row
+        else:
+            raise ValueError('ERROR, max pages exceeded, %s' % page_nr)
+        return
+
+    rate_limiter = RateLimiter(min_interval)
+    content = get(kommune_id, page_nr=1, cache_dir=cache_dir, rate_limiter=rate_limiter)
+    data = list(parse(content))
+    if len(data) == 0:
+        return
+    for row in data:
+        yield row
+
+    def get_page(page_nr):
+        return list(parse(get(kommune_id, page_nr=page_nr, cache_dir=cache_dir, rate_limiter=rate_limiter)))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for first_page in range(2, max_pages, concurrency):
+            pages = range(first_page, min(first_page + concurrency, max_pages))
+            for data in executor.map(get_page, pages):
+                if len(data) == 0:
+                    return
+                for row in data:
+                    yield row
+        raise ValueError('ERROR, max pages exceeded, %s' % max_pages)
 
 def all_location(kommune_id, old_age_days=30, cache_dir='data'):
     """Uses the new API: http://www.barnehagefakta.no/api/Location/kommune/<kommune_id> to
@@ -199,11 +249,12 @@ def all_location(kommune_id, old_age_days=30, cache_dir='data'):
         row['name'] = item['navn']
         yield row
     
-def update_kommune(kommune_id, cache_dir = 'data'):
+def update_kommune(kommune_id, cache_dir = 'data', concurrency=1):
+    """Writes all rows for the given kommune to cache_dir/kommune_id/nbr_udir_no.json, see all_pages"""
     filename_output = os.path.join(cache_dir, kommune_id, 'nbr_udir_no.json')
     file_util.create_dirname(filename_output)
     with open(filename_output, 'w') as f_out:
-        for row in all_pages(kommune_id): # all_location(kommune_id): #
+        for row in all_pages(kommune_id, cache_dir=cache_dir, concurrency=concurrency): # all_location(kommune_id): #
             f_out.write(json.dumps(row) + '\n') # FIXME: newline makes it human readable, but not json readable..
     return filename_output
 
@@ -223,9 +274,13 @@ if __name__ == '__main__':
                         help='List of kommune-ids')
     parser.add_argument('--cache_dir', default='data',
                         help='Specify directory for cached .html files and .json outputs, defaults to data/')    
+    parser.add_argument('--concurrency', default=1, type=int,
+                        help='Number of search pages to fetch in parallel (rate limited), defaults to 1 (one page at a time)')
     argparse_util.add_verbosity(parser, default=logging.DEBUG)
 
+    profile_report.add_argument(parser)
     args = parser.parse_args()
+    profile_report.enable(args.profile_report, 'barnehageregister_nbrId.py')
     logging.basicConfig(level=args.loglevel)
     for kommune_id in args.kommunenr:
-        update_kommune(kommune_id)
+        update_kommune(kommune_id, cache_dir=args.cache_dir, concurrency=args.concurrency)
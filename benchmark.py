@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf8
+
+"""Benchmarks of the expensive steps on synthetic, national-scale inputs (no network access).
+The inputs are generated from a seed: barnehagefakta.no json for N kindergartens, nbr.udir.no register pages
+and an overpass response with M elements (some sharing a no-barnehage:nsrid).
+Scale 1 corresponds to Norway (about 5500 kindergartens in 356 kommuner),
+conflate is run per kommune and is therefore scaled from the largest kommune (Oslo).
+Results are compared with a stored baseline, see --save_baseline.
+Example usage
+./benchmark.py --scales 1 10 --save_baseline
+./benchmark.py --scales 1 10"""
+# Standard python imports
+import os
+import sys
+import copy
+import json
+import time
+import random
+import shutil
+import tempfile
+import logging
+logger = logging.getLogger('barnehagefakta.benchmark')
+# This project
+import osmapis_nsrid as osmapis
+from barnehagefakta_osm import create_osmtags, OSMWriter, xml_escape
+import name_cleanup
+
+n_kindergartens = 5500          # Norway, scale 1
+n_kommuner = 356
+n_oslo = 700                    # the largest kommune, scale 1 for conflate
+duplicate_fraction = 0.01       # fraction of the overpass elements sharing a no-barnehage:nsrid
+way_fraction = 0.3              # fraction of the overpass kindergartens mapped as a building (way)
+
+name_words = [u'Sol', u'Måne', u'Eventyr', u'Trollskogen', u'Bjørnebo', u'Kirkeveien', u'Lille', u'Store',
+              u'Fjell', u'Skog', u'Eng', u'Tusenfryd', u'Regnbuen', u'Ekorn', u'Humle', u'Smørblomst']
+name_suffixes = [u'barnehage', u'Barnehage', u'bhg', u'Barnehage AS', u'barnehage SA', u'FUS barnehage',
+                 u'Kanvas-barnehage', u'Familiebarnehage', u'barnehager avd. Nord', u'Kommunale barnehage']
+operators = [u'Kommune', u'FUS AS', u'Kanvas', u'Norlandia Barnehagene AS', u'Espira AS', u'Foreldrelaget SA']
+
+#
+# Synthetic inputs
+#
+
+def random_name(rng):
+    words = rng.sample(name_words, rng.randint(1, 2))
+    return u' '.join(words + [rng.choice(name_suffixes)])
+
+def synthetic_barnehagefakta(n, seed=0):
+    """Returns a list of n barnehagefakta.no responses (as dictionaries, see barnehagefakta_get)"""
+    rng = random.Random(seed)
+    items = list()
+    for ix in range(n):
+        nsrid = str(1000000 + ix)
+        kommune = '%04d' % (101 + ix % n_kommuner)
+        min_age = rng.choice([0, 1, 3])
+        items.append({
+            'alder': '%d - %d' % (min_age, rng.choice([5, 6])),
+            'eierform': rng.choice(['Privat', 'Kommunal']),
+            'erAktiv': True,
+            'erBarnehage': True,
+            'erPrivatBarnehage': True,
+            'kommune': {'kommunenavn': 'Kommune %s' % kommune, 'kommunenummer': kommune},
+            'kontaktinformasjon': {'besoksAdresse': {'adresselinje': u'%s %d' % (rng.choice(name_words), rng.randint(1, 99)),
+                                                     'postnr': '%04d' % rng.randint(1, 9999), 'poststed': 'STED'},
+                                   'epost': '', 'url': rng.choice(['', 'http://example.com/%s' % nsrid]),
+                                   'telefon': '%08d' % rng.randint(0, 99999999)},
+            'koordinatLatLng': [round(rng.uniform(58, 70), 6), round(rng.uniform(5, 30), 6)],
+            'navn': random_name(rng),
+            'orgnr': str(900000000 + ix),
+            'nsrId': nsrid,
+            'indikatorDataBarnehage': {'antallBarn': rng.randint(5, 150)},
+            'indikatorDataKommune': {'antallBarn': rng.randint(100, 30000)},
+            'type': u'Familiebarnehage' if rng.random() < 0.1 else u'Ordinær barnehage',
+        })
+    return items
+
+def synthetic_register_pages(items, page_size=20):
+    """Returns the nbr.udir.no search pages (json strings, see barnehageregister_nbrId.parse) listing items"""
+    pages = list()
+    for start in range(0, len(items), page_size):
+        enheter = [{'enhetLink': {'text': item['navn'], 'id': item['orgnr']},
+                    'eierLink': {'text': operators[ix % len(operators)], 'id': 800000000 + ix}}
+                   for ix, item in enumerate(items[start:start + page_size])]
+        pages.append(json.dumps({'enheter': enheter, 'antallTreff': len(items)}))
+    return pages
+
+def xml_tags(tags):
+    return u''.join(u'<tag k="%s" v="%s"/>' % (xml_escape(key), xml_escape(value)) for key, value in sorted(tags.items()))
+
+def synthetic_overpass(items, mapped_fraction=0.6, seed=0):
+    """Returns an overpass no-barnehage:nsrid response (xml string) for the given barnehagefakta items,
+    mapped_fraction of them are in osm (as a node or a way), some with a shared nsrid"""
+    rng = random.Random(seed)
+    lines = [u'<?xml version="1.0" encoding="UTF-8"?>', u'<osm version="0.6" generator="benchmark.py">',
+             u'<meta osm_base="2020-01-01T00:00:00Z"/>']
+    node_id = 1
+    way_id = 1
+    mapped = [item for item in items if rng.random() < mapped_fraction]
+    duplicates = rng.sample(mapped, int(len(mapped)*duplicate_fraction))
+    for item in mapped + duplicates:
+        node, _ = create_osmtags(item, operator=rng.choice(operators))
+        tags = dict(node.tags)
+        tags.pop('ADDRESS', None)
+        if rng.random() < 0.2:   # edited in osm
+            tags['name'] = random_name(rng)
+        lat, lon = item['koordinatLatLng']
+        meta = u'version="%d" timestamp="2019-01-01T00:00:00Z" changeset="1" uid="1" user="benchmark"' % rng.randint(1, 5)
+        if rng.random() < way_fraction:
+            refs = list()
+            for dlat, dlon in ((0, 0), (0, 1e-4), (1e-4, 1e-4), (1e-4, 0)):
+                lines.append(u'<node id="%d" lat="%.7f" lon="%.7f" %s/>' % (node_id, lat + dlat, lon + dlon, meta))
+                refs.append(node_id)
+                node_id += 1
+            nds = u''.join(u'<nd ref="%d"/>' % ref for ref in refs + refs[:1])
+            lines.append(u'<way id="%d" %s>%s%s</way>' % (way_id, meta, nds, xml_tags(tags)))
+            way_id += 1
+        else:
+            lines.append(u'<node id="%d" lat="%.7f" lon="%.7f" %s>%s</node>' % (node_id, lat, lon, meta, xml_tags(tags)))
+            node_id += 1
+    lines.append(u'</osm>')
+    return u'\n'.join(lines)
+
+def synthetic_outdated(items, seed=0):
+    """Returns a list of (outdated, updated) barnehagefakta.no responses, with the kinds of changes seen in practice"""
+    rng = random.Random(seed)
+    pairs = list()
+    for item in items:
+        updated = copy.deepcopy(item)
+        change = rng.choice(['capacity', 'capacity_small', 'name', 'age', 'url', 'none'])
+        if change == 'capacity':
+            updated['indikatorDataBarnehage']['antallBarn'] += 20
+        elif change == 'capacity_small':
+            updated['indikatorDataBarnehage']['antallBarn'] += 2
+        elif change == 'name':
+            updated['navn'] = random_name(rng)
+        elif change == 'age':
+            updated['alder'] = '1 - 6'
+        elif change == 'url':
+            updated['kontaktinformasjon']['url'] = 'http://example.org/new'
+        pairs.append((item, updated))
+    return pairs
+
+#
+# Benchmarks, each is a function (scale, seed) -> (number of items, function to time)
+#
+
+def bench_create_osmtags(scale, seed):
+    items = synthetic_barnehagefakta(n_kindergartens*scale, seed)
+    def run():
+        name_cleanup.cleanup.cache_clear()
+        for item in items:
+            create_osmtags(item)
+    return len(items), run
+
+def bench_name_cleanup(scale, seed):
+    names = [item['navn'] for item in synthetic_barnehagefakta(n_kindergartens*scale, seed)]
+    def run():
+        name_cleanup.cleanup.cache_clear()
+        for name in names:
+            name_cleanup.name_cleanup(name)
+    return len(names), run
+
+def bench_parse_register(scale, seed):
+    import barnehageregister_nbrId
+    pages = synthetic_register_pages(synthetic_barnehagefakta(n_kindergartens*scale, seed))
+    def run():
+        for page in pages:
+            for row in barnehageregister_nbrId.parse(page):
+                pass
+    return n_kindergartens*scale, run
+
+def bench_from_xml(scale, seed):
+    xml = synthetic_overpass(synthetic_barnehagefakta(n_kindergartens*scale, seed), seed=seed)
+    def run():
+        osmapis.OSMnsrid.from_xml(xml)
+    return xml.count(u'no-barnehage:nsrid'), run
+
+def bench_from_file(scale, seed):
+    xml = synthetic_overpass(synthetic_barnehagefakta(n_kindergartens*scale, seed), seed=seed)
+    f = tempfile.NamedTemporaryFile('wb', suffix='.osm', delete=False)
+    with f:
+        f.write(xml.encode('utf8'))
+    def run():
+        try:
+            osmapis.OSMnsrid.from_file(f.name)
+        finally:
+            if run.last:
+                os.remove(f.name)
+    run.last = False
+    return xml.count(u'no-barnehage:nsrid'), run
+
+def bench_conflate(scale, seed, radius=0.1):
+    """The (non-interactive) scoring step of conflate_osm.conflate, for a single kommune"""
+    import conflate_osm
+    rng = random.Random(seed)
+    items = synthetic_barnehagefakta(n_oslo*scale, seed)
+    for item in items:          # same kommune
+        lat, lon = 59.9 + rng.uniform(-0.1, 0.1), 10.75 + rng.uniform(-0.2, 0.2)
+        item['koordinatLatLng'] = [lat, lon]
+    nbr_elements = [create_osmtags(item)[0] for item in items]
+    overpass_osm = osmapis.OSMnsrid.from_xml(synthetic_overpass(items, seed=seed))
+    overpass_elements = [o for o in overpass_osm if len(o.tags) != 0]
+    def run():
+        conflate_osm.compute_score_matrix_pruned(nbr_elements, overpass_elements, overpass_osm, radius=radius)
+    return len(nbr_elements), run
+
+def bench_resolve_conflict(scale, seed):
+    import update_osm
+    pairs = synthetic_outdated(synthetic_barnehagefakta(n_kindergartens*scale, seed), seed=seed)
+    converted = list()
+    for outdated, updated in pairs:
+        osm_outdated, _ = create_osmtags(outdated)
+        osm_updated, _ = create_osmtags(updated)
+        converted.append((osm_outdated, osm_updated))
+    def run():
+        # resolve_conflict modifies its arguments, the copies are made before timing
+        arguments = [(copy.deepcopy(osm_outdated), copy.deepcopy(osm_outdated), osm_updated)
+                     for osm_outdated, osm_updated in converted]
+        run.start = time.time()
+        for osm_element, osm_outdated, osm_updated in arguments:
+            update_osm.resolve_conflict(osm_element, osm_outdated, osm_updated)
+    return len(converted), run
+
+def bench_generate_html(scale, seed, root=os.path.dirname(os.path.abspath(__file__))):
+    """generate_html.main for a synthetic data directory (all pages are rendered, force=True)"""
+    import generate_html
+    items = synthetic_barnehagefakta(n_kindergartens*scale, seed)
+    work_dir = tempfile.mkdtemp(prefix='benchmark_generate_html')
+    data_dir = os.path.join(work_dir, 'data')
+    nr2name = dict()
+    writers = dict()
+    for item in items:
+        kommune = item['kommune']['kommunenummer']
+        nr2name[int(kommune)] = item['kommune']['kommunenavn']
+        if kommune not in writers:
+            writers[kommune] = OSMWriter(os.path.join(data_dir, kommune, '%s_barnehagefakta.osm' % kommune))
+        writers[kommune].add(create_osmtags(item)[0])
+    for writer in writers.values():
+        writer.close()
+    osm = osmapis.OSMnsrid.from_xml(synthetic_overpass(items, seed=seed))
+
+    def run():
+        # no network: the kommune names are given by the synthetic data
+        kommunenummer, cwd = generate_html.kommunenummer, os.getcwd()
+        generate_html.kommunenummer = lambda cache_dir=None: (nr2name, dict((v, k) for k, v in nr2name.items()))
+        os.chdir(work_dir)      # history.csv is written to the working directory
+        try:
+            generate_html.main(osm, data_dir=data_dir, root_output=work_dir, root=root, force=True)
+        finally:
+            generate_html.kommunenummer = kommunenummer
+            os.chdir(cwd)
+            if run.last:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    run.last = False
+    return len(items), run
+
+# name -> (benchmark, largest scale it is run at)
+benchmarks = [('create_osmtags', bench_create_osmtags, None),
+              ('name_cleanup', bench_name_cleanup, None),
+              ('parse_register', bench_parse_register, None),
+              ('OSMnsrid.from_xml', bench_from_xml, None),
+              ('OSMnsrid.from_file', bench_from_file, None),
+              ('conflate', bench_conflate, 10), # the score matrix is dense, n_oslo*100 does not fit in memory
+              ('resolve_conflict', bench_resolve_conflict, None),
+              ('generate_html.main', bench_generate_html, None)]
+
+def run_benchmark(function, scale, repeat=3, seed=0):
+    """Returns (number of items, best time in seconds) of repeat runs, the setup is not timed"""
+    n, run = function(scale, seed)
+    best = None
+    for ix in range(repeat):
+        run.last = ix == repeat - 1
+        run.start = None
+        start = time.time()
+        run()
+        if run.start is not None: # the run excluded its own setup
+            start = run.start
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return n, best
+
+def run_all(scales, repeat=3, seed=0, names=None):
+    """Returns {name: {scale: {'items': n, 'seconds': best}}}"""
+    results = dict()
+    for name, function, max_scale in benchmarks:
+        if names and name not in names:
+            continue
+        for scale in scales:
+            if max_scale is not None and scale > max_scale:
+                logger.info('Skipping %s at scale %s (larger than %s)', name, scale, max_scale)
+                continue
+            logger.info('Running %s at scale %s', name, scale)
+            n, seconds = run_benchmark(function, scale, repeat=repeat, seed=seed)
+            results.setdefault(name, dict())[str(scale)] = dict(items=n, seconds=seconds)
+    return results
+
+def compare(results, baseline, threshold=1.25):
+    """Returns (table as a string, list of regressions), a regression is more than threshold times slower than the baseline"""
+    lines = ['%-22s %6s %9s %11s %11s %11s' % ('benchmark', 'scale', 'items', 'seconds', 'us/item', 'baseline')]
+    regressions = list()
+    for name in results:
+        for scale, result in sorted(results[name].items(), key=lambda item: int(item[0])):
+            seconds = result['seconds']
+            per_item = 1e6*seconds/max(result['items'], 1)
+            ratio = ''
+            previous = baseline.get(name, dict()).get(scale)
+            if previous is not None and previous['seconds'] > 0:
+                r = seconds/previous['seconds']
+                ratio = '%.2fx' % r
+                if r > threshold:
+                    ratio += ' SLOWER'
+                    regressions.append((name, scale, r))
+            lines.append('%-22s %6s %9d %11.3f %11.1f %11s' % (name, scale, result['items'], seconds, per_item, ratio))
+    return '\n'.join(lines), regressions
+
+if __name__ == '__main__':
+    from utility_to_osm import argparse_util
+    parser = argparse_util.get_parser('Benchmarks the conversion, parsing, conflation and html generation on synthetic data at multiples of the size of Norway, and compares with a stored baseline.')
+    parser.add_argument('--scales', nargs='+', type=int, default=[1, 10, 100],
+                        help='Input sizes, as multiples of Norway, defaults to 1 10 100')
+    parser.add_argument('--benchmarks', nargs='+', default=None,
+                        help='Only run these benchmarks (%s)' % ', '.join(name for name, _, _ in benchmarks))
+    parser.add_argument('--repeat', default=3, type=int,
+                        help='Number of runs of each benchmark, the best is kept, defaults to 3')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed for the synthetic data, defaults to 0')
+    parser.add_argument('--baseline', default='benchmark_baseline.json',
+                        help='Compare with the results stored in this file, defaults to benchmark_baseline.json')
+    parser.add_argument('--save_baseline', default=False, action='store_true',
+                        help='Store the results as the new --baseline')
+    parser.add_argument('--threshold', default=1.25, type=float,
+                        help='Report a regression (and exit with status 1) when a benchmark is more than this many times slower than the baseline, defaults to 1.25')
+    argparse_util.add_verbosity(parser, default=logging.WARNING)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+    logging.getLogger('barnehagefakta').setLevel(max(args.loglevel, logging.WARNING)) # the benchmarked code logs a lot
+    logger.setLevel(args.loglevel)
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_all(args.scales, repeat=args.repeat, seed=args.seed, names=args.benchmarks)
+    table, regressions = compare(results, baseline, threshold=args.threshold)
+    print(table)
+
+    if args.save_baseline:
+        for name in results:
+            baseline.setdefault(name, dict()).update(results[name])
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print('Saved %s' % args.baseline)
+    elif len(regressions) != 0:
+        print('%d regression(s) compared to %s' % (len(regressions), args.baseline))
+        sys.exit(1)
@@ -15,7 +15,9 @@ import numpy as np
 from utility_to_osm import file_util
 import osmapis_nsrid as osmapis
 from barnehagefakta_osm import to_kommunenr
+from barnehagefakta_store import is_cached
 from utility_to_osm import argparse_util
+import profile_report
 
 # how close is the lat/lon
 from generate_html import get_lat_lon # fixme, move this piece of code
@@ -30,16 +32,17 @@ def overpass_xml(xml, old_age_days=7, conflate_cache_filename=None):
     else:
         filename = conflate_cache_filename
     
-    cached, outdated = file_util.cached_file(filename, old_age_days=old_age_days)
-    if cached is not None and not(outdated):
+    if is_cached(filename, old_age_days):
         print('Using overpass responce stored as "%s". Delete this file if you want an updated version' % filename)
-        return osmapis.OSMnsrid.from_xml(cached)
+        return osmapis.OSMnsrid.from_file(filename)
 
     o = osmapis.OverpassAPI()
-    osm = o.interpreter(xml)
+    with profile_report.timer('http_fetch'):
+        osm = o.interpreter(xml)
 
     print('Overpass responce stored as %s' % filename)
-    osm.save(filename)
+    with profile_report.timer('xml_serialize'):
+        osm.save(filename)
 
     return osm
 
@@ -163,6 +166,231 @@ def score(nbr_node, overpass_element, overpass_osm):
     
     return score
 
+def score_similarity_strings_matrix(nbr_names, overpass_names):
+    """Vectorized score_similarity_strings, returns the matrix
+    [[score_similarity_strings(a, b) for b in overpass_names] for a in nbr_names]
+    None is used for missing names.
+    >>> score_similarity_strings_matrix(['Foo barnehage', 'Bar', None], ['foo barnehage', 'Barnehage foo', None]).tolist()
+    [[200, 20, 0], [10, 10, 0], [0, 0, 0]]
+    """
+    nbr_present = np.array([name is not None for name in nbr_names], dtype=bool)
+    overpass_present = np.array([name is not None for name in overpass_names], dtype=bool)
+    nbr_lower = [name.lower() if name is not None else '' for name in nbr_names]
+    overpass_lower = [name.lower() if name is not None else '' for name in overpass_names]
+
+    # exact (case-insensitive) match gives 200
+    codes = dict()
+    nbr_codes = np.array([codes.setdefault(name, len(codes)) for name in nbr_lower], dtype=int)
+    overpass_codes = np.array([codes.setdefault(name, len(codes)) for name in overpass_lower], dtype=int)
+    equal = nbr_codes[:, np.newaxis] == overpass_codes[np.newaxis, :]
+
+    # +10 for each nbr word found in the overpass name,
+    # each unique word is only searched for once
+    words = dict()
+    rows = list()
+    for name in nbr_lower:
+        row = list()
+        for word in name.split():
+            row.append(words.setdefault(word, len(words)))
+        rows.append(row)
+    word_count = np.zeros((len(nbr_names), len(words)), dtype=int)
+    for ix, row in enumerate(rows):
+        for word_ix in row:
+            word_count[ix, word_ix] += 1
+
+    overpass_array = np.array(overpass_lower, dtype=str)
+    word_found = np.zeros((len(words), len(overpass_names)), dtype=int)
+    for word, word_ix in words.items():
+        if len(overpass_array) != 0:
+            word_found[word_ix, :] = np.char.find(overpass_array, word) != -1
+
+    score = np.where(equal, 200, 10*np.dot(word_count, word_found))
+    score[~nbr_present, :] = 0
+    score[:, ~overpass_present] = 0
+    return score
+
+def compute_score_matrix(nbr_elements, overpass_elements, overpass_osm, overpass_lat_lon=None):
+    """Vectorized version of score(), returns the integer matrix where
+    [ix, jx] is score(nbr_elements[ix], overpass_elements[jx], overpass_osm) truncated to an integer.
+    Features (tag values, names, nsrid and coordinates) are extracted once per element.
+    Optionally pass overpass_lat_lon, the already computed get_lat_lon for each overpass element.
+
+    Agrees with score() for nodes with and without name, amenity, operator, nsrid and highway tags:
+    >>> nodes = [osmapis.Node(attribs=dict(lat=59.9 + ix*0.03, lon=10.7), tags=tags) for ix, tags in enumerate((
+    ...     {'amenity': 'kindergarten', 'name': 'Foo barnehage', 'operator': 'Foo AS', 'no-barnehage:nsrid': '1'},
+    ...     {'amenity': 'kindergarten', 'name': 'Bar barnehage', 'no-barnehage:nsrid': '2'},
+    ...     {'amenity': 'kindergarten', 'operator': 'Foo AS', 'no-barnehage:nsrid': '1'},
+    ...     {'name': 'foo barnehage', 'operator': 'Bar'},
+    ...     {'amenity': 'kindergarten'},
+    ...     {'name:no': 'Foo barnehage', 'highway': 'residential'},
+    ...     {'name': 'Foo barnehage', 'highway': 'bus_stop'},
+    ...     {}))]
+    >>> matrix = compute_score_matrix(nodes, nodes, None)
+    >>> with np.errstate(divide='ignore'):
+    ...     reference = [[int(score(a, b, None)) for b in nodes] for a in nodes]
+    >>> matrix.tolist() == reference
+    True
+    """
+    nbr_tags = [e.tags for e in nbr_elements]
+    overpass_tags = [e.tags for e in overpass_elements]
+    shape = (len(nbr_elements), len(overpass_elements))
+    score = np.zeros(shape, dtype=int)
+    if len(nbr_elements) == 0 or len(overpass_elements) == 0:
+        return score
+
+    # how many of the keys overlapp (+1 for each)
+    # do any of the values match (+10 for each)
+    # (only keys present in the nbr data can overlapp)
+    keys = set()
+    for tags in nbr_tags:
+        keys.update(tags.keys())
+    for key in sorted(keys):
+        values = dict()         # value -> integer code, missing keys get -1 and -2 so they never match
+        nbr_codes = np.array([values.setdefault(tags[key], len(values)) if key in tags else -1
+                              for tags in nbr_tags], dtype=int)
+        overpass_codes = np.array([values.setdefault(tags[key], len(values)) if key in tags else -2
+                                   for tags in overpass_tags], dtype=int)
+        overlapp = (nbr_codes >= 0)[:, np.newaxis] & (overpass_codes >= 0)[np.newaxis, :]
+        score += overlapp
+        score += 10*(nbr_codes[:, np.newaxis] == overpass_codes[np.newaxis, :])
+
+    # are the names similar
+    nbr_names = [tags.get('name', None) for tags in nbr_tags]
+    score += score_similarity_strings_matrix(nbr_names, [tags.get('name', None) for tags in overpass_tags])
+    score += score_similarity_strings_matrix(nbr_names, [tags.get('name:no', None) for tags in overpass_tags])
+
+    # same nsrid?
+    key = 'no-barnehage:nsrid'
+    nbr_nsrid = [tags.get(key, None) for tags in nbr_tags]
+    overpass_nsrid = [tags.get(key, None) for tags in overpass_tags]
+    values = dict()
+    nbr_codes = np.array([values.setdefault(v, len(values)) if v is not None else -1 for v in nbr_nsrid], dtype=int)
+    overpass_codes = np.array([values.setdefault(v, len(values)) if v is not None else -2 for v in overpass_nsrid], dtype=int)
+    both = (nbr_codes >= 0)[:, np.newaxis] & (overpass_codes >= 0)[np.newaxis, :]
+    same = nbr_codes[:, np.newaxis] == overpass_codes[np.newaxis, :]
+    score += np.where(both, np.where(same, 100, -10), 0)
+
+    # how close is the lat/lon
+    score = score.astype(float)
+    overpass_lat = np.empty(len(overpass_elements))
+    overpass_lon = np.empty(len(overpass_elements))
+    if overpass_lat_lon is None:
+        overpass_lat_lon = [get_lat_lon(overpass_osm, element) for element in overpass_elements] # fixme, only returns 1 node
+    for jx, lat_lon in enumerate(overpass_lat_lon):
+        if lat_lon is None:
+            overpass_lat[jx], overpass_lon[jx] = np.nan, np.nan
+        else:
+            overpass_lat[jx], overpass_lon[jx] = lat_lon
+    nbr_lat = np.array([e.attribs['lat'] for e in nbr_elements], dtype=float)
+    nbr_lon = np.array([e.attribs['lon'] for e in nbr_elements], dtype=float)
+    diff = np.sqrt((overpass_lat[np.newaxis, :] - nbr_lat[:, np.newaxis])**2 +
+                   (overpass_lon[np.newaxis, :] - nbr_lon[:, np.newaxis])**2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distance_score = 1/diff
+    distance_score[distance_score > 100] = 100
+    distance_score[np.isnan(distance_score)] = 0 # no lat/lon found
+    score += distance_score
+
+    # is there a highway tag?
+    highway = np.array(['highway' in tags for tags in overpass_tags], dtype=bool)
+    bus_stop = np.array([tags.get('highway', None) == 'bus_stop' for tags in overpass_tags], dtype=bool)
+    score[:, highway] -= 10
+    score[:, bus_stop] -= 100
+
+    return score.astype(int)
+
+class GridIndex(object):
+    """Buckets items by lat/lon (in degrees) into square cells of size cell_size,
+    an item within cell_size of a point is always found in the 3x3 cells around the point.
+    >>> index = GridIndex(0.1)
+    >>> index.add(59.71, 10.84, 'a')
+    >>> index.add(59.79, 10.91, 'b')
+    >>> index.add(60.5, 10.84, 'c')
+    >>> sorted(index.neighbours(index.cell(59.72, 10.85)))
+    ['a', 'b']
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = dict()
+
+    def cell(self, lat, lon):
+        return int(np.floor(lat/self.cell_size)), int(np.floor(lon/self.cell_size))
+
+    def add(self, lat, lon, item):
+        self.cells.setdefault(self.cell(lat, lon), []).append(item)
+
+    def neighbours(self, cell):
+        """Yields all items in the given cell and the 8 surrounding cells"""
+        i, j = cell
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for item in self.cells.get((i + di, j + dj), []):
+                    yield item
+
+def compute_score_matrix_pruned(nbr_elements, overpass_elements, overpass_osm, radius=None):
+    """As compute_score_matrix, but each nbr element is only scored against the overpass elements
+    within radius (in degrees, as used by score()), the elements with the same no-barnehage:nsrid
+    and the elements without a known lat/lon. All other scores are left as 0.
+    radius=None scores all pairs."""
+    if radius is None:
+        return compute_score_matrix(nbr_elements, overpass_elements, overpass_osm)
+
+    score = np.zeros((len(nbr_elements), len(overpass_elements)), dtype=int)
+    overpass_lat_lon = [get_lat_lon(overpass_osm, element) for element in overpass_elements] # fixme, only returns 1 node
+    index = GridIndex(radius)
+    unlocated = list()
+    for jx, lat_lon in enumerate(overpass_lat_lon):
+        if lat_lon is None:
+            unlocated.append(jx)
+        else:
+            index.add(lat_lon[0], lat_lon[1], jx)
+
+    # exact nsrid hits, ignoring overpass elements without tags
+    element_jx = dict((id(element), jx) for jx, element in enumerate(overpass_elements))
+    nsrids = getattr(overpass_osm, 'nsrids', {})
+
+    nbr_cells = dict()
+    for ix, element in enumerate(nbr_elements):
+        cell = index.cell(element.attribs['lat'], element.attribs['lon'])
+        nbr_cells.setdefault(cell, []).append(ix)
+
+    count = 0
+    for cell in sorted(nbr_cells):
+        ix_list = nbr_cells[cell]
+        nsrid_hits = set()
+        for ix in ix_list:
+            nsrid = nbr_elements[ix].tags.get('no-barnehage:nsrid', None)
+            for element in nsrids.get(nsrid, []):
+                if id(element) in element_jx:
+                    nsrid_hits.add(element_jx[id(element)])
+
+        jx_list = sorted(set(index.neighbours(cell)).union(unlocated, nsrid_hits))
+        if len(jx_list) == 0:
+            continue
+
+        block = compute_score_matrix([nbr_elements[ix] for ix in ix_list],
+                                     [overpass_elements[jx] for jx in jx_list],
+                                     overpass_osm,
+                                     overpass_lat_lon=[overpass_lat_lon[jx] for jx in jx_list])
+
+        # the 3x3 cells covers more than radius, only keep those that are close enough
+        lat = np.array([overpass_lat_lon[jx][0] if overpass_lat_lon[jx] is not None else np.nan for jx in jx_list])
+        lon = np.array([overpass_lat_lon[jx][1] if overpass_lat_lon[jx] is not None else np.nan for jx in jx_list])
+        nbr_lat = np.array([nbr_elements[ix].attribs['lat'] for ix in ix_list], dtype=float)
+        nbr_lon = np.array([nbr_elements[ix].attribs['lon'] for ix in ix_list], dtype=float)
+        diff = np.sqrt((lat[np.newaxis, :] - nbr_lat[:, np.newaxis])**2 +
+                       (lon[np.newaxis, :] - nbr_lon[:, np.newaxis])**2)
+        keep = ~(diff > radius)  # nan (unknown lat/lon) is kept
+        nbr_nsrid = np.array([nbr_elements[ix].tags.get('no-barnehage:nsrid', '') for ix in ix_list], dtype=object)
+        nsrid = np.array([overpass_elements[jx].tags.get('no-barnehage:nsrid', None) for jx in jx_list], dtype=object)
+        keep |= nbr_nsrid[:, np.newaxis] == nsrid[np.newaxis, :]
+
+        score[np.ix_(ix_list, jx_list)] = np.where(keep, block, 0)
+        count += np.sum(keep)
+
+    logger.info('Scored %d of %d possible pairs within radius = %s', count, score.size, radius)
+    return score
+
 def is_perfect_match(dict_a, dict_b):
     """Look for matching nsrid"""
     try:
@@ -327,21 +555,21 @@ def get_all_referenced(lst, osm, recursion=0):
         else:
             raise ValueError('%d, Expected node/way/relation, not %s, %s' % (recursion, type(item), item))
 
-def conflate(nbr_osm, overpass_osm, output_filename='out.osm'):
+def conflate(nbr_osm, overpass_osm, output_filename='out.osm', radius=None):
+    """Interactive conflation of nbr_osm into overpass_osm, see compute_score_matrix_pruned for radius"""
     #original_osm = osmapis.OSMnsrid.from_xml(overpass_osm.to_xml()) # inconvenient way of getting a copy
 
     # score_list = dict()
     # all_scores = list()
     nbr_elements = list(nbr_osm)
     overpass_elements = [o for o in overpass_osm if len(o.tags) != 0] # the overpass elements that actually has tags
-    score_matrix = np.zeros((len(nbr_elements), len(overpass_elements)), dtype=np.int)
     logger.debug('nbr_elements = %s, %s', len(nbr_elements), nbr_elements)
     logger.debug('overpass_elements = %s, %s', len(overpass_elements), overpass_elements)
 
+    with profile_report.timer('scoring'):
+        score_matrix = compute_score_matrix_pruned(nbr_elements, overpass_elements, overpass_osm=overpass_osm,
+                                                   radius=radius)
     for ix in range(len(nbr_elements)):
-        for jx in range(len(overpass_elements)):
-            score_matrix[ix, jx] = score(nbr_elements[ix], overpass_elements[jx],
-                                         overpass_osm=overpass_osm)
         if len(score_matrix) != 0:
             logger.debug('score for nsrid=%s, max=%s, %s %s',
                          nbr_elements[ix].tags['no-barnehage:nsrid'],
@@ -462,7 +690,8 @@ def conflate(nbr_osm, overpass_osm, output_filename='out.osm'):
         
     if len(modified) != 0:
         print('Saving conflated data as "%s", open this in JOSM, review and upload. Remember to include "data.udir.no" in source' % output_filename)
-        overpass_osm.save(output_filename)
+        with profile_report.timer('xml_serialize'):
+            overpass_osm.save(output_filename)
     else:
         print('No changes made, nothing to upload')
     
@@ -498,9 +727,13 @@ if __name__ == '__main__':
                         help="Optionally specify a overpass query xml file, defaults to query_template.xml")
     parser.add_argument('--conflate_cache_filename', default=None,
                         help='Optionally specify a filename for the overpass responce.')
+    parser.add_argument('--radius', default=0.1, type=float,
+                        help='Only consider osm objects within this distance (in degrees) of a kindergarten, in addition to objects with the same no-barnehage:nsrid. Use 0 to consider all objects, defaults to 0.1')
     argparse_util.add_verbosity(parser, default=logging.DEBUG)
     
+    profile_report.add_argument(parser)
     args = parser.parse_args()
+    profile_report.enable(args.profile_report, 'conflate_osm.py')
 
     logging.basicConfig(level=args.loglevel)
 
@@ -552,8 +785,7 @@ if __name__ == '__main__':
     nbr_osms = []
     for filename in nbr_osms_filenames:
         logger.info('Parsing %s', filename)
-        xml = file_util.read_file(filename)
-        nbr_osms.append(osmapis.OSMnsrid.from_xml(xml))
+        nbr_osms.append(osmapis.OSMnsrid.from_file(filename))
 
     if len(nbr_osms) == 0:
         print('Warning: You need to supply either --osm_kommune and/or --osm_filename, see --help. Exiting...')
@@ -568,4 +800,7 @@ if __name__ == '__main__':
     print('Saving the combined nbr data as nbr.osm')
     nbr_osm.save('nbr.osm')
 
-    conflate(nbr_osm, overpass_osm, output_filename='out.osm')
+    radius = args.radius
+    if radius <= 0:
+        radius = None
+    conflate(nbr_osm, overpass_osm, output_filename='out.osm', radius=radius)
@@ -6,6 +6,7 @@ import subprocess
 from glob import glob
 
 from utility_to_osm import file_util
+from barnehagefakta_store import FileStore, get_store
 
 def get_conversion(data_dir='data'):
     nsrId_to_orgnr_filename = os.path.join(data_dir, 'nsrId_to_orgnr.json')
@@ -21,6 +22,41 @@ def get_conversion(data_dir='data'):
     
     return nsrId_to_orgnr, orgnr_to_nsrId
 
+def convert(data_dir, nsrId_to_orgnr, store=None):
+    """Moves the barnehagefakta_no_nbrId*.json responses below data_dir into store
+    (see barnehagefakta_store, defaults to the FileStore) under their orgnr.
+    With the FileStore the files are renamed using git mv, if possible."""
+    if store is None:
+        store = FileStore()
+    for kommune_nr in os.listdir(data_dir):
+        folder = os.path.join(data_dir, kommune_nr)
+        if os.path.isdir(folder):
+            print(folder)
+
+            for filename in glob(os.path.join(folder, 'barnehagefakta_no_nbrId*.json')):
+                reg = re.search(r'barnehagefakta_no_nbrId(\d+)', filename)
+                if reg:
+                    nbrId = reg.group(1)
+                    try:
+                        orgnr = nsrId_to_orgnr[nbrId]
+                    except KeyError as e:
+                        content = file_util.read_file(filename)
+                        print('ERROR', repr(e), filename, content)
+                        if content == '404':
+                            os.remove(filename)
+                        continue
+
+                    if isinstance(store, FileStore):
+                        new_filename = store.filename(orgnr, folder)
+                        subprocess.run(['git', 'mv', filename, new_filename])
+                        # if the file is still there, probably not version controlled
+                        if os.path.exists(filename):
+                            os.rename(filename, new_filename)
+                    else:
+                        store.save(orgnr, folder, file_util.read_file(filename),
+                                   fetched=os.path.getmtime(filename))
+                        os.remove(filename)
+
 if __name__ == '__main__':
     data_dir = 'data' #'barnehagefakta_osm_data/data'
     nsrId_to_orgnr_filename = 'data/nsrId_to_orgnr.json'
@@ -54,33 +90,9 @@ if __name__ == '__main__':
         with open(nsrId_to_orgnr_filename, 'w') as f:
             json.dump(nsrId_to_orgnr, f)
 
-    nsrId_to_orgnr = get_nsrId_to_orgnr()
-    
-    if False:
-        # Done once, on newer dump of database, Rename files
-        for kommune_nr in os.listdir(data_dir):
-            folder = os.path.join(data_dir, kommune_nr)
-            if os.path.isdir(folder):
-                print(folder)
-
-                count = 0
-                for filename in glob(os.path.join(folder, 'barnehagefakta_no_nbrId*.json')):
-                    reg = re.search('barnehagefakta_no_nbrId(\d+)', filename)
-                    if reg:
-                        nbrId = reg.group(1)
-                        try:
-                            orgnr = nsrId_to_orgnr[nbrId]
-                        except KeyError as e:
-                            content = file_util.read_file(filename)
-                            print('ERROR', repr(e), filename, content)
-                            if content == '404':
-                                os.remove(filename)
-                            continue
-                            
-                        new_filename = filename.replace('barnehagefakta_no_nbrId%s' % nbrId,
-                                                        'barnehagefakta_no_orgnr%s' % orgnr)
+    nsrId_to_orgnr, _ = get_conversion(data_dir)
 
-                        subprocess.run(['git', 'mv', filename, new_filename])
-                        # if the file is still there, probably not version controlled
-                        if os.path.exists(filename):
-                            os.rename(filename, new_filename)
+    if False:
+        # Done once, on newer dump of database, Rename files (or import them into the sqlite file cache_db)
+        cache_db = None
+        convert(data_dir, nsrId_to_orgnr, store=get_store(cache_db))
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf8
 
+import re
 import json
+import hashlib
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import codecs
 def open_utf8(filename, *args, **kwargs):
@@ -16,6 +21,11 @@ from jinja2 import Template
 # This project
 import update_osm
 import osmapis_nsrid as osmapis
+import profile_report
+try:
+    from nsrid_index import IndexedElement
+except ImportError:             # requires numpy, only needed for --overpass_index
+    IndexedElement = ()
 from utility_to_osm.kommunenummer import kommunenummer
 from utility_to_osm.generate_html_history_chart import render_history_chart
 
@@ -25,15 +35,50 @@ from utility_to_osm.generate_html_history_chart import render_history_chart
 #     t = d.make_table(a.encode('utf8'), b.encode('utf8'))
 #     return t
 from utility_to_osm import htmldiff
-def my_htmldiff(a, b):
+def htmldiff_full(a, b):
     try:
         d = htmldiff.HTMLMatcher(a.encode('utf8'), b.encode('utf8'),
                                  accurate_mode=True)
         return d.htmlDiff(addStylesheet=False).decode('utf8')
-    except:
-        d = htmldiff.HTMLMatcher(a, b,
-                                 accurate_mode=True)
-        return d.htmlDiff(addStylesheet=False)
+    except Exception as e:
+        logger.debug('htmldiff failed on utf8 bytes, using str. %s', e)
+
+    d = htmldiff.HTMLMatcher(a, b,
+                             accurate_mode=True)
+    return d.htmlDiff(addStylesheet=False)
+
+# Fast path for short single token values (capacity, min_age, operator:type, ...):
+# the diff of two such tokens only depends on the tokens themselves, so the diff of two sentinel tokens is used as a
+# template. The template is checked against the full diff of a few typical values before it is used.
+reg_single_token = re.compile(r'[A-Za-z0-9]{1,32}\Z')
+token_sentinels = ('qqqqqqqq', 'zzzzzzzz')
+reg_token_sentinels = re.compile('|'.join(token_sentinels))
+token_template = None           # None: not yet created, False: fast path disabled
+def get_token_template():
+    global token_template
+    if token_template is None:
+        token_template = htmldiff_full(*token_sentinels)
+        if any(token_template.count(sentinel) != 1 for sentinel in token_sentinels):
+            token_template = False
+        else:
+            for a, b in (('10', '12'), ('3', '5'), ('private', 'public'), ('yes', 'no'), ('18', 'Yes')):
+                if fill_token_template(token_template, a, b) != htmldiff_full(a, b):
+                    token_template = False
+                    break
+        logger.debug('htmldiff fast path for single tokens enabled = %s', token_template is not False)
+    return token_template
+
+def fill_token_template(template, a, b):
+    return reg_token_sentinels.sub(lambda reg: a if reg.group(0) == token_sentinels[0] else b, template)
+
+@functools.lru_cache(maxsize=65536)
+def my_htmldiff(a, b):
+    """Returns the html diff of the strings a and b (cached)"""
+    if a != b and reg_single_token.match(a) and reg_single_token.match(b):
+        template = get_token_template()
+        if template is not False:
+            return fill_token_template(template, a, b)
+    return htmldiff_full(a, b)
 
 link_template = u'<a href="{href}"\ntitle="{title}">{text}</a>'
 # base_url = 'http://obtitus.github.io/barnehagefakta_osm_data/'
@@ -52,6 +97,9 @@ def not_empty_file(filename, ignore_missing_file=False):
             logger.warning('file does not exists "%s", %s', filename, e)
     return False
 def get_lat_lon(osm, osm_data):
+    if isinstance(osm_data, IndexedElement): # position already found by nsrid_index
+        return osm_data.position
+
     way = None
     node = None
     if isinstance(osm_data, osmapis.Relation):
@@ -101,16 +149,22 @@ def create_pre(dict1, dict_compare, mark_missing_key=True, ignore_keys=('ADDRESS
     tags += '</pre>'
     return tags
 
-def create_osm_url(osm_data):
-    if isinstance(osm_data, osmapis.Node):
-        osm_type_str = 'node'
+def get_osm_type(osm_data):
+    """Returns 'node', 'way' or 'relation' for the osmapis element or nsrid_index.IndexedElement"""
+    if isinstance(osm_data, IndexedElement):
+        return osm_data.type
+    elif isinstance(osm_data, osmapis.Node):
+        return 'node'
     elif isinstance(osm_data, osmapis.Way):
-        osm_type_str = 'way'
+        return 'way'
     elif isinstance(osm_data, osmapis.Relation):
-        osm_type_str = 'relation'
+        return 'relation'
     else:
         raise ValueError('osm_data type not recognized, %s, %s', type(osm_data), osm_data)
 
+def create_osm_url(osm_data):
+    osm_type_str = get_osm_type(osm_data)
+
     osm_id = osm_data.attribs['id']
     full = ''
     if osm_type_str != 'node':
@@ -243,22 +297,151 @@ def create_rows(osm, data):
     return table, count_osm, count_duplicate_osm
         #yield row
 
+@profile_report.timed('render')
+def create_page(osm, folder, template, page_filename, warning_filename, discontinued_filename,
+                kommune_nr, kommune_name, last_update):
+    """Renders the page for a single kommune folder to page_filename (if it contains any kindergartens),
+    returns the tuple (number of rows, count_osm, count_duplicate_osm, list of nsrids)"""
+    logger.info('Kommune folder = %s', folder)
+
+    table = list()
+    nsrids = list()
+    info = ''
+    info_warning = ''
+    count_osm = 0
+    count_duplicate_osm = 0
+    for filename, data in update_osm.get_osm_files(folder):
+        t, c_osm, c_duplicate_osm = create_rows(osm, data)
+        table.extend(t)
+        nsrids.extend(kindergarten.tags['no-barnehage:nsrid'] for kindergarten in data)
+        count_osm += c_osm
+        count_duplicate_osm += c_duplicate_osm
+        filename_base = os.path.basename(filename)
+        if filename.endswith('barnehagefakta.osm'):
+            link = u'<a href="{href}"\ntitle="{title}">\n{text}</a>'.format(href=filename,
+                                                                            title=u"Trykk for å laste ned "+ filename_base,
+                                                                            text=filename_base)
+            info += u'<p>{link} inneholder data fra NBR som noder, denne kan åpnes i JOSM.</p>'.format(link=link)
+
+        if filename.endswith('barnehagefakta_familiebarnehager.osm'):
+            link = u'<a href="{href}"\ntitle="{title}">\n{text}</a>'.format(href=filename,
+                                                                            title=u"Trykk for å laste ned "+filename_base,
+                                                                            text=filename_base)
+            info += u'<p>Familiebarnehager er vanskeligere å kartlegge, disse ligger derfor i sin egen fil: {link}</p>'.format(link=link)
+
+
+    if not_empty_file(warning_filename):
+        link = u'<a href="{href}"\ntitle="{title}">\n{text}</a>'.format(href=warning_filename,
+                                                                        title=u"Sjekk gjerne warnings.log",
+                                                                        text='warnings.log')
+        info_warning += u'<p>Sjekk gjerne {0}</p>\n'.format(link)
+
+    if not_empty_file(discontinued_filename, ignore_missing_file=True):
+        link = u'<a href="{href}"\ntitle="{title}">\n{text}</a>'.format(href=discontinued_filename,
+                                                                        title=u"Sjekk gjerne discontinued.csv",
+                                                                        text='discontinued.csv')
+        info_warning += u'<p>Sjekk gjerne {0} for barnehager i nbr sitt register som ikke ligger i barnehagefakta.no</p>\n'.format(link)
+
+    if len(table) != 0:
+        page = template.render(kommune_name=kommune_name,
+                               kommune_nr=kommune_nr,
+                               table=table, info=info,
+                               info_warning=info_warning,
+                               last_update=last_update)
+        # Kommune-folder
+        with open_utf8(page_filename, 'w') as output:
+            output.write(page)
+
+    return len(table), count_osm, count_duplicate_osm, nsrids
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def overpass_fingerprint(osm, nsrids):
+    """Returns a hash of the parts of the overpass result used by create_rows for the given nsrids
+    (the elements, their tags and position), None if osm is None"""
+    if osm is None:
+        return None
+    h = hashlib.sha1()
+    for nsrid in sorted(nsrids):
+        for item in osm.nsrids.get(nsrid, []):
+            try:
+                lat_lon = get_lat_lon(osm, item)
+            except Exception:
+                lat_lon = None
+            key = (nsrid, get_osm_type(item), str(item.attribs.get('id')), sorted(item.tags.items()), lat_lon)
+            h.update(repr(key).encode('utf8'))
+    return h.hexdigest()
+
+def load_manifest(filename):
+    """Returns the manifest written by the previous main call, see main"""
+    try:
+        with open_utf8(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.info('No usable manifest %s, regenerating all pages. %s', filename, e)
+        return dict()
+
+worker_state = dict()           # osm and template for the render_pages workers, inherited when forked
+
+def create_page_worker(kwargs):
+    return create_page(worker_state['osm'], template=worker_state['template'], **kwargs)
+
+def render_pages(osm, template, tasks, jobs=1):
+    """Runs create_page for each (kommune_nr, create_page keyword arguments) in tasks,
+    yields the tuple (kommune_nr, result) in the same order as tasks.
+    With jobs > 1 the pages are rendered by a pool of forked processes,
+    such that osm and template are shared with the workers instead of being pickled for each page."""
+    if jobs <= 1:
+        for kommune_nr, kwargs in tasks:
+            yield kommune_nr, create_page(osm, template=template, **kwargs)
+        return
+
+    worker_state.update(osm=osm, template=template)
+    try:
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+            futures = [(kommune_nr, executor.submit(create_page_worker, kwargs)) for kommune_nr, kwargs in tasks]
+            for kommune_nr, future in futures:
+                yield kommune_nr, future.result()
+    finally:
+        worker_state.clear()
+
 def main(osm, data_dir='data', root_output='',
-         root=''):
+         root='', force=False, jobs=1):
+    """Generates a page for each kommune folder below data_dir and the index.html.
+    The inputs of each page (hashes of the .osm files and the templates, the relevant overpass elements, ...)
+    and its summary counts are recorded in root_output/generate_html_manifest.json,
+    a page is only regenerated if its inputs have changed (or force is True).
+    With jobs > 1 the pages are rendered in parallel, see render_pages."""
 
     index_template = os.path.join(root, 'templates', 'index_template.html')
     template = os.path.join(root, 'templates', 'kommune_page_template.html')
+    templates_hash = file_hash(template) + file_hash(index_template)
     
     with open_utf8(template) as f:
         template = Template(f.read())
     with open_utf8(index_template) as f:
         index_template = Template(f.read())
 
+    manifest_filename = os.path.join(root_output, 'generate_html_manifest.json')
+    manifest = dict()
+    if not(force):
+        manifest = load_manifest(manifest_filename)
+    previous = dict()
+    if manifest.get('templates') == templates_hash:
+        previous = manifest.get('kommuner', dict())
+    new_manifest = dict(templates=templates_hash, kommuner=dict())
+
     kommune_nr2name, kommune_name2nr = kommunenummer(cache_dir=data_dir)
     index_table = list()
     # counters for bottom of main table (what a mess)
     total_nbr = 0
     total_osm = 0
+    kommuner = list()           # (kommune_nr, kommune_name, page_filename) in index order
+    tasks = list()              # pages to regenerate, see render_pages
+    page_inputs = dict()
     for kommune_nr in sorted(os.listdir(data_dir)):
         folder = os.path.join(data_dir, kommune_nr)
         if os.path.isdir(folder):
@@ -275,72 +458,54 @@ def main(osm, data_dir='data', root_output='',
             last_update_stamp = os.path.getmtime(folder)
             last_update_datetime = datetime.fromtimestamp(last_update_stamp)
             last_update = last_update_datetime.strftime('%Y-%m-%d %H:%M')
-            
-            logger.info('Kommune folder = %s', folder)
-
-            table = list()
-            info = ''
-            info_warning = ''
-            count_osm = 0
-            count_duplicate_osm = 0
-            for filename, data in update_osm.get_osm_files(folder):
-                t, c_osm, c_duplicate_osm = create_rows(osm, data)
-                table.extend(t)
-                count_osm += c_osm
-                count_duplicate_osm += c_duplicate_osm
-                filename_base = os.path.basename(filename)
-                if filename.endswith('barnehagefakta.osm'):
-                    link = u'<a href="{href}"\ntitle="{title}">\n{text}</a>'.format(href=filename,
-                                                                                    title=u"Trykk for å laste ned "+ filename_base,
-                                                                                    text=filename_base)
-                    info += u'<p>{link} inneholder data fra NBR som noder, denne kan åpnes i JOSM.</p>'.format(link=link)
-                    
-                if filename.endswith('barnehagefakta_familiebarnehager.osm'):
-                    link = u'<a href="{href}"\ntitle="{title}">\n{text}</a>'.format(href=filename,
-                                                                                    title=u"Trykk for å laste ned "+filename_base,
-                                                                                    text=filename_base)
-                    info += u'<p>Familiebarnehager er vanskeligere å kartlegge, disse ligger derfor i sin egen fil: {link}</p>'.format(link=link)
-
-
-            if not_empty_file(warning_filename):
-                link = u'<a href="{href}"\ntitle="{title}">\n{text}</a>'.format(href=warning_filename,
-                                                                                title=u"Sjekk gjerne warnings.log",
-                                                                                text='warnings.log')
-                info_warning += u'<p>Sjekk gjerne {0}</p>\n'.format(link)
-
-            if not_empty_file(discontinued_filename, ignore_missing_file=True):
-                link = u'<a href="{href}"\ntitle="{title}">\n{text}</a>'.format(href=discontinued_filename,
-                                                                                title=u"Sjekk gjerne discontinued.csv",
-                                                                                text='discontinued.csv')
-                info_warning += u'<p>Sjekk gjerne {0} for barnehager i nbr sitt register som ikke ligger i barnehagefakta.no</p>\n'.format(link)
-                
-            if len(table) != 0:
-                total_nbr += len(table)
-                total_osm += count_osm
-                
-                per = (100.*count_osm)/len(table)
-                progress = '<meter style="width:100%" value="{value}" min="{min}" max="{max}" optimum="{max}">{per} %</meter>'\
-                           .format(value=count_osm,
-                                   min=0, max=len(table),
-                                   per=per)
-
-                count_duplicate_osm_str = '0'
-                if count_duplicate_osm != 0:
-                    count_duplicate_osm_str = '<p style="background-color:red">%s</p>' % count_duplicate_osm
-                
-                index_table.append((page_filename, u'Vis kommune', [kommune_nr, kommune_name, len(table), count_osm,
-                                                                    count_duplicate_osm_str, progress]))
-                
-                page = template.render(kommune_name=kommune_name,
-                                       kommune_nr=kommune_nr,
-                                       table=table, info=info,
-                                       info_warning=info_warning,
-                                       last_update=last_update)
-                # Kommune-folder
-                with open_utf8(page_filename, 'w') as output:
-                    output.write(page)
-                
-                    
+
+            inputs = dict(osm_files=dict((f, file_hash(os.path.join(folder, f)))
+                                         for f in sorted(os.listdir(folder)) if f.endswith('.osm')),
+                          warning=not_empty_file(warning_filename, ignore_missing_file=True),
+                          discontinued=not_empty_file(discontinued_filename, ignore_missing_file=True),
+                          kommune_name=kommune_name,
+                          last_update=last_update)
+            kommuner.append((kommune_nr, kommune_name, page_filename))
+            entry = previous.get(kommune_nr)
+            if entry is not None and entry['inputs'] == inputs \
+               and (entry['rows'] == 0 or os.path.exists(page_filename)) \
+               and entry['overpass'] == overpass_fingerprint(osm, entry['nsrids']):
+                logger.info('Kommune folder = %s unchanged, skipping', folder)
+                new_manifest['kommuner'][kommune_nr] = entry
+            else:
+                page_inputs[kommune_nr] = inputs
+                tasks.append((kommune_nr, dict(folder=folder, page_filename=page_filename,
+                                               warning_filename=warning_filename,
+                                               discontinued_filename=discontinued_filename,
+                                               kommune_nr=kommune_nr, kommune_name=kommune_name,
+                                               last_update=last_update)))
+
+    for kommune_nr, (rows, count_osm, count_duplicate_osm, nsrids) in render_pages(osm, template, tasks, jobs=jobs):
+        new_manifest['kommuner'][kommune_nr] = dict(inputs=page_inputs[kommune_nr], nsrids=nsrids,
+                                                    overpass=overpass_fingerprint(osm, nsrids),
+                                                    rows=rows, count_osm=count_osm,
+                                                    count_duplicate_osm=count_duplicate_osm)
+
+    for kommune_nr, kommune_name, page_filename in kommuner:
+        entry = new_manifest['kommuner'][kommune_nr]
+        rows, count_osm, count_duplicate_osm = entry['rows'], entry['count_osm'], entry['count_duplicate_osm']
+        if rows != 0:
+            total_nbr += rows
+            total_osm += count_osm
+
+            per = (100.*count_osm)/rows
+            progress = '<meter style="width:100%" value="{value}" min="{min}" max="{max}" optimum="{max}">{per} %</meter>'\
+                       .format(value=count_osm,
+                               min=0, max=rows,
+                               per=per)
+
+            count_duplicate_osm_str = '0'
+            if count_duplicate_osm != 0:
+                count_duplicate_osm_str = '<p style="background-color:red">%s</p>' % count_duplicate_osm
+
+            index_table.append((page_filename, u'Vis kommune', [kommune_nr, kommune_name, rows, count_osm,
+                                                                count_duplicate_osm_str, progress]))
+
     # total:
     per = (100.*total_osm)/total_nbr
     progress = '<meter style="width:100%" value="{value}" min="{min}" max="{max}" optimum="{max}">{per} %</meter>'\
@@ -372,10 +537,18 @@ def main(osm, data_dir='data', root_output='',
     with open_utf8(index, 'w') as output:
         output.write(page)
 
+    with open_utf8(manifest_filename, 'w') as output:
+        json.dump(new_manifest, output)
+
 
-def get_osm_data():
-    xml = update_osm.overpass_nsrid()
-    osm = osmapis.OSMnsrid.from_xml(xml)
+def get_osm_data(use_index=False, delta=False):
+    """Returns the overpass no-barnehage:nsrid response as a osmapis_nsrid.OSMnsrid,
+    or as a nsrid_index.NsridIndex if use_index is True.
+    See update_osm.overpass_nsrid_cache for delta."""
+    if use_index:
+        osm = update_osm.overpass_nsrid_index(delta=delta)
+    else:
+        osm = osmapis.OSMnsrid.from_file(update_osm.overpass_nsrid_cache(delta=delta))
     # osm_elements = list(update_osm.find_all_nsrid_osm_elements(osm))
     print('Overpass returned', len(osm.nsrids), 'objects')#, osm.nsrids
 
@@ -397,16 +570,26 @@ if __name__ == '__main__':
                         help="Specify input/output directory, defaults to current directory. Expects a templates folder with required html and javascript templates")
     parser.add_argument('--no-overpass', default=False, action='store_true',
                         help="Do not call the openstreetmap overpass api looking for no-barnehage:nsrid")
+    parser.add_argument('--overpass_index', default=False, action='store_true',
+                        help="Read the overpass response through a compact index (see nsrid_index.py, requires numpy) instead of parsing the full xml")
+    parser.add_argument('--overpass_delta', default=False, action='store_true',
+                        help="Refresh the cached overpass response by only requesting the changes since it was downloaded (an augmented diff)")
+    parser.add_argument('--force', default=False, action='store_true',
+                        help="Regenerate all pages, even if their input has not changed since the last run (see generate_html_manifest.json)")
+    parser.add_argument('--jobs', default=1, type=int,
+                        help="Number of kommune pages to render in parallel (separate processes), defaults to 1")
     argparse_util.add_verbosity(parser, default=logging.WARNING)
 
+    profile_report.add_argument(parser)
     args = parser.parse_args()
+    profile_report.enable(args.profile_report, 'generate_html.py')
     
     logging.basicConfig(level=args.loglevel)
 
     if args.no_overpass:
         osm = None
     else:
-        osm = get_osm_data()
+        osm = get_osm_data(use_index=args.overpass_index, delta=args.overpass_delta)
     
     main(osm, args.data_dir,
-         root=args.root)
+         root=args.root, force=args.force, jobs=args.jobs)
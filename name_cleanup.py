@@ -2,14 +2,57 @@
 # -*- coding: utf8
 
 import re
+import functools
 import logging
 logger = logging.getLogger('barnehagefakta.name_cleanup')
+# This project
+import profile_report
 
+#
+# Rules, compiled once. Each group of rules has a combined regex that is checked first,
+# such that the (order dependent) individual rules only run for names where at least one of them can match.
+#
+flags = re.IGNORECASE|re.UNICODE
+
+def compile_group(words):
+    """Returns the compiled (word, end_regex, middle_regex) for each word, matching the word
+    with whitespace in front and either the end of the string or whitespace after,
+    and the combined regex matching any of them"""
+    rules = [(word,
+              re.compile(r'([\s]%s$)' % word, flags=flags),
+              re.compile(r'([\s]%s[\s])' % word, flags=flags)) for word in words]
+    combined = re.compile(r'[\s](?:%s)(?:[\s]|$)' % '|'.join(words), flags=flags)
+    return rules, combined
+
+# Replace shorthands
+barnehage_shorthands, barnehage_shorthands_any = compile_group(('Bhg', 'Barne'))
+# remove AS, Sa
+company_shorts, company_shorts_any = compile_group(('AS', 'Sa', 'A/s', 'Da', 'Ba', 'Ans', 'Ltd', 'Ikb', 'Ved', 'Si'))
+# lowercase for barnehageenhet, naturbarnehage, oppvekstsenter, familiebarnehage, ...
+reg_barnehage = re.compile(r'([\w]*barnehage[\w]*)', flags=flags)
+# Lower case for a bunch of other cases
+lower_cases = ('oppvekstsenter', 'menighet[s]?', 'barnehave', u'åpen', u'åpne', 'grendehus',
+               'terrasse', u'gård', 'privat', 'kultur', 'skole', 'skoleordning',
+               'natur', 'kirke[s]?', 'kommunale', u'Oppvekstområde', 'Oppvekst',
+               'Of', 'musikk', 'familie', 'kristelig[e]?', 'vei')
+lower_case_regs = [re.compile('(%s)' % case, flags=flags) for case in lower_cases]
+lower_cases_any = re.compile('|'.join(lower_cases), flags=flags)
+# avd. for Avd, avd and Avdeling
+reg_avd = re.compile(' (avd[.]?) ', flags=flags)
+reg_avdeling = re.compile(' (Avdeling) ', flags=flags)
+
+abbrevs = frozenset(('fus', 'sfo', 'nlm', 'kfum', 'kfuk', 'hf'))
+capitalize = frozenset(('montessori', 'steinerbarnehage'))
+remove = frozenset(('Ved', ))
+
+@profile_report.timed('name_cleanup')
 def name_cleanup(name, log_filehandle=None, operator=''):
     u"""Attempt at sanitizing the name from ssr by mainly forcing sane capitalization and removing company designations AS/SA/...
     Doctest:
     >>> name_cleanup('')
     ''
+    >>> name_cleanup(' \t')
+    ''
     >>> name_cleanup('Hei')
     'Hei'
     >>> name_cleanup('Hei ')
@@ -69,64 +112,84 @@ def name_cleanup(name, log_filehandle=None, operator=''):
     >>> print(name_cleanup(u'Gydas Vei barnehage'))
     Gydas vei barnehage
     """
-    #name = name.decode('utf8')
     old_name = name
-    
+    if name.strip() == '':
+        return ''
+    name = cleanup(name)
+
+    if name != old_name:
+        logger.debug('name cleanup %s -> %s', old_name, name)
+
+    if log_filehandle is not None and old_name != name:
+        log_filehandle.write('"%s", "%s"\n' % (old_name, name))
+    return name
+
+def name_cleanup_batch(names, log_filehandle=None):
+    u"""Returns the list of cleaned names for the given list of names, see name_cleanup.
+    Each distinct name is only cleaned once.
+    >>> name_cleanup_batch(['Foo Barnehage AS', 'hei Oppvekstsenter', 'Foo Barnehage AS'])
+    ['Foo barnehage', 'Hei oppvekstsenter', 'Foo barnehage']
+    """
+    done = dict()
+    ret = list()
+    for name in names:
+        if name not in done:
+            done[name] = name_cleanup(name, log_filehandle)
+        ret.append(done[name])
+    return ret
+
+@functools.lru_cache(maxsize=4096)
+def cleanup(name):
+    """The rules of name_cleanup, without any logging (the result is cached)"""
     name = name.strip()
     if name == '':
         return ''
 
     # Replace shorthands
-    barnehage_shorthands = ('Bhg', 'Barne')
-    for short in barnehage_shorthands:
-        reg1 = re.search('([\s]%s$)' % short, name, flags=re.IGNORECASE|re.UNICODE)
-        reg2 = re.search('([\s]%s[\s])' % short, name, flags=re.IGNORECASE|re.UNICODE)
-        if reg1:
-            name = name.replace(reg1.group(1), 'barnehage')
-        if reg2:
-            name = name.replace(reg2.group(1), 'barnehage')
-    
+    if barnehage_shorthands_any.search(name):
+        for short, reg_end, reg_middle in barnehage_shorthands:
+            reg1 = reg_end.search(name)
+            reg2 = reg_middle.search(name)
+            if reg1:
+                name = name.replace(reg1.group(1), 'barnehage')
+            if reg2:
+                name = name.replace(reg2.group(1), 'barnehage')
+
     # remove AS, Sa
-    for company_short in('AS', 'Sa', 'A/s', 'Da', 'Ba', 'Ans', 'Ltd', 'Ikb', 'Ved', 'Si'):
-        # company_short at end of string with space in front:
-        reg1 = re.search('([\s]%s$)' % company_short, name, flags=re.IGNORECASE|re.UNICODE)
-        # company_short with spaces on both sides:
-        reg2 = re.search('([\s]%s[\s])' % company_short, name, flags=re.IGNORECASE|re.UNICODE)
-        if reg1:
-            name = name.replace(reg1.group(1), '')
-        if reg2:
-            name = name.replace(reg2.group(1), ' ')
-        # name = name.replace(company_short, '')
-        # name = name.replace(company_short.lower(), '')
+    if company_shorts_any.search(name):
+        for company_short, reg_end, reg_middle in company_shorts:
+            # company_short at end of string with space in front:
+            reg1 = reg_end.search(name)
+            # company_short with spaces on both sides:
+            reg2 = reg_middle.search(name)
+            if reg1:
+                name = name.replace(reg1.group(1), '')
+            if reg2:
+                name = name.replace(reg2.group(1), ' ')
 
     # Fixme: learn reg-replace?
     # lowercase for barnehageenhet, naturbarnehage, oppvekstsenter, familiebarnehage, ...
-    for reg in re.finditer('([\w]*barnehage[\w]*)', name, flags=re.IGNORECASE|re.UNICODE):
+    for reg in reg_barnehage.finditer(name):
         name = name.replace(reg.group(1), reg.group(1).lower())
 
     # Lower case for a bunch of other cases
-    for case in ('oppvekstsenter', 'menighet[s]?', 'barnehave', u'åpen', u'åpne', 'grendehus',
-                 'terrasse', u'gård', 'privat', 'kultur', 'skole', 'skoleordning',
-                 'natur', 'kirke[s]?', 'kommunale', u'Oppvekstområde', 'Oppvekst',
-                 'Of', 'musikk', 'familie', 'kristelig[e]?', 'vei'):
-        reg = re.search('(%s)' % case, name, flags=re.IGNORECASE|re.UNICODE)
-        if reg:
-            name = name.replace(reg.group(1), reg.group(1).lower())
-        
+    if lower_cases_any.search(name):
+        for reg_case in lower_case_regs:
+            reg = reg_case.search(name)
+            if reg:
+                name = name.replace(reg.group(1), reg.group(1).lower())
+
     # avd. for Avd, avd
-    reg = re.search(' (avd[.]?) ', name, flags=re.IGNORECASE|re.UNICODE)
+    reg = reg_avd.search(name)
     if reg:
         name = name.replace(reg.group(1), "avd.")
 
     # avd. for Avdelig
-    reg = re.search(' (Avdeling) ', name, flags=re.IGNORECASE|re.UNICODE)
+    reg = reg_avdeling.search(name)
     if reg:
         name = name.replace(reg.group(1), "avd.")
-        
+
     new_name = []
-    abbrevs = ('fus', 'sfo', 'nlm', 'kfum', 'kfuk', 'hf')
-    capitalize = ('montessori', 'steinerbarnehage')
-    remove = ('Ved', )
     for word in name.split():
         word_low = word.lower()
         if word_low in abbrevs:
@@ -143,18 +206,10 @@ def name_cleanup(name, log_filehandle=None, operator=''):
 
     if new_name[0].lower() not in abbrevs:
         new_name[0] = new_name[0].capitalize()
-    
+
     name = " ".join(new_name)
-    #name = name[0].upper() + name[1:]
 
     name = name.replace('i / Ii', 'i / Ii'.upper())
-
-    #print(old_name, name)
-    if name != old_name:
-        logger.debug('name cleanup %s -> %s', old_name, name)
-
-    if log_filehandle is not None and old_name != name:
-        log_filehandle.write('"%s", "%s"\n' % (old_name, name))
     return name
 
 if __name__ == '__main__':
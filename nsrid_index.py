@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf8
+
+"""Compact, memory-mappable index of the overpass no-barnehage:nsrid response,
+for the read-only users of the overpass data (e.g. generate_html.py --overpass_index).
+The index consists of two files: filename (a numpy .npy array with one row per element,
+sorted by nsrid) and filename.json (the attribs and tags of each element as utf8 json, referenced by byte offsets).
+Looking up an nsrid only decodes the matching elements, no osmapis objects are created."""
+# Standard python imports
+import os
+import json
+import mmap
+try:
+    from collections.abc import Mapping
+except ImportError:             # python2
+    from collections import Mapping
+import logging
+logger = logging.getLogger('barnehagefakta.nsrid_index')
+# Non-standard imports
+import numpy as np
+# This project
+import osmapis_nsrid as osmapis
+
+element_types = ('node', 'way', 'relation')
+nan = float('nan')
+
+def element_type(element):
+    if isinstance(element, osmapis.Node):
+        return 'node'
+    elif isinstance(element, osmapis.Way):
+        return 'way'
+    elif isinstance(element, osmapis.Relation):
+        return 'relation'
+    raise ValueError('expected osmapis.Relation/Way/Node object, got %s' % type(element))
+
+def element_position(osm, element):
+    """Returns the (lat, lon) attribs of the node, the first node of the way
+    or the first node of the first way in the relation, None if not found"""
+    try:
+        if isinstance(element, osmapis.Relation):
+            element = osm.ways[element.members[0]['ref']]
+        if isinstance(element, osmapis.Way):
+            element = osm.nodes[element.nds[0]]
+        return element.attribs['lat'], element.attribs['lon']
+    except (KeyError, IndexError, AttributeError, TypeError):
+        return None
+
+class IndexedElement(object):
+    """A single element from the index, with the same attribs and tags as the osmapis element.
+    type is 'node', 'way' or 'relation' and position is as element_position"""
+    __slots__ = ('nsrid', 'type', 'attribs', 'tags', 'position')
+
+    def __init__(self, nsrid, type, attribs, tags, position):
+        self.nsrid = nsrid
+        self.type = type
+        self.attribs = attribs
+        self.tags = tags
+        self.position = position
+
+    def __repr__(self):
+        return '<IndexedElement %s %s nsrid=%s>' % (self.type, self.attribs.get('id'), self.nsrid)
+
+class NsridMapping(Mapping):
+    """nsrid -> list of IndexedElement, the equivalent of OSMnsrid.nsrids"""
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, nsrid):
+        elements = self.index.lookup(nsrid)
+        if len(elements) == 0:
+            raise KeyError(nsrid)
+        return elements
+
+    def __contains__(self, nsrid):
+        start, end = self.index.rows(nsrid)
+        return start != end
+
+    def __iter__(self):
+        return iter(self.index.keys())
+
+    def __len__(self):
+        return len(self.index.keys())
+
+class NsridIndex(object):
+    """Use NsridIndex.build(osm).save(filename) once and NsridIndex.load(filename) in each tool.
+
+    >>> xml = '''<osm version="0.6">
+    ... <node id="1" version="2" lat="59.9" lon="10.7"><tag k="no-barnehage:nsrid" v="42"/><tag k="name" v="A"/></node>
+    ... <node id="2" version="1" lat="60.1" lon="11.1"/>
+    ... <way id="3" version="5"><nd ref="2"/><tag k="no-barnehage:nsrid" v="7"/></way>
+    ... </osm>'''
+    >>> index = NsridIndex.build(osmapis.OSMnsrid.from_xml(xml))
+    >>> len(index.nsrids), '42' in index.nsrids, '43' in index.nsrids
+    (2, True, False)
+    >>> way = index.nsrids['7'][0]
+    >>> way.type, way.tags['no-barnehage:nsrid'], index.records['lat'][index.rows('7')[0]]
+    ('way', '7', 60.1)
+    """
+    dtype = [('type', 'i1'), ('id', 'i8'), ('version', 'i4'),
+             ('lat', 'f8'), ('lon', 'f8'), ('data_start', 'i8'), ('data_end', 'i8')]
+
+    def __init__(self, records, data):
+        self.records = records  # numpy structured array, sorted by nsrid
+        self.data = data        # bytes-like, the json encoded attribs and tags
+        self._keys = None
+        self.nsrids = NsridMapping(self)
+
+    @classmethod
+    def build(cls, osm):
+        """Returns a (in memory) NsridIndex of all elements in the osmapis_nsrid.OSMnsrid osm with a nsrid"""
+        items = list()
+        for nsrid, elements in osm.nsrids.items():
+            for element in elements:
+                items.append((nsrid, element))
+        items.sort(key=lambda item: item[0].encode('utf8'))
+
+        width = max([len(nsrid.encode('utf8')) for nsrid, _ in items] + [1])
+        dtype = np.dtype([('nsrid', 'S%d' % width)] + cls.dtype)
+        records = np.zeros(len(items), dtype=dtype)
+        data = list()
+        offset = 0
+        for row, (nsrid, element) in enumerate(items):
+            position = element_position(osm, element)
+            blob = json.dumps(dict(attribs=element.attribs, tags=element.tags, position=position),
+                              default=str).encode('utf8')
+            lat, lon = (nan, nan) if position is None else position
+            records[row] = (nsrid.encode('utf8'), element_types.index(element_type(element)),
+                            int(element.attribs['id']), int(element.attribs.get('version', 0)),
+                            float(lat), float(lon), offset, offset + len(blob))
+            data.append(blob)
+            offset += len(blob)
+        return cls(records, b''.join(data))
+
+    @classmethod
+    def from_xml(cls, xml):
+        return cls.build(osmapis.OSMnsrid.from_xml(xml))
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            np.save(f, self.records)
+        with open(filename + '.json', 'wb') as f:
+            f.write(self.data)
+
+    @classmethod
+    def load(cls, filename):
+        """Memory maps the files written by save"""
+        records = np.load(filename, mmap_mode='r')
+        data_filename = filename + '.json'
+        if os.path.getsize(data_filename) == 0: # mmap does not handle empty files
+            return cls(records, b'')
+        with open(data_filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(records, data)
+
+    def keys(self):
+        if self._keys is None:
+            self._keys = [key.decode('utf8') for key in np.unique(self.records['nsrid'])]
+        return self._keys
+
+    def rows(self, nsrid):
+        """Returns the (start, end) rows of the given nsrid"""
+        key = nsrid.encode('utf8')
+        column = self.records['nsrid']
+        if len(key) > column.dtype.itemsize:
+            return 0, 0
+        return (int(np.searchsorted(column, key, side='left')),
+                int(np.searchsorted(column, key, side='right')))
+
+    def element(self, row):
+        record = self.records[row]
+        dct = json.loads(self.data[record['data_start']:record['data_end']].decode('utf8'))
+        position = dct['position']
+        if position is not None:
+            position = tuple(position)
+        return IndexedElement(record['nsrid'].decode('utf8'), element_types[record['type']],
+                              dct['attribs'], dct['tags'], position)
+
+    def lookup(self, nsrid):
+        """Returns the list of IndexedElement with the given nsrid (empty if not found)"""
+        start, end = self.rows(nsrid)
+        return [self.element(row) for row in range(start, end)]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        for row in range(len(self.records)):
+            yield self.element(row)
+
+def load_or_build(xml_filename, index_filename=None):
+    """Returns the NsridIndex for the overpass response in xml_filename,
+    the index is stored as index_filename (defaults to xml_filename + '.npy')
+    and rebuilt if it is older than the xml file"""
+    if index_filename is None:
+        index_filename = xml_filename + '.npy'
+    if os.path.exists(index_filename) and os.path.exists(index_filename + '.json') \
+       and os.path.getmtime(index_filename) >= os.path.getmtime(xml_filename):
+        return NsridIndex.load(index_filename)
+
+    logger.info('Building %s from %s', index_filename, xml_filename)
+    index = NsridIndex.build(osmapis.OSMnsrid.from_file(xml_filename))
+    index.save(index_filename)
+    return NsridIndex.load(index_filename)
@@ -1,3 +1,5 @@
+import copy
+import xml.etree.ElementTree as ET
 import logging
 logger = logging.getLogger('barnehagefakta.osmapis_nsrid')
 
@@ -5,6 +7,7 @@ logger = logging.getLogger('barnehagefakta.osmapis_nsrid')
 # from utility_to_osm.osmapis.osmapis import *
 #from osmapis import *
 from utility_to_osm import osmapis
+import profile_report
 
 Node = osmapis.Node
 Relation = osmapis.Relation
@@ -43,4 +46,178 @@ class OSMnsrid(osmapis.OSM):
             
         return super(OSMnsrid, self).discard(item)
 
+    @classmethod
+    @profile_report.timed('xml_parse')
+    def from_file(cls, filename, predicate=None):
+        """Parses the .osm file incrementally, without reading the whole file or building the full tree,
+        each element is added as soon as it has been parsed.
+        If predicate is given, only the elements where predicate(tags) is True are kept,
+        together with the nodes and ways they reference (this reads the file twice).
+        Example usage
+        o = OSMnsrid.from_file('overpass.osm', predicate=has_nsrid)"""
+        keep = None
+        if predicate is not None:
+            keep = find_references(filename, predicate)
+
+        osm = cls()
+        for elem in iter_elements(filename):
+            if keep is not None and elem.get('id') not in keep[elem.tag]:
+                continue
+            osm.add(osmapis.wrappers[elem.tag].from_xml(elem))
+        return osm
+
 osmapis.wrappers["osm"] = OSMnsrid
+
+def has_nsrid(tags):
+    return 'no-barnehage:nsrid' in tags
+
+def iter_elements(filename):
+    """Yields each node, way and relation element in the .osm file as it is parsed,
+    the element is cleared after use such that the tree never grows"""
+    root = None
+    for event, elem in ET.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        if elem.tag in ('node', 'way', 'relation'):
+            yield elem
+            root.clear()        # remove the parsed elements, only the (empty) root is kept
+
+def osm_base(filename):
+    """Returns the overpass timestamp of the .osm file, <meta osm_base="..."/>, or None if not given"""
+    for event, elem in ET.iterparse(filename, events=('start', )):
+        if elem.tag == 'meta':
+            return elem.get('osm_base')
+        if elem.tag in ('node', 'way', 'relation'): # meta comes first
+            return None
+    return None
+
+def element_key(elem):
+    return elem.tag, elem.get('id')
+
+def apply_augmented_diff(filename, adiff, output_filename):
+    """Applies the overpass augmented diff (the xml string adiff, see https://wiki.openstreetmap.org/wiki/Overpass_API/Augmented_Diffs)
+    to the .osm file filename, writing the result to output_filename with the osm_base timestamp of the diff.
+    Modified elements are replaced where they are, created elements are added at the end,
+    as are modified elements not in filename (e.g. an element that got a no-barnehage:nsrid tag), counted as upserted.
+    Returns the tuple (created, modified, deleted, upserted) counts."""
+    root = ET.fromstring(adiff)
+    timestamp = None
+    changes = dict()            # (tag, id) -> (action, new element or None if deleted)
+    for child in root:
+        if child.tag == 'meta':
+            timestamp = child.get('osm_base')
+        if child.tag != 'action':
+            continue
+        action = child.get('type')
+        old, new = child.find('old'), child.find('new')
+        if action == 'create':
+            elem = child[0] if new is None else new[0]
+            changes[element_key(elem)] = (action, elem)
+        elif action == 'modify':
+            changes[element_key(new[0])] = (action, new[0])
+        elif action == 'delete':
+            elem = child[0] if old is None else old[0]
+            changes[element_key(elem)] = (action, None)
+        else:
+            raise ValueError('Unknown augmented diff action %s' % action)
+    if timestamp is None:
+        raise ValueError('No <meta osm_base="..."/> found in the augmented diff')
+
+    counts = dict(created=0, modified=0, deleted=0, upserted=0)
+    with open(output_filename, 'wb') as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(b'<osm version="0.6" generator="osmapis_nsrid.apply_augmented_diff">\n')
+        f.write(ET.tostring(ET.Element('meta', osm_base=timestamp)) + b'\n')
+        for elem in iter_elements(filename):
+            key = element_key(elem)
+            if key in changes:
+                _, elem = changes.pop(key)
+                if elem is None:
+                    counts['deleted'] += 1
+                    continue
+                counts['modified'] += 1
+            elem.tail = '\n'
+            f.write(ET.tostring(elem))
+
+        for key, (action, elem) in changes.items():
+            if elem is None:
+                logger.debug('Deleted %s %s is not in %s', key[0], key[1], filename)
+                continue
+            if action == 'modify':
+                logger.debug('Modified %s %s is not in %s, adding it', key[0], key[1], filename)
+                counts['upserted'] += 1
+            else:
+                counts['created'] += 1
+            elem.tail = '\n'
+            f.write(ET.tostring(elem))
+        f.write(b'</osm>\n')
+    return counts['created'], counts['modified'], counts['deleted'], counts['upserted']
+
+def find_references(filename, predicate):
+    """Returns a dictionary from 'node', 'way' and 'relation' to the set of ids (as strings)
+    of the elements where predicate(tags) is True and the elements these reference,
+    the nodes of the ways in a relation are included"""
+    keep = dict(node=set(), way=set(), relation=set())
+    way_nds = dict()
+    for elem in iter_elements(filename):
+        tags = dict((tag.get('k'), tag.get('v')) for tag in elem.findall('tag'))
+        if elem.tag == 'way':
+            way_nds[elem.get('id')] = [nd.get('ref') for nd in elem.findall('nd')]
+
+        if not(predicate(tags)):
+            continue
+        keep[elem.tag].add(elem.get('id'))
+        if elem.tag == 'relation':
+            for member in elem.findall('member'):
+                if member.get('type') in keep:
+                    keep[member.get('type')].add(member.get('ref'))
+
+    for way_id in keep['way']:
+        keep['node'].update(way_nds.get(way_id, ()))
+    return keep
+
+class NsridSnapshot(object):
+    """A parsed overpass no-barnehage:nsrid response, parsed once per session.
+    Use view(nsrid) to get small (original, modified) OSMnsrid objects containing
+    copies of the elements with the given nsrid, the snapshot itself is never modified.
+    Example usage
+    snapshot = NsridSnapshot.from_xml(xml)
+    osm_original, osm = snapshot.view('3234487807')"""
+
+    def __init__(self, osm):
+        self.osm = osm
+        self.nsrids = osm.nsrids
+
+    @classmethod
+    def from_xml(cls, xml):
+        return cls(OSMnsrid.from_xml(xml))
+
+    @classmethod
+    def from_file(cls, filename, predicate=None):
+        """See OSMnsrid.from_file"""
+        return cls(OSMnsrid.from_file(filename, predicate=predicate))
+
+    def __len__(self):
+        return len(self.nsrids)
+
+    def __contains__(self, nsrid):
+        return nsrid in self.nsrids
+
+    def get(self, nsrid, default=None):
+        """Returns the (shared, do not modify) list of elements with the given nsrid"""
+        return self.nsrids.get(nsrid, default)
+
+    def view(self, nsrid):
+        """Returns the tuple (original, modified) of OSMnsrid objects, each with its own copy
+        of the elements tagged no-barnehage:nsrid=nsrid, modify the latter and
+        use OSC.from_diff(original, modified) to get the changes.
+        The cost is proportional to the number of matching elements, not the size of the snapshot."""
+        elements = self.nsrids.get(nsrid, [])
+        original = OSMnsrid()
+        modified = OSMnsrid()
+        for item in elements:
+            original.add(copy.deepcopy(item))
+            modified.add(copy.deepcopy(item))
+        return original, modified
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf8
+
+"""Lightweight stage timers, counters and byte totals for the command line tools.
+Disabled by default (the timers then cost a single attribute lookup), enabled by --profile-report,
+which writes a json summary and logs a human readable table when the program exits.
+Example usage
+with profile_report.timer('http_fetch'):
+    r = request_session.get(url)
+profile_report.add_bytes('http_fetch', len(r.content))
+profile_report.count('cache_hit')"""
+# Standard python imports
+import time
+import json
+import atexit
+import threading
+import functools
+import logging
+logger = logging.getLogger('barnehagefakta.profile_report')
+
+class Timer(object):
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.profile.add_time(self.name, time.time() - self.start)
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+null_timer = NullTimer()
+
+class Profile(object):
+    """Thread safe accumulator of timers (name -> [calls, seconds]), counters and byte totals.
+
+    >>> p = Profile()
+    >>> p.enabled = True
+    >>> with p.timer('parse'):
+    ...     pass
+    >>> p.count('cache_hit', 2)
+    >>> p.add_bytes('http_fetch', 1024)
+    >>> s = p.summary()
+    >>> s['timers']['parse']['calls'], s['counters'], s['bytes']
+    (1, {'cache_hit': 2}, {'http_fetch': 1024})
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timers = dict()
+        self.counters = dict()
+        self.bytes = dict()
+
+    def timer(self, name):
+        if not(self.enabled):
+            return null_timer
+        return Timer(self, name)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_bytes(self, name, n):
+        if self.enabled:
+            with self.lock:
+                self.bytes[name] = self.bytes.get(name, 0) + n
+
+    def summary(self):
+        with self.lock:
+            timers = dict()
+            for name, (calls, seconds) in self.timers.items():
+                timers[name] = dict(calls=calls, seconds=seconds)
+            return dict(wall_seconds=time.time() - self.started,
+                        timers=timers, counters=dict(self.counters), bytes=dict(self.bytes))
+
+    def table(self, summary=None):
+        """Returns the summary as a human readable table, the slowest stage first"""
+        if summary is None:
+            summary = self.summary()
+        lines = ['%-24s %10s %12s %12s' % ('stage', 'calls', 'seconds', 'ms/call')]
+        timers = summary['timers']
+        for name in sorted(timers, key=lambda name: -timers[name]['seconds']):
+            calls, seconds = timers[name]['calls'], timers[name]['seconds']
+            lines.append('%-24s %10d %12.3f %12.3f' % (name, calls, seconds, 1000*seconds/max(calls, 1)))
+        for name in sorted(summary['counters']):
+            lines.append('%-24s %10d' % (name, summary['counters'][name]))
+        for name in sorted(summary['bytes']):
+            lines.append('%-24s %10.1f MB' % (name, summary['bytes'][name]/1e6))
+        lines.append('%-24s %23.3f' % ('wall time', summary['wall_seconds']))
+        return '\n'.join(lines)
+
+    def report(self, filename, program=''):
+        summary = self.summary()
+        summary['program'] = program
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=1, sort_keys=True)
+        logger.warning('Profile report (also written to %s):\n%s', filename, self.table(summary))
+
+# global, used by all modules in this project
+profile = Profile()
+
+def timer(name):
+    """Returns a context manager adding the time spent to the stage name (does nothing if not enabled)"""
+    return profile.timer(name)
+
+def timed(name):
+    """Decorator version of timer"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile.timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    profile.count(name, n)
+
+def add_bytes(name, n):
+    profile.add_bytes(name, n)
+
+def add_argument(parser):
+    parser.add_argument('--profile-report', '--profile_report', dest='profile_report', default=None,
+                        nargs='?', const='profile_report.json', metavar='FILENAME',
+                        help='Time the pipeline stages and write a json summary to FILENAME (defaults to profile_report.json) and a table to the log at exit')
+
+def enable(filename, program=''):
+    """Starts profiling, the report is written to filename when the program exits (does nothing if filename is None)"""
+    if filename is None:
+        return
+    profile.enabled = True
+    profile.started = time.time()
+    atexit.register(profile.report, filename, program)
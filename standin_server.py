@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf8
+
+"""Local HTTP stand-in for barnehagefakta.no, nbr.udir.no and the overpass api, for load testing
+the concurrent and cached fetch paths without network access.
+Serves /api/barnehage/{orgnr}, /api/sok/sok?...&kommunenr=..&side=N, /api/xapi_meta and /api/interpreter
+(an augmented diff against the xapi_meta response for [adiff:...] queries, see update_osm.py --overpass_delta)
+from synthetic data (see benchmark.py) or replays recorded responses (--record_dir, a --cache_dir of barnehagefakta_get.py).
+Latency, sporadic 404 (see barnehagefakta_get_json) and 429/5xx errors can be injected.
+Point the tools at it with the environment variables BARNEHAGEFAKTA_URL, NBR_URL and OVERPASS_URL.
+Example usage
+./standin_server.py --port 8000 --latency 0.1 --flap_404 0.02 --error_rate 0.01 &
+BARNEHAGEFAKTA_URL=http://localhost:8000 NBR_URL=http://localhost:8000 OVERPASS_URL=http://localhost:8000 \\
+    ./barnehagefakta_osm.py --kommune 0101 --update_kommune --concurrency 8 --cache_dir /tmp/data"""
+# Standard python imports
+import os
+import time
+import json
+import random
+import hashlib
+import threading
+import copy
+import xml.etree.ElementTree as ET
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:             # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer as ThreadingHTTPServer
+    from urlparse import urlparse, parse_qs
+import logging
+logger = logging.getLogger('barnehagefakta.standin_server')
+# This project
+from barnehagefakta_store import reg_filename
+import benchmark
+
+page_size = 20
+
+class StandinData(object):
+    """The responses served, synthetic kindergartens (see benchmark.synthetic_barnehagefakta)
+    where recorded barnehagefakta.no responses (.json files below record_dir) replace the synthetic ones."""
+    def __init__(self, n=benchmark.n_kindergartens, seed=0, record_dir=None, overpass_filename=None):
+        self.items = dict()     # orgnr -> json string (or '404')
+        self.kommuner = dict()  # kommune -> list of (orgnr, name)
+        for item in benchmark.synthetic_barnehagefakta(n, seed):
+            self.add(item['orgnr'], json.dumps(item), item['kommune']['kommunenummer'], item['navn'])
+        if record_dir is not None:
+            self.add_recorded(record_dir)
+
+        if overpass_filename is not None:
+            with open(overpass_filename, 'rb') as f:
+                self.overpass = f.read()
+        else:
+            items = [json.loads(self.items[orgnr]) for orgnr in sorted(self.items) if self.items[orgnr] != '404']
+            self.overpass = benchmark.synthetic_overpass(items, seed=seed).encode('utf8')
+        self.augmented_diff = self.create_augmented_diff(seed=seed)
+
+    def add(self, orgnr, content, kommune, name):
+        if str(orgnr) not in self.items:
+            self.kommuner.setdefault(kommune, list()).append((str(orgnr), name))
+        self.items[str(orgnr)] = content
+
+    def add_recorded(self, record_dir):
+        count = 0
+        for root, dirs, files in os.walk(record_dir):
+            for f in files:
+                reg = reg_filename.match(f)
+                if reg is None or reg.group(2) is not None: # only the current responses
+                    continue
+                with open(os.path.join(root, f)) as fh:
+                    content = fh.read()
+                kommune = os.path.basename(os.path.normpath(root))
+                name = ''
+                if content != '404':
+                    name = json.loads(content).get('navn', '')
+                self.add(reg.group(1), content, kommune, name)
+                count += 1
+        logger.info('Replaying %d recorded responses from %s', count, record_dir)
+
+    def create_augmented_diff(self, n_changes=3, seed=0):
+        """Returns an overpass augmented diff (xml bytes) against the overpass response, modifying and deleting
+        n_changes of its tagged nodes and creating nodes for n_changes kindergartens not in it, with osm_base set to now"""
+        rng = random.Random(seed)
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        osm = ET.fromstring(self.overpass)
+        nodes = [elem for elem in osm.findall('node') if elem.find('tag') is not None]
+        mapped = set(tag.get('v') for tag in osm.iter('tag') if tag.get('k') == 'no-barnehage:nsrid')
+        unmapped = [orgnr for orgnr in sorted(self.items) if orgnr not in mapped and self.items[orgnr] != '404']
+        max_id = max([int(elem.get('id')) for elem in osm.findall('node')] or [0])
+
+        root = ET.Element('osmAugmentedDiff', version='0.6', generator='standin_server.py')
+        ET.SubElement(root, 'meta', osm_base=now)
+        changed = rng.sample(nodes, min(2*n_changes, len(nodes)))
+        for ix, elem in enumerate(changed):
+            new = copy.deepcopy(elem)
+            new.set('version', str(int(elem.get('version', '1')) + 1))
+            new.set('timestamp', now)
+            if ix < n_changes:
+                action = ET.SubElement(root, 'action', type='modify')
+                ET.SubElement(new, 'tag', k='note', v='modified by standin_server.py')
+            else:
+                action = ET.SubElement(root, 'action', type='delete')
+                for child in list(new):
+                    new.remove(child)
+                new.set('visible', 'false')
+            ET.SubElement(action, 'old').append(elem)
+            ET.SubElement(action, 'new').append(new)
+
+        for ix, orgnr in enumerate(unmapped[:n_changes]):
+            item = json.loads(self.items[orgnr])
+            lat, lon = item['koordinatLatLng']
+            action = ET.SubElement(root, 'action', type='create')
+            node = ET.SubElement(action, 'node', id=str(max_id + 1 + ix), lat='%.7f' % lat, lon='%.7f' % lon,
+                                 version='1', timestamp=now, changeset='2', uid='1', user='standin_server')
+            for key, value in (('amenity', 'kindergarten'), ('name', item['navn']), ('no-barnehage:nsrid', orgnr)):
+                ET.SubElement(node, 'tag', k=key, v=value)
+        return ET.tostring(root, encoding='UTF-8')
+
+    def search_page(self, kommune, page_nr):
+        rows = self.kommuner.get(kommune, [])
+        start = (page_nr - 1)*page_size
+        enheter = [{'enhetLink': {'text': name, 'id': orgnr},
+                    'eierLink': {'text': benchmark.operators[int(orgnr) % len(benchmark.operators)],
+                                 'id': 800000000 + int(orgnr) % 1000}}
+                   for orgnr, name in rows[start:start + page_size]]
+        return json.dumps({'enheter': enheter, 'antallTreff': len(rows)})
+
+class Faults(object):
+    """The injected latency (seconds, plus up to jitter seconds), sporadic 404 and error responses"""
+    def __init__(self, latency=0., jitter=0., flap_404=0., error_rate=0., error_codes=(429, 500, 503), seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flap_404 = flap_404
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def delay(self):
+        delay = self.latency + self.jitter*self.random()
+        if delay > 0:
+            time.sleep(delay)
+
+    def error(self):
+        """Returns the status code of an injected error, or None"""
+        if self.error_rate > 0 and self.random() < self.error_rate:
+            with self.lock:
+                return self.rng.choice(self.error_codes)
+        return None
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = dict()    # 'path status' -> count
+        self.bytes = 0
+
+    def add(self, kind, status, n):
+        with self.lock:
+            key = '%s %s' % (kind, status)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.bytes += n
+
+    def summary(self):
+        with self.lock:
+            return dict(counts=dict(self.counts), bytes=self.bytes)
+
+class Handler(BaseHTTPRequestHandler):
+    data = None                 # StandinData
+    faults = Faults()
+    stats = Stats()
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send(self, kind, status, content=b'', content_type='application/json', headers=None):
+        if not(isinstance(content, bytes)):
+            content = content.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+        self.stats.add(kind, status, len(content))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        query = parse_qs(url.query)
+        self.faults.delay()
+
+        if url.path == '/stats':
+            return self.send('stats', 200, json.dumps(self.stats.summary()))
+
+        if parts[:2] == ['api', 'barnehage'] and len(parts) == 3:
+            kind = 'barnehage'
+        elif parts[:3] == ['api', 'sok', 'sok']:
+            kind = 'sok'
+        elif parts[:2] in (['api', 'xapi_meta'], ['api', 'interpreter']):
+            kind = 'overpass'
+        else:
+            return self.send('unknown', 404, '404')
+
+        status = self.faults.error()
+        if status is not None:
+            headers = {'Retry-After': '1'} if status == 429 else None
+            return self.send(kind, status, 'injected error', content_type='text/plain', headers=headers)
+
+        if kind == 'barnehage':
+            content = self.data.items.get(parts[2])
+            if content is None or content == '404' or \
+               (self.faults.flap_404 > 0 and self.faults.random() < self.faults.flap_404):
+                return self.send(kind, 404, '404')
+            etag = '"%s"' % hashlib.sha1(content.encode('utf8')).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                return self.send(kind, 304, headers={'ETag': etag})
+            return self.send(kind, 200, content, headers={'ETag': etag})
+        elif kind == 'sok':
+            kommune = query.get('kommunenr', [''])[0]
+            page_nr = int(query.get('side', ['1'])[0])
+            return self.send(kind, 200, self.data.search_page(kommune, page_nr))
+        elif parts[1] == 'interpreter' and '[adiff:' in query.get('data', [''])[0]:
+            return self.send(kind, 200, self.data.augmented_diff, content_type='application/osm3s+xml')
+        else:
+            return self.send(kind, 200, self.data.overpass, content_type='application/osm3s+xml')
+
+def serve(data, port=8000, host='localhost', faults=None):
+    """Returns the (not yet started) server, call serve_forever() (e.g. in a thread) and shutdown()"""
+    handler = type('StandinHandler', (Handler, ), dict(data=data, faults=faults or Faults(), stats=Stats()))
+    return ThreadingHTTPServer((host, port), handler)
+
+if __name__ == '__main__':
+    from utility_to_osm import argparse_util
+    parser = argparse_util.get_parser('Local stand-in for barnehagefakta.no, nbr.udir.no and the overpass api, see the module documentation.')
+    parser.add_argument('--port', default=8000, type=int,
+                        help='Port to listen on, defaults to 8000')
+    parser.add_argument('--host', default='localhost',
+                        help='Host to listen on, defaults to localhost')
+    parser.add_argument('--kindergartens', default=benchmark.n_kindergartens, type=int,
+                        help='Number of synthetic kindergartens, defaults to %s (Norway)' % benchmark.n_kindergartens)
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed for the synthetic data and the injected faults, defaults to 0')
+    parser.add_argument('--record_dir', default=None,
+                        help='Replay the barnehagefakta_no_orgnr*.json responses below this directory (e.g. data/) in addition to the synthetic ones')
+    parser.add_argument('--overpass_file', default=None,
+                        help='Replay this overpass response (.osm) instead of a synthetic one')
+    parser.add_argument('--latency', default=0., type=float,
+                        help='Seconds to wait before each response, defaults to 0')
+    parser.add_argument('--jitter', default=0., type=float,
+                        help='Add up to this many seconds (uniformly random) to --latency, defaults to 0')
+    parser.add_argument('--flap_404', default=0., type=float,
+                        help='Probability of a sporadic 404 for an existing kindergarten, defaults to 0')
+    parser.add_argument('--error_rate', default=0., type=float,
+                        help='Probability of responding with one of --error_codes instead, defaults to 0')
+    parser.add_argument('--error_codes', default=[429, 500, 503], nargs='+', type=int,
+                        help='Status codes used by --error_rate, defaults to 429 500 503')
+    argparse_util.add_verbosity(parser, default=logging.INFO)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    data = StandinData(args.kindergartens, seed=args.seed, record_dir=args.record_dir,
+                       overpass_filename=args.overpass_file)
+    faults = Faults(latency=args.latency, jitter=args.jitter, flap_404=args.flap_404,
+                    error_rate=args.error_rate, error_codes=args.error_codes, seed=args.seed)
+    server = serve(data, port=args.port, host=args.host, faults=faults)
+    url = 'http://%s:%s' % (args.host, args.port)
+    logger.info('Serving %d kindergartens in %d kommuner on %s, use\n'
+                'BARNEHAGEFAKTA_URL=%s NBR_URL=%s OVERPASS_URL=%s', len(data.items), len(data.kommuner), url, url, url, url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info('Statistics: %s', json.dumps(server.RequestHandlerClass.stats.summary()))
+        server.server_close()
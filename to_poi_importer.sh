@@ -20,13 +20,13 @@ OUTPUTDIR=datasets/norge-barnehagefakta
 # sudo npm install -g osmtogeojson
 # cd ..
 
-# Create a 'large' .osm file with all kindergartens:
-python barnehagefakta_osm.py -s --kommune ALL --output_filename $POI/$OUTPUTDIR/norge_barnehagefakta.osm --cache_dir barnehagefakta_osm_data/data/
-# convert to json and tile it
+# Create a 'large' .json file with all kindergartens and tile it, in one pass:
+python barnehagefakta_osm.py -s --kommune ALL --output_filename $POI/$OUTPUTDIR/norge_barnehagefakta.json --tile_dir $POI/$OUTPUTDIR --cache_dir barnehagefakta_osm_data/data/
+# previously: create a .osm file, convert to json and tile it
+#python barnehagefakta_osm.py -s --stream --kommune ALL --output_filename $POI/$OUTPUTDIR/norge_barnehagefakta.osm --cache_dir barnehagefakta_osm_data/data/
+#$node $osmtogeojson $OUTPUTDIR/norge_barnehagefakta.osm > $OUTPUTDIR/norge_barnehagefakta.json
+#$node tile_geojson.js -d $OUTPUTDIR/norge_barnehagefakta.json -r $OUTPUTDIR
 cd $POI
-$node $osmtogeojson $OUTPUTDIR/norge_barnehagefakta.osm > $OUTPUTDIR/norge_barnehagefakta.json
-$node tile_geojson.js -d $OUTPUTDIR/norge_barnehagefakta.json -r $OUTPUTDIR
-#$node tile_geojson.js $OUTPUTDIR/norge_barnehagefakta.json  $OUTPUTDIR
 cd $OUTPUTDIR
 $git add -A data/
 $git commit -am "auto data update" || true
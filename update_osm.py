@@ -4,8 +4,12 @@
 # Standard python imports
 import os
 import re
+import copy
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from urllib.parse import quote
 import logging
 logger = logging.getLogger('barnehagefakta.update_osm')
 
@@ -32,6 +36,8 @@ except ImportError:
     print('Please create mypasswords.py, please see mypasswords_template.py')
 
 from barnehagefakta_osm import create_osmtags
+from barnehagefakta_store import FileStore, get_store, get_journal_filename, ChangeJournal, is_cached
+import profile_report
 
 def compare_capacity(value1_str, value2_str):
     '''
@@ -52,30 +58,31 @@ def get_osm_files(folder):
         filename = os.path.join(folder, filename)
         if filename.endswith('.osm'):
             logger.info('.osm file %s', filename)
-            with open(filename) as f:
+            with open(filename) as f, profile_report.timer('xml_parse'):
                 data = osmapis.OSMnsrid.from_xml(f.read())
 
             yield filename, data
 
-def find_outdated(root):
+def find_outdated(root, store=None):
     """Yields all {nbr_id}-%Y-%m-%d-OUTDATED.json files below directory 'root'.
-    the tuple (filename_outdated, filename_updated, nbr_id) is yielded
+    the tuple (filename_outdated, filename_updated, nbr_id) is yielded,
+    for other stores (see barnehagefakta_store), references are yielded instead of filenames.
     """
-    for root, dirs, files in os.walk(root):
-        for f in files:
-            if f.endswith('OUTDATED.json'):
-                try:
-                    reg = re.search('orgnr(\d+)-(\d+-\d+-\d+)-OUTDATED.json', f)
-                    nbr_id = reg.group(1)
-                    date = datetime.strptime(reg.group(2), '%Y-%m-%d')
-                    filename_updated = f.replace('-'+reg.group(2)+'-OUTDATED', '') # hack
-                    filename_updated = os.path.join(root, filename_updated)
-                except Exception as e:
-                    raise ValueError('Invalid OUTDATED.json filename detected, "%s/%s", %s' % (root, f, e))
-
-                filename_outdated = os.path.join(root, f)
-                yield filename_outdated, filename_updated, nbr_id
-                #yield os.path.join(root, f), date, nbr_id
+    if store is None:
+        store = FileStore()
+    return store.find_outdated(root)
+
+def find_pending(root, store, journal, scan=False):
+    """Returns the tuple (records, offset), the outdated responses to look at as dictionaries with the keys
+    outdated, updated and orgnr, and the journal offset to checkpoint once they are handled.
+    Without a change journal (or if scan is True) every outdated response in the store is returned and offset is None."""
+    if scan or not(os.path.exists(journal.filename)):
+        records = [dict(orgnr=orgnr, outdated=outdated, updated=updated)
+                   for outdated, updated, orgnr in find_outdated(root, store)]
+        return records, None
+    records, offset = journal.pending(scan=find_outdated(root, store))
+    logger.info('%d changes in %s since last run', len(records), journal.filename)
+    return records, offset
 
 def find_all_nsrid_osm_elements(osm, nsrid=None):
     """Parses the given osmapis.OSM and yields all elements containing the tag barnehage:nsrid,
@@ -90,23 +97,33 @@ def find_all_nsrid_osm_elements(osm, nsrid=None):
             logger.debug('found tags = "%s"\nattribs="%s"', elem.tags, elem.attribs)
             yield elem
 
-def overpass_nsrid(nsrid='*',
-                   bbox_scandinavia = '[bbox=3.33984375,57.468589192089325,38.408203125,81.1203884020757]'):
-     # bbox_scandinavia: limit request size, should contains all of Norway.
+bbox_scandinavia = '[bbox=3.33984375,57.468589192089325,38.408203125,81.1203884020757]'
+# e.g. http://localhost:8000 for standin_server.py
+overpass_url = os.environ.get('OVERPASS_URL', 'http://www.overpass-api.de')
 
+def overpass_nsrid_filename(nsrid='*', bbox_scandinavia=bbox_scandinavia):
     filename = 'overpass_api_cache_%s_%s.xml' % (nsrid, bbox_scandinavia)
     filename = filename.replace(',', '')
     filename = filename.replace('*', '-')
     filename = filename.replace('[', '')
     filename = filename.replace(']', '')
     filename = filename.replace('=', '')
+    return filename
+
+def overpass_nsrid(nsrid='*',
+                   bbox_scandinavia = bbox_scandinavia):
+     # bbox_scandinavia: limit request size, should contains all of Norway.
+
+    filename = overpass_nsrid_filename(nsrid, bbox_scandinavia)
     logger.debug('cached overpass filename "%s"', filename)
 
     cached, outdated = file_util.cached_file(filename, old_age_days=1)
     if cached is not None and not(outdated):
         return cached
 
-    r = request_session.get('http://www.overpass-api.de/api/xapi_meta?*[no-barnehage:nsrid=%s]%s' % (nsrid, bbox_scandinavia))
+    with profile_report.timer('http_fetch'):
+        r = request_session.get(overpass_url + '/api/xapi_meta?*[no-barnehage:nsrid=%s]%s' % (nsrid, bbox_scandinavia))
+    profile_report.add_bytes('http_fetch', len(r.content))
     ret = r.content
 
     if r.status_code == 200:
@@ -116,13 +133,186 @@ def overpass_nsrid(nsrid='*',
         logger.error('Invalid status code %s', r.status_code)
         return None
 
-def update_osm(original, modified, username=None, password=None, comment='', osm_element=None):
-    #'''osmapis changeset example'''
+def overpass_nsrid_query(nsrid='*', bbox_scandinavia=bbox_scandinavia, since=None):
+    """Returns the overpass QL query for the same elements as overpass_nsrid,
+    as an augmented diff since the given timestamp (e.g. '2015-09-06T17:28:02Z'), if given.
+
+    >>> print(overpass_nsrid_query('42', '[bbox=3,57,38,81]', since='2015-09-06T17:28:02Z'))
+    [adiff:"2015-09-06T17:28:02Z"][timeout:180];(nwr["no-barnehage:nsrid"="42"](57,3,81,38);>;);out meta;
+    """
+    west, south, east, north = re.search(r'bbox=([^\]]+)', bbox_scandinavia).group(1).split(',')
+    tag = '["no-barnehage:nsrid"]'
+    if nsrid != '*':
+        tag = '["no-barnehage:nsrid"="%s"]' % nsrid
+    header = '[timeout:180];'
+    if since is not None:
+        header = '[adiff:"%s"]' % since + header
+    return header + '(nwr%s(%s,%s,%s,%s);>;);out meta;' % (tag, south, west, north, east)
+
+def overpass_nsrid_delta(nsrid='*', bbox_scandinavia=bbox_scandinavia):
+    """Refreshes the cached overpass_nsrid response by requesting only the changes since its
+    osm_base timestamp (an augmented diff) and applying them.
+    Returns True on success, False if there is no cached response with a timestamp"""
+    filename = overpass_nsrid_filename(nsrid, bbox_scandinavia)
+    if not(os.path.exists(filename)):
+        return False
+    since = osmapis.osm_base(filename)
+    if since is None:
+        return False
+
+    query = overpass_nsrid_query(nsrid, bbox_scandinavia, since=since)
+    with profile_report.timer('http_fetch'):
+        r = request_session.get(overpass_url + '/api/interpreter?data=' + quote(query))
+    profile_report.add_bytes('http_fetch', len(r.content))
+    if r.status_code != 200:
+        raise ValueError('Invalid status code %s for the augmented diff' % r.status_code)
+
+    created, modified, deleted, upserted = osmapis.apply_augmented_diff(filename, r.content, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+    logger.info('Applied the changes since %s to %s: %d created, %d modified, %d deleted, %d upserted',
+                since, filename, created, modified, deleted, upserted)
+    return True
+
+def overpass_nsrid_cache(nsrid='*', bbox_scandinavia=bbox_scandinavia, delta=False):
+    """Ensures the overpass_nsrid response is cached, without reading it,
+    returns the cache filename (None if the request failed).
+    If delta is True, an outdated cache is refreshed with overpass_nsrid_delta
+    (falling back to downloading everything).
+    Use with osmapis_nsrid.OSMnsrid.from_file"""
+    filename = overpass_nsrid_filename(nsrid, bbox_scandinavia)
+    if is_cached(filename, old_age_days=1):
+        return filename
+    if delta:
+        try:
+            if overpass_nsrid_delta(nsrid, bbox_scandinavia):
+                return filename
+        except Exception as e:
+            logger.warning('Unable to refresh %s using an augmented diff, downloading everything. %s', filename, e)
+    if overpass_nsrid(nsrid, bbox_scandinavia) is None:
+        return None
+    return filename
+
+def overpass_nsrid_index(nsrid='*', bbox_scandinavia=bbox_scandinavia, delta=False):
+    """Returns the overpass_nsrid response as a (read-only) nsrid_index.NsridIndex,
+    the index is stored next to the cached response and only rebuilt when the response changes.
+    Returns None if the request failed."""
+    import nsrid_index          # requires numpy
+    filename = overpass_nsrid_cache(nsrid, bbox_scandinavia, delta=delta)
+    if filename is None:
+        return None
+    return nsrid_index.load_or_build(filename)
+
+changeset_max_elements = 10000 # the OSM API limit, see /api/capabilities
+
+def get_api(username=None, password=None, api_url=None):
+    """Returns an authenticated osmapis.API, api_url overrides the default OSM API (e.g. a local test server)"""
     if username is None:
         username = mypasswords.osm_username
     if password is None:
         password = mypasswords.osm_password
 
+    kwargs = dict()
+    if api_url is not None:
+        kwargs['base_url'] = api_url
+    return osmapis.API(username=username, password=password,
+                       changeset_tags=dict(source="Nasjonalt barnehageregister",
+                                           created_by="barnehagefakta_osm.py"),
+                       **kwargs)
+
+def view_elements(osm):
+    for elements in (osm.nodes, osm.ways, osm.relations):
+        for element in elements.values():
+            yield element
+
+class BatchUpload(object):
+    """Collects the (original, modified) views of every kindergarten that needs an update
+    and uploads all the changes in as few changesets as possible, using a single session.
+    Example usage
+    batch = BatchUpload(comment=changeset_comment)
+    batch.add(osm_original, osm, ref=filename_outdated)
+    batch.upload()
+    batch.uploaded_refs # the refs where every element was uploaded"""
+    def __init__(self, comment='', max_elements=changeset_max_elements):
+        self.comment = comment
+        self.max_elements = max_elements
+        self.items = list()     # list of (original element, modified element)
+        self.keys = dict()      # (type, id) -> index in items
+        self.refs = list()      # list of (ref, indexes in items)
+        self.uploaded_refs = list()
+
+    def add(self, original, modified, ref=None):
+        """Adds the osmapis_nsrid.OSMnsrid objects from NsridSnapshot.view(nsrid),
+        ref (e.g. the OUTDATED filename) is listed in uploaded_refs once all of its elements are uploaded"""
+        originals = dict()
+        for element in view_elements(original):
+            originals[(type(element), element.attribs['id'])] = element
+        indexes = list()
+        for element in view_elements(modified):
+            key = (type(element), element.attribs['id'])
+            if key in self.keys:
+                logger.warning('%s %s has already been added to the batch, ignoring', key[0].__name__, key[1])
+            else:
+                self.keys[key] = len(self.items)
+                self.items.append((originals.get(key), element))
+            indexes.append(self.keys[key])
+        self.refs.append((ref, indexes))
+
+    def __len__(self):
+        return len(self.items)
+
+    def chunks(self):
+        """Yields osmapis.OSC diffs, each with at most max_elements elements"""
+        for start in range(0, len(self.items), self.max_elements):
+            original, modified = osmapis.OSMnsrid(), osmapis.OSMnsrid()
+            for element_original, element in self.items[start:start + self.max_elements]:
+                if element_original is not None:
+                    original.add(element_original)
+                modified.add(element)
+            yield osmapis.OSC.from_diff(original, modified)
+
+    def upload(self, api=None, confirm=False):
+        """Uploads one changeset per chunk, returns the list of changeset ids.
+        A chunk that fails is logged and skipped, the refs with all their elements in
+        the uploaded chunks are listed in uploaded_refs.
+        If confirm is True, the user is asked once before anything is uploaded."""
+        self.uploaded_refs = list()
+        if len(self) == 0:
+            return []
+        chunks = list(self.chunks())
+        if confirm:
+            for osc in chunks:
+                print('DIFF: %s' % osc)
+            user_input = input('Upload %d modified elements in %d changeset(s)? enter to continue, "n" to skip>>[y] '
+                               % (len(self), len(chunks))).lower()
+            if user_input not in ('y', ''):
+                print('Skipping.')
+                return []
+
+        if api is None:
+            api = get_api()
+        changeset_ids = list()
+        uploaded = set()        # chunk numbers
+        for chunk_nr, osc in enumerate(chunks):
+            try:
+                changeset = api.create_changeset(comment=self.comment)
+                changeset_id = api.get_changeset_id(changeset)
+                api.upload_diff(osc=osc, changeset=changeset)
+                api.close_changeset(int(changeset_id))
+            except Exception:
+                logger.exception('Failed to upload changeset %d of %d, skipping', chunk_nr + 1, len(chunks))
+                continue
+            logger.info('Uploaded changeset %s', changeset_id)
+            changeset_ids.append(changeset_id)
+            uploaded.add(chunk_nr)
+
+        for ref, indexes in self.refs:
+            if all(ix // self.max_elements in uploaded for ix in indexes):
+                self.uploaded_refs.append(ref)
+        return changeset_ids
+
+def update_osm(original, modified, username=None, password=None, comment='', osm_element=None, api_url=None):
+    #'''osmapis changeset example'''
+
     # # Ensure we delete the ADDRESS tag (if any)
     # if 'ADDRESS' in modified.tags:
     #     del modified.tags['ADDRESS']
@@ -145,15 +335,13 @@ def update_osm(original, modified, username=None, password=None, comment='', osm
         webbrowser.open(osm_element.tags['contact:website'])
         return update_osm(original, modified,
                           username=username, password=password, comment=comment,
-                          osm_element=osm_element)
+                          osm_element=osm_element, api_url=api_url)
     else:
         print('unkown user_input, breaking.', repr(user_input))
         exit(1)
 
 
-    api = osmapis.API(username=username, password=password,
-                      changeset_tags=dict(source="Nasjonalt barnehageregister",
-                                          created_by="barnehagefakta_osm.py"))
+    api = get_api(username=username, password=password, api_url=api_url)
     changeset = api.create_changeset(comment=comment)
     changeset_id = api.get_changeset_id(changeset)
 
@@ -259,18 +447,133 @@ def resolve_conflict(osm_element, osm_outdated, osm_updated):
     else:
         return True
 
+# decide_outdated decisions where the OUTDATED response is removed
+remove_decisions = ('404', 'not_imported_404', 'no_relevant_tags', 'not_added', 'resolved')
+
+def decide_outdated(snapshot, store, filename_outdated, filename_updated, nbr_id,
+                    cache_dir='data', missing_ok=False):
+    """Decides what to do with a single outdated response, without modifying the store or OSM.
+    snapshot is the osmapis_nsrid.NsridSnapshot, or a function returning it (only called if needed).
+    Returns the tuple (decision, details), decision is one of
+    'missing' (the responses no longer exist, only if missing_ok), '404', 'not_imported_404', '404_in_osm',
+    'no_relevant_tags', 'not_added', 'resolved', 'unresolved', 'update' or 'duplicate',
+    the OUTDATED response should be removed for the remove_decisions.
+    details is the tuple (osm_original, osm, osm_element) for 'update', the list of elements for 'duplicate', else None."""
+    try:
+        with profile_report.timer('json_parse'):
+            outdated = json.loads(store.read(filename_outdated))
+            updated = json.loads(store.read(filename_updated))
+    except (IOError, KeyError) as e:
+        if not(missing_ok):
+            raise
+        logger.info('%s: %s, assuming this change has already been handled', nbr_id, e)
+        return 'missing', None
+
+    logger.info('%s: outdated = "%s", updated = "%s"', nbr_id, filename_outdated, filename_updated)
+
+    if callable(snapshot):
+        snapshot = snapshot()
+    osm_original, osm = snapshot.view(nbr_id)
+    osm_elements = osm.nsrids.get(nbr_id, [])
+
+    if outdated == 404:
+        logger.info('nbrid = %s was 404, removing', nbr_id)
+        return '404', None
+    if updated == 404:
+        if len(osm_elements) == 0:
+            logger.warning('nbrid = %s is now 404, previous = %s is not imported to osm, ignoring', nbr_id, outdated)
+            return 'not_imported_404', None
+        else:
+            logger.error('ERROR: nbrid = %s is now 404. FIXME: support this, previous = %s', nbr_id, outdated)
+            # Note: do not delete before we have a good fix for this!
+            return '404_in_osm', None
+
+    with profile_report.timer('create_osmtags'):
+        osm_outdated, _ = create_osmtags(outdated, cache_dir=cache_dir)
+        osm_updated, _ = create_osmtags(updated, cache_dir=cache_dir)
+
+    if osm_outdated.tags == osm_updated.tags: # none of the tags that we care about has changed
+        logger.info('nbrid = %s no relevant tags changed, removing', nbr_id) # fixme: check for lat/lon changes...
+        if datadiff is not None:
+            logger.debug("%s", datadiff.diff(outdated, updated))
+        return 'no_relevant_tags', None
+
+    if len(osm_elements) == 0:
+        logger.info('nbrid = %s has not been added to osm, removing the OUTDATED file', nbr_id)
+        if datadiff is not None:
+            logger.info("%s", datadiff.diff(outdated, updated))
+        return 'not_added', None
+    elif len(osm_elements) == 1:
+        osm_element = osm_elements[0]
+        logger.info('resolve_conflict(osm_element=%s %s, ...)', type(osm_element), osm_element.tags)
+        with profile_report.timer('resolve_conflict'):
+            resolved = resolve_conflict(osm_element, osm_outdated, osm_updated)
+        if resolved == 'update':
+            return 'update', (osm_original, osm, osm_element)
+        elif resolved == True:
+            return 'resolved', None
+        else:
+            return 'unresolved', None
+    else:
+        logger.error('OSM contains multiple nodes/ways/relations with the tag no-barnehage:nsrid=%s, please fix this.', nbr_id)
+        return 'duplicate', osm_elements
+
+worker_state = dict()           # the decide_outdated arguments shared by the decide_outdated_parallel workers
+
+def init_decide_worker(store):
+    # copies get their own sqlite connections (see barnehagefakta_store), the snapshot is inherited when forked
+    worker_state['store'] = copy.copy(store)
+
+def decide_outdated_worker(item):
+    state = worker_state
+    return item + decide_outdated(state['snapshot'], state['store'], *item, cache_dir=state['cache_dir'],
+                                  missing_ok=state['missing_ok'])
+
+def decide_outdated_parallel(outdated_items, snapshot, store, cache_dir='data', missing_ok=False, jobs=2):
+    """Runs decide_outdated for each (filename_outdated, filename_updated, nbr_id) in outdated_items
+    using a pool of forked processes sharing the read-only snapshot.
+    Yields the tuple (filename_outdated, filename_updated, nbr_id, decision, details) in the same order as outdated_items,
+    such that the caller can do all the removals and counting as for the serial case."""
+    if len(outdated_items) == 0:
+        return
+    worker_state.update(snapshot=snapshot, cache_dir=cache_dir, missing_ok=missing_ok)
+    try:
+        context = multiprocessing.get_context('fork')
+        chunksize = max(1, len(outdated_items) // (4*jobs))
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                                 initializer=init_decide_worker, initargs=(store, )) as executor:
+            for result in executor.map(decide_outdated_worker, outdated_items, chunksize=chunksize):
+                yield result
+    finally:
+        worker_state.clear()
+
 if __name__ == '__main__':
     import utility_to_osm.argparse_util as argparse_util
     parser = argparse_util.get_parser('Keeps OSM objects with no-barnehage:nsrid=* updated if there are changes in the NBR data. Does not overwrite modified OSM data.')
     parser.add_argument('--data_dir', default='data',
                         help='Specify directory for .osm files, defaults to data/')
     parser.add_argument('--batch', default=False, action='store_true',
-                        help='Do not promt for user input (will not update OSM, run without --batch to clear all conflicts)')
+                        help='Do not promt for user input (will not update OSM unless --upload_batch is given, then the updates are uploaded without asking. Run without --batch to clear all conflicts)')
+    parser.add_argument('--upload_batch', default=False, action='store_true',
+                        help='Instead of prompting for each update, collect all updates and upload them at the end in as few changesets as possible (asks once, unless --batch is also given)')
+    parser.add_argument('--api_url', default=None,
+                        help='Use this OSM API instead of the default, e.g. a local test server')
+    parser.add_argument('--jobs', default=1, type=int,
+                        help='Process the outdated responses in this many processes, the decisions are still applied one by one (mostly useful with --batch), defaults to 1')
     parser.add_argument('--log_filename', default='update_osm.log',
                          help='log file for all logging levels, defaults to update_osm.log.')
+    parser.add_argument('--cache_db', default=None,
+                        help='Look for outdated responses in this sqlite file instead of .json files in --data_dir (see barnehagefakta_store.py)')
+    parser.add_argument('--overpass_delta', default=False, action='store_true',
+                        help='Refresh the cached overpass response by only requesting the changes since it was downloaded (an augmented diff)')
+    parser.add_argument('--scan', default=False, action='store_true',
+                        help='Look for all outdated responses in --data_dir (or --cache_db), instead of only those recorded in the change journal since the last run. This is the default if there is no change journal.')
     argparse_util.add_verbosity(parser, default=logging.WARNING)
 
+    profile_report.add_argument(parser)
     args = parser.parse_args()
+    profile_report.enable(args.profile_report, 'update_osm.py')
+    store = get_store(args.cache_db)
 
     #logging.basicConfig(level=args.loglevel)
     # logger_adapter_dict = dict(nbr_id=None)
@@ -302,77 +605,93 @@ if __name__ == '__main__':
     N_need_update = 0
     N_resolved = 0
     N_unresolved = 0
-    for filename_outdated, filename_updated, nbr_id in find_outdated(root):
-        #logger_adapter_dict['nbr_id'] = nbr_id
-        N_outdated += 1
-        logger.info('%s: outdated = "%s", updated = "%s"', nbr_id, filename_outdated, filename_updated)
-        outdated = json.load(open(filename_outdated))
-        updated = json.load(open(filename_updated))
-
-        xml = overpass_nsrid()
-        osm_original = osmapis.OSMnsrid.from_xml(xml)
-        osm = osmapis.OSMnsrid.from_xml(xml)
-        osm_elements = osm.nsrids.get(nbr_id, [])
-
-        if outdated == 404:
-            N_404 += 1
-            logger.info('nbrid = %s was 404, removing', nbr_id)
-            os.remove(filename_outdated)
-            continue
-        if updated == 404:
-            if len(osm_elements) == 0:
-                logger.warning('nbrid = %s is now 404, previous = %s is not imported to osm, ignoring', nbr_id, outdated)
-                os.remove(filename_outdated)
-            else:
-                logger.error('ERROR: nbrid = %s is now 404. FIXME: support this, previous = %s', nbr_id, outdated)
-                # Note: do not delete before we have a good fix for this!
+    snapshot = None
+
+    journal = ChangeJournal(get_journal_filename(root))
+    records, journal_offset = find_pending(root, store, journal, scan=args.scan)
+    use_journal = journal_offset is not None
+    outdated_items = [(record['outdated'], record['updated'], record['orgnr']) for record in records]
+
+    batch_upload = None
+    if args.upload_batch:
+        batch_upload = BatchUpload(comment=changeset_comment)
+
+    removed = set()
+    def remove_outdated(ref):
+        store.remove(ref)
+        removed.add(ref)
+
+    def get_snapshot():         # parse the overpass response once, and only if there is something to do
+        global snapshot
+        if snapshot is None:
+            snapshot = osmapis.NsridSnapshot.from_file(overpass_nsrid_cache(delta=args.overpass_delta))
+        return snapshot
+
+    if args.jobs > 1:
+        outdated_items = list(outdated_items)
+        decisions = decide_outdated_parallel(outdated_items, get_snapshot() if len(outdated_items) != 0 else None,
+                                             store, cache_dir=args.data_dir,
+                                             missing_ok=use_journal, jobs=args.jobs)
+    else:
+        decisions = (item + decide_outdated(get_snapshot, store, *item, cache_dir=args.data_dir,
+                                            missing_ok=use_journal)
+                     for item in outdated_items)
 
+    for filename_outdated, filename_updated, nbr_id, decision, details in decisions:
+        #logger_adapter_dict['nbr_id'] = nbr_id
+        if decision == 'missing':
+            removed.add(filename_outdated)
             continue
 
-        osm_outdated, _ = create_osmtags(outdated, cache_dir=args.data_dir)
-        osm_updated, _ = create_osmtags(updated, cache_dir=args.data_dir)
-
-        if osm_outdated.tags == osm_updated.tags: # none of the tags that we care about has changed
+        N_outdated += 1
+        if decision == '404':
+            N_404 += 1
+        elif decision == 'no_relevant_tags':
             N_no_relevant_tags += 1
-            logger.info('nbrid = %s no relevant tags changed, removing', nbr_id) # fixme: check for lat/lon changes...
-            if datadiff is not None:
-                logger.debug("%s", datadiff.diff(outdated, updated))
-
-            os.remove(filename_outdated)
-            continue
-
-        if len(osm_elements) == 0:
+        elif decision == 'not_added':
             N_not_added += 1
-            logger.info('nbrid = %s has not been added to osm, removing the OUTDATED file', nbr_id)
-            if datadiff is not None:
-                logger.info("%s", datadiff.diff(outdated, updated))
-
-            os.remove(filename_outdated)
-        elif len(osm_elements) == 1:
-            osm_element = osm_elements[0]
-            logger.info('resolve_conflict(osm_element=%s %s, ...)', type(osm_element), osm_element.tags)
-            resolved = resolve_conflict(osm_element, osm_outdated, osm_updated)
-            if resolved == False:
-                N_unresolved += 1
-            elif resolved == 'update':
-                if args.batch is False:
-                    resolved = update_osm(original=osm_original,
-                                          modified=osm,
-                                          comment=changeset_comment,
-                                          osm_element=osm_element)
-                else:
-                    logger.warning('Run without --batch to update osm')
-                    N_need_update += 1
-
-            if resolved == True:
-                N_resolved += 1
-                logger.info('nbrid = %s has been resolved, removing the OUTDATED file', nbr_id)
-                os.remove(filename_outdated)
-        else:
-            logger.error('OSM contains multiple nodes/ways/relations with the tag no-barnehage:nsrid=%s, please fix this.', nbr_id)
-            for ix, e in enumerate(osm_elements):
+        elif decision == 'unresolved':
+            N_unresolved += 1
+        elif decision == 'duplicate':
+            for ix, e in enumerate(details):
                 print('DUPLICATE %d: %s\n"%s"' % (ix, e.tags, e))
             #exit(1)
+        elif decision == 'update':
+            osm_original, osm, osm_element = details
+            if batch_upload is not None:
+                batch_upload.add(osm_original, osm, ref=filename_outdated)
+            elif args.batch is False:
+                if update_osm(original=osm_original,
+                              modified=osm,
+                              comment=changeset_comment,
+                              osm_element=osm_element,
+                              api_url=args.api_url):
+                    decision = 'resolved'
+            else:
+                logger.warning('Run without --batch to update osm')
+                N_need_update += 1
+
+        if decision == 'resolved':
+            N_resolved += 1
+            logger.info('nbrid = %s has been resolved, removing the OUTDATED file', nbr_id)
+
+        if decision in remove_decisions:
+            remove_outdated(filename_outdated)
+
+    if batch_upload is not None and len(batch_upload.refs) != 0:
+        changeset_ids = batch_upload.upload(api=get_api(api_url=args.api_url), confirm=not(args.batch))
+        uploaded_refs = batch_upload.uploaded_refs
+        if len(uploaded_refs) != 0:
+            logger.info('%d updates uploaded in changeset(s) %s, removing the OUTDATED files',
+                        len(uploaded_refs), ', '.join(str(i) for i in changeset_ids))
+        for filename_outdated in uploaded_refs:
+            remove_outdated(filename_outdated)
+        N_resolved += len(uploaded_refs)
+        N_need_update += len(batch_upload.refs) - len(uploaded_refs)
+
+    if use_journal:             # keep the unresolved changes for the next run
+        pending = [record for record in records if record['outdated'] not in removed]
+        journal.save_checkpoint(journal_offset, pending)
 
     # Summary
     resolved = N_404 + N_no_relevant_tags + N_not_added + N_resolved
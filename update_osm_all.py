@@ -34,8 +34,7 @@ def print_osm_keys(osm_data_tags):
 
 
 def get_osm_data():
-    xml = update_osm.overpass_nsrid()
-    osm = osmapis.OSMnsrid.from_xml(xml)
+    osm = osmapis.OSMnsrid.from_file(update_osm.overpass_nsrid_cache())
     # osm_elements = list(update_osm.find_all_nsrid_osm_elements(osm))
     print('returning %d osm objects' % len(osm.nsrids))#, osm.nsrids
     return osm
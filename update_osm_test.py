@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 
 # Standard python imports
+import os
+import time
 import json
+import tempfile
 import unittest
+from datetime import datetime
 import logging
 logger = logging.getLogger('barnehagefakta.update_osm.test')
 # non standard
 import osmapis
 # This project
 import update_osm
-from barnehagefakta_osm import create_osmtags
+import barnehagefakta_get
+import barnehagefakta_osm
+import osmapis_nsrid
+from barnehagefakta_osm import create_osmtags, TiledGeoJSONWriter, tile_xy
+from barnehagefakta_store import FileStore, SQLiteStore, ChangeJournal, get_journal_filename, migrate
 
 # Example responses from overpass api, when searcing for a single no-barnehage:nsrid.
 reply_node ="""<?xml version="1.0" encoding="UTF-8"?>
@@ -328,3 +336,423 @@ class MyTest(unittest.TestCase):
                 self.setUp()    # cleanup
                 
         #assert False
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = osmapis_nsrid.NsridSnapshot.from_xml(reply_way)
+
+    def test_view(self):
+        self.assertIn('1016218', self.snapshot)
+        original, modified = self.snapshot.view('1016218')
+        self.assertEqual(len(original.nsrids['1016218']), 1)
+        self.assertEqual(len(modified.nsrids['1016218']), 1)
+        self.assertEqual(original.nsrids['1016218'][0].tags, modified.nsrids['1016218'][0].tags)
+
+    def test_view_copy_on_write(self):
+        original, modified = self.snapshot.view('1016218')
+        modified.nsrids['1016218'][0].tags['capacity'] = '42'
+        self.assertEqual(original.nsrids['1016218'][0].tags['capacity'], '18')
+        self.assertEqual(self.snapshot.get('1016218')[0].tags['capacity'], '18')
+        # a new view does not see previous modifications
+        _, modified = self.snapshot.view('1016218')
+        self.assertEqual(modified.nsrids['1016218'][0].tags['capacity'], '18')
+
+    def test_view_missing(self):
+        original, modified = self.snapshot.view('42')
+        self.assertEqual(len(original), 0)
+        self.assertEqual(modified.nsrids.get('42', []), [])
+
+    def test_from_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.osm', delete=False) as f:
+            f.write(reply_way)
+        try:
+            streamed = osmapis_nsrid.OSMnsrid.from_file(f.name)
+            filtered = osmapis_nsrid.OSMnsrid.from_file(f.name, predicate=osmapis_nsrid.has_nsrid)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(len(streamed), len(self.snapshot.osm))
+        self.assertEqual(streamed.nsrids['1016218'][0].tags, self.snapshot.get('1016218')[0].tags)
+        # the way is kept together with its nodes
+        self.assertEqual(len(filtered), len(self.snapshot.osm))
+
+    def test_apply_augmented_diff(self):
+        adiff = '''<osm-augmented-diff version="0.6"><meta osm_base="2016-01-01T00:00:00Z"/>
+<action type="create"><node id="-1" version="1" lat="59.9" lon="10.7"><tag k="no-barnehage:nsrid" v="42"/></node></action>
+<action type="modify"><old><node id="-2" version="1" lat="59.9" lon="10.7"/></old>
+<new><node id="-2" version="2" lat="59.9" lon="10.7"><tag k="no-barnehage:nsrid" v="43"/></node></new></action>
+</osm-augmented-diff>'''
+        with tempfile.NamedTemporaryFile('w', suffix='.osm', delete=False) as f:
+            f.write(reply_way)
+        try:
+            counts = osmapis_nsrid.apply_augmented_diff(f.name, adiff, f.name + '.tmp')
+            self.assertEqual(osmapis_nsrid.osm_base(f.name + '.tmp'), '2016-01-01T00:00:00Z')
+            updated = osmapis_nsrid.OSMnsrid.from_file(f.name + '.tmp')
+        finally:
+            os.remove(f.name)
+            if os.path.exists(f.name + '.tmp'):
+                os.remove(f.name + '.tmp')
+        self.assertEqual(counts, (1, 0, 0, 1)) # the modified node was not in the file
+        self.assertEqual(len(updated), len(self.snapshot.osm) + 2)
+        self.assertIn('42', updated.nsrids)
+        self.assertIn('43', updated.nsrids)
+
+class RecordingAPI(object):
+    """Stand-in for osmapis.API, records the uploaded diffs"""
+    def __init__(self, fail=()):
+        self.uploaded = list()
+        self.closed = list()
+        self.fail = fail        # changeset numbers where upload_diff fails
+        self.created = 0
+
+    def create_changeset(self, comment=''):
+        self.created += 1
+        return self.created
+
+    def get_changeset_id(self, changeset):
+        return changeset
+
+    def upload_diff(self, osc, changeset):
+        if changeset in self.fail:
+            raise IOError('upload failed')
+        self.uploaded.append((changeset, osc))
+
+    def close_changeset(self, changeset_id):
+        self.closed.append(changeset_id)
+
+class BatchUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.batch = update_osm.BatchUpload(comment='test', max_elements=1)
+        for reply in (reply_node, reply_way):
+            snapshot = osmapis_nsrid.NsridSnapshot.from_xml(reply)
+            original, modified = snapshot.view('1016218')
+            modified.nsrids['1016218'][0].tags['capacity'] = '42'
+            self.batch.add(original, modified, ref=reply)
+
+    def test_upload_chunks(self):
+        self.assertEqual(len(self.batch), 2)
+        api = RecordingAPI()
+        changeset_ids = self.batch.upload(api=api)
+        self.assertEqual(changeset_ids, [1, 2])
+        self.assertEqual(api.closed, [1, 2])
+        self.assertEqual(self.batch.uploaded_refs, [reply_node, reply_way])
+
+    def test_upload_failed_chunk(self):
+        api = RecordingAPI(fail=(1, ))
+        self.assertEqual(self.batch.upload(api=api), [2])
+        self.assertEqual(self.batch.uploaded_refs, [reply_way])
+
+    def test_upload_single_changeset(self):
+        self.batch.max_elements = update_osm.changeset_max_elements
+        api = RecordingAPI()
+        self.assertEqual(self.batch.upload(api=api), [1])
+
+class DictStore(object):
+    """Stand-in for the barnehagefakta_store stores, reference -> response"""
+    def __init__(self, responses):
+        self.responses = responses
+
+    def read(self, ref):
+        return json.dumps(self.responses[ref])
+
+class DecideOutdatedTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = osmapis_nsrid.NsridSnapshot.from_xml(reply_way)
+        self.store = DictStore({'404': 404, 'same': barnehagefakta_no_nbrId1016218})
+
+    def decide(self, outdated, updated, nbr_id='1016218'):
+        return update_osm.decide_outdated(self.snapshot, self.store, outdated, updated, nbr_id)[0]
+
+    def test_404(self):
+        self.assertEqual(self.decide('404', 'same'), '404')
+        self.assertEqual(self.decide('same', '404', nbr_id='42'), 'not_imported_404')
+        self.assertEqual(self.decide('same', '404'), '404_in_osm')
+
+    def test_no_relevant_tags(self):
+        self.assertEqual(self.decide('same', 'same'), 'no_relevant_tags')
+
+    def test_missing(self):
+        self.assertRaises(KeyError, self.decide, 'gone', 'same')
+        decision, _ = update_osm.decide_outdated(self.snapshot, self.store, 'gone', 'same', '1016218', missing_ok=True)
+        self.assertEqual(decision, 'missing')
+
+    def test_snapshot_function(self):
+        decision, _ = update_osm.decide_outdated(lambda: self.snapshot, self.store, '404', 'same', '1016218')
+        self.assertEqual(decision, '404')
+
+class TiledGeoJSONWriterTest(unittest.TestCase):
+    def read_tile(self, tile_dir, x, y):
+        with open(os.path.join(tile_dir, 'data', str(x), '%d.json' % y)) as f:
+            return json.load(f)
+
+    def test_layout(self):
+        tile_dir = tempfile.mkdtemp()
+        writer = TiledGeoJSONWriter(tile_dir)
+        for node_id, lat, lon in ((-1, 59.9, 10.7), (-2, 63.43, 10.39), (-3, 59.9001, 10.7001)):
+            writer.add(osmapis.Node(attribs=dict(id=node_id, lat=lat, lon=lon), tags={'name': str(node_id)}))
+        self.assertEqual(len(writer), 3)
+        # written as added, only the count per tile is kept
+        self.assertEqual(sorted(writer.tiles.values()), [1, 2])
+        self.assertTrue(os.path.exists(os.path.join(tile_dir, 'data', '2169', '1191.json')))
+        writer.close()
+
+        self.assertEqual(tile_xy(63.43, 10.39, 12), (2166, 1107))
+        filenames = sorted(os.path.relpath(os.path.join(dirpath, filename), tile_dir)
+                           for dirpath, _, files in os.walk(tile_dir) for filename in files)
+        self.assertEqual(filenames, [os.path.join('data', '2166', '1107.json'),
+                                     os.path.join('data', '2169', '1191.json')])
+        oslo = self.read_tile(tile_dir, 2169, 1191)
+        self.assertEqual(oslo['type'], 'FeatureCollection')
+        self.assertEqual([feature['id'] for feature in oslo['features']], ['node/-1', 'node/-3'])
+        self.assertEqual(oslo['features'][0]['geometry'], {'type': 'Point', 'coordinates': [10.7, 59.9]})
+        self.assertEqual(oslo['features'][1]['properties']['tags'], {'name': '-3'})
+        trondheim = self.read_tile(tile_dir, 2166, 1107)
+        self.assertEqual([feature['id'] for feature in trondheim['features']], ['node/-2'])
+
+    def test_rewrite(self):
+        tile_dir = tempfile.mkdtemp()
+        for node_id in (-1, -2):        # a second run replaces, not appends to, the tile
+            writer = TiledGeoJSONWriter(tile_dir)
+            writer.add(osmapis.Node(attribs=dict(id=node_id, lat=59.9, lon=10.7)))
+            writer.close()
+        self.assertEqual([feature['id'] for feature in self.read_tile(tile_dir, 2169, 1191)['features']],
+                         ['node/-2'])
+
+class FileStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, '0213')
+        self.store = self.create_store()
+
+    def create_store(self):
+        return FileStore()
+
+    def test_round_trip(self):
+        self.assertEqual(self.store.load('1', self.cache_dir, 1)[0], None)
+        self.store.save('1', self.cache_dir, '{"old": 1}', validators={'ETag': '"a"'})
+        self.assertEqual(self.store.load('1', self.cache_dir, 1), ('{"old": 1}', False))
+        self.assertEqual(self.store.load_validators('1', self.cache_dir), {'ETag': '"a"'})
+
+        outdated = self.store.archive('1', self.cache_dir, datetime(2020, 1, 1))
+        self.store.save('1', self.cache_dir, '{"new": 1}')
+        self.assertEqual(self.store.load_validators('1', self.cache_dir), {})
+        updated = self.store.ref('1', self.cache_dir)
+        self.assertEqual(list(self.store.find_outdated(self.root)), [(outdated, updated, '1')])
+        self.assertEqual(self.store.read(outdated), '{"old": 1}')
+        self.assertEqual(self.store.read(updated), '{"new": 1}')
+
+        self.store.remove(outdated)
+        self.assertEqual(list(self.store.find_outdated(self.root)), [])
+
+class SQLiteStoreTest(FileStoreTest):
+    def create_store(self):
+        return SQLiteStore(os.path.join(self.root, 'barnehagefakta.sqlite'))
+
+    def test_migrate(self):
+        file_store = FileStore()
+        file_store.save('1', self.cache_dir, '{"old": 1}')
+        file_store.archive('1', self.cache_dir, datetime(2020, 1, 1))
+        file_store.save('1', self.cache_dir, '{"new": 1}', validators={'ETag': '"b"'})
+        file_store.save('2', self.cache_dir, '404')
+
+        self.assertEqual(migrate(self.root, self.store, remove=True), 3)
+        self.assertEqual(list(file_store.find_outdated(self.root)), [])
+        self.assertEqual(self.store.load('2', self.cache_dir, 1)[0], '404')
+        self.assertEqual(self.store.load_validators('1', self.cache_dir), {'ETag': '"b"'})
+        (outdated, updated, orgnr), = self.store.find_outdated()
+        self.assertEqual((self.store.read(outdated), self.store.read(updated), orgnr),
+                         ('{"old": 1}', '{"new": 1}', '1'))
+
+class StubResponse(object):
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or dict()
+
+class StubSession(object):
+    """Stand-in for gentle_requests.GentleRequests, returns the given responses and records the request headers"""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = list()
+
+    def get(self, url, headers=None):
+        self.requests.append((url, headers))
+        return self.responses.pop(0)
+
+class ConditionalRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, '0213')
+        self.store = FileStore()
+        self.session = barnehagefakta_get.request_session
+
+    def tearDown(self):
+        barnehagefakta_get.request_session = self.session
+
+    def get(self, *responses):
+        barnehagefakta_get.request_session = StubSession(*responses)
+        content = barnehagefakta_get.barnehagefakta_get_json('1', old_age_days=1, cache_dir=self.cache_dir, store=self.store)
+        return content, barnehagefakta_get.request_session.requests
+
+    def make_old(self):
+        filename = self.store.filename('1', self.cache_dir)
+        old = time.time() - 2*24*60*60
+        os.utime(filename, (old, old))
+
+    def test_not_modified(self):
+        content, requests = self.get(StubResponse(200, b'{"navn": "Foo"}', {'ETag': '"a"'}))
+        self.assertFalse(requests[0][1]) # no conditional headers without a cached response
+        self.assertEqual(self.store.load_validators('1', self.cache_dir), {'ETag': '"a"'})
+
+        self.make_old()
+        self.assertEqual(self.store.load('1', self.cache_dir, 1)[1], True)
+        content, requests = self.get(StubResponse(304))
+        self.assertEqual(requests[0][1], {'If-None-Match': '"a"'})
+        self.assertEqual(content, '{"navn": "Foo"}')
+        self.assertEqual(self.store.load('1', self.cache_dir, 1), ('{"navn": "Foo"}', False))
+        self.assertEqual(list(self.store.find_outdated(self.root)), [])
+
+    def test_modified(self):
+        self.get(StubResponse(200, b'{"navn": "Foo"}', {'ETag': '"a"'}))
+        self.make_old()
+        content, requests = self.get(StubResponse(200, b'{"navn": "Bar"}', {'ETag': '"b"'}))
+        self.assertEqual(content, b'{"navn": "Bar"}')
+        self.assertEqual(self.store.load_validators('1', self.cache_dir), {'ETag': '"b"'})
+        self.assertEqual(len(list(self.store.find_outdated(self.root))), 1)
+
+class GetManyTest(unittest.TestCase):
+    """barnehagefakta_get_many and barnehagefakta_get_ordered with a stub barnehagefakta_get"""
+    def setUp(self):
+        self.get = barnehagefakta_get.barnehagefakta_get
+        barnehagefakta_get.barnehagefakta_get = self.stub_get
+        self.calls = list()     # (orgnr, start time)
+        self.consumed = 0
+
+    def tearDown(self):
+        barnehagefakta_get.barnehagefakta_get = self.get
+
+    def stub_get(self, orgnr, rate_limiter=None, **kwargs):
+        rate_limiter.wait()
+        self.calls.append((orgnr, time.time()))
+        time.sleep(0.01*(int(orgnr) % 3)) # complete out of order
+        if orgnr == '404':
+            raise barnehagefakta_get.NotFoundException(orgnr)
+        return {'orgnr': orgnr}
+
+    def items(self, orgnrs):
+        for orgnr in orgnrs:
+            self.consumed += 1
+            yield orgnr
+
+    def test_many(self):
+        orgnrs = ['1', '2', '3', '1', '404', '2']
+        results = list(barnehagefakta_get.barnehagefakta_get_many(orgnrs, concurrency=3, min_interval=0))
+        self.assertEqual(sorted(orgnr for orgnr, _, _ in results), ['1', '2', '3', '404'])
+        self.assertEqual(sorted(orgnr for orgnr, _ in self.calls), ['1', '2', '3', '404'])
+        for orgnr, dct, e in results:
+            if orgnr == '404':
+                self.assertEqual(dct, {})
+                self.assertTrue(isinstance(e, barnehagefakta_get.NotFoundException))
+            else:
+                self.assertEqual((dct, e), ({'orgnr': orgnr}, None))
+
+    def test_many_window(self):
+        results = barnehagefakta_get.barnehagefakta_get_many(self.items(map(str, range(20))), concurrency=2,
+                                                             min_interval=0, window=3)
+        next(results)
+        self.assertTrue(self.consumed <= 3)
+        self.assertEqual(len(list(results)), 19)
+
+    def test_ordered(self):
+        orgnrs = ['5', '4', '404', '3', '5', '2', '1']
+        results = list(barnehagefakta_get.barnehagefakta_get_ordered(self.items(orgnrs), concurrency=3,
+                                                                     min_interval=0, window=5))
+        self.assertEqual([orgnr for orgnr, _, _ in results], orgnrs)
+        self.assertTrue(isinstance(results[2][2], barnehagefakta_get.NotFoundException))
+        self.assertEqual(results[0][1:], ({'orgnr': '5'}, None))
+        self.assertEqual(len(self.calls), 6)     # '5' is still in the window the second time
+
+    def test_rate_limiter(self):
+        list(barnehagefakta_get.barnehagefakta_get_many(['1', '2', '3', '4', '5'], concurrency=5, min_interval=0.05))
+        starts = sorted(start for _, start in self.calls)
+        for start, next_start in zip(starts, starts[1:]):
+            self.assertTrue(next_start - start >= 0.04, starts)
+
+def stub_convert_kommune(kommune_id, **kwargs):
+    """Process pool worker for ConvertKommunerTest, the first kommune is the slowest"""
+    time.sleep(0.3 if kommune_id == '0101' else 0.)
+    return kommune_id, [], [], ''
+
+class ConvertKommunerTest(unittest.TestCase):
+    """convert_kommuner with a stub convert_kommune"""
+    kommunenummer = ['0101', '0104', '0105', '0106']
+
+    def setUp(self):
+        self.convert_kommune = barnehagefakta_osm.convert_kommune
+        barnehagefakta_osm.convert_kommune = stub_convert_kommune
+
+    def tearDown(self):
+        barnehagefakta_osm.convert_kommune = self.convert_kommune
+
+    def convert(self, **kwargs):
+        return [result[0] for result in barnehagefakta_osm.convert_kommuner(self.kommunenummer, jobs=2, **kwargs)]
+
+    def test_ordered(self):
+        self.assertEqual(self.convert(), self.kommunenummer)
+
+    def test_completed(self):
+        result = self.convert(ordered=False, window=4)
+        self.assertEqual(sorted(result), self.kommunenummer)
+        self.assertEqual(result[-1], '0101')
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, '0213')
+        self.store = FileStore()
+        self.journal = ChangeJournal(get_journal_filename(self.root))
+
+    def archive(self, orgnr, journal=True):
+        """Saves and archives a response for orgnr, as barnehagefakta_get_json does when it changes"""
+        self.store.save(orgnr, self.cache_dir, '{"old": 1}')
+        outdated = self.store.archive(orgnr, self.cache_dir, datetime(2020, 1, 1))
+        self.store.save(orgnr, self.cache_dir, '{"new": 1}')
+        updated = self.store.ref(orgnr, self.cache_dir)
+        if journal:
+            self.journal.append(orgnr, self.cache_dir, '{"old": 1}', '{"new": 1}', outdated, updated)
+        return outdated
+
+    def test_append_read(self):
+        outdated = self.archive('1')
+        self.archive('2')
+        with open(self.journal.filename, 'a') as f:
+            f.write('{"orgnr": "3"')     # partially written
+        records = list(self.journal.read())
+        self.assertEqual([record['orgnr'] for record, _ in records], ['1', '2'])
+        self.assertEqual(records[0][0]['kommune'], '0213')
+        self.assertEqual(records[0][0]['outdated'], outdated)
+        self.assertEqual(list(self.journal.read(records[0][1]))[0][0]['orgnr'], '2')
+
+    def test_checkpoint(self):
+        self.archive('1')
+        self.archive('2')
+        records, offset = self.journal.pending()
+        self.assertEqual(len(records), 2)
+        self.journal.save_checkpoint(offset, records[1:])
+        self.archive('3')
+        records, _ = self.journal.pending()
+        self.assertEqual([record['orgnr'] for record in records], ['2', '3'])
+
+    def test_first_run_includes_older_outdated(self):
+        self.archive('1', journal=False) # from before the journal
+        self.archive('2')
+        records, offset = update_osm.find_pending(self.root, self.store, self.journal)
+        self.assertEqual(sorted(record['orgnr'] for record in records), ['1', '2'])
+        self.journal.save_checkpoint(offset, [])
+        records, _ = update_osm.find_pending(self.root, self.store, self.journal)
+        self.assertEqual(records, [])
+
+    def test_missing_journal(self):
+        outdated = self.archive('1', journal=False)
+        records, offset = update_osm.find_pending(self.root, self.store, self.journal)
+        self.assertEqual(offset, None)
+        self.assertEqual([record['outdated'] for record in records], [outdated])